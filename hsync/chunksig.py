@@ -0,0 +1,163 @@
+# Chunk signatures, for fetching only the changed parts of large files.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''
+A chunk signature lets the destination fetch just the parts of a large file
+that have changed. The source cuts each file of at least --chunk-min-size
+bytes into fixed-size chunks and records the digest of each. The
+destination hashes its old copy of the file in the same chunks, keeps the
+chunks that match, and fetches the others with Range requests. The whole
+file is still checked against its digest in the signature file.
+
+The chunk file (HSYNC.SIG.chunks) starts with the digest header, then has
+one line per distinct file content,
+
+    <file digest> <chunk size> <chunk digest> <chunk digest>...
+
+followed by a 'FINAL:' line. Lines are keyed on the contents rather than the
+path, so a file that hasn't changed keeps its chunk digests from one chunk
+file to the next without being read again.
+'''
+
+import logging
+import os
+
+from exceptions import *
+from filehash import HashStringFormatError
+from hashengine import digest_header, header_digest, engine as hash_engine
+
+log = logging.getLogger()
+
+CHUNKS_SUFFIX = '.chunks'
+
+
+class ChunkSignature(object):
+    '''
+    The chunk digests from a chunk file, keyed on the raw digest of the
+    whole file's contents. digest_name is the algorithm they were made with.
+    '''
+
+    def __init__(self, digest_name):
+        self.digest_name = digest_name
+        self.files = {}
+
+    def add(self, digest, chunk_size, chunks):
+        self.files[digest] = (chunk_size, chunks)
+
+    def get(self, digest, chunk_size=None):
+        '''
+        Return the raw chunk digests for the contents with raw digest
+        digest, as a tuple (chunk_size, chunks), or None. If chunk_size is
+        given, only chunks of that size will do.
+        '''
+        entry = self.files.get(digest)
+        if entry is None or \
+                (chunk_size is not None and entry[0] != chunk_size):
+            return None
+        return entry
+
+    def __len__(self):
+        return len(self.files)
+
+
+def chunk_file_write(hashlist, path, root, chunk_size, min_size, old=None):
+    '''
+    Write the chunk file for the files in hashlist of at least min_size
+    bytes. The chunk digests are taken from those recorded by the hash
+    engine as the files were scanned, or from old (a ChunkSignature) if the
+    contents are unchanged. Any others are read from the files under root.
+    '''
+    log.debug("Writing chunk file '%s'", path)
+    if old is not None and old.digest_name != hash_engine.digest_name:
+        old = None
+
+    done = set()
+    read = 0
+    with open(path, 'w') as f:
+        f.write(digest_header(hash_engine.digest_name) + '\n')
+        for fh in hashlist:
+            if not fh.is_file or fh.size < min_size or fh.digest in done:
+                continue
+
+            chunks = hash_engine.take_chunks(fh.digest)
+            if chunks is None and old is not None:
+                entry = old.get(fh.digest, chunk_size)
+                if entry is not None:
+                    chunks = entry[1]
+            if chunks is None:
+                fpath = os.path.join(root, fh.fpath)
+                try:
+                    result = hash_engine.hash_path(fpath,
+                                                   chunk_size=chunk_size)
+                except IOError as e:
+                    log.warn("Can't read '%s' for its chunk digests: %s",
+                             fpath, e)
+                    continue
+                read += 1
+                if result.digest != fh.digest:
+                    log.warn("'%s' has changed since it was scanned, "
+                             "leaving it out of the chunk file", fpath)
+                    continue
+                chunks = result.chunks
+
+            done.add(fh.digest)
+            f.write("%s %d %s\n" % (fh.hashstr, chunk_size,
+                                    ' '.join(c.encode('hex')
+                                             for c in chunks)))
+        f.write("FINAL: %d\n" % len(done))
+
+    log.debug("Chunk file: %d files, %d read again", len(done), read)
+
+
+def chunks_from_lines(lines, name='chunk file'):
+    '''
+    Read a ChunkSignature from the lines of a chunk file, without line
+    endings.
+    '''
+    sig = None
+    final_seen = False
+    for l in lines:
+        final_seen = False
+        if l.startswith('#'):
+            digest_name = header_digest(l)
+            if digest_name is not None:
+                sig = ChunkSignature(digest_name)
+        elif l.startswith('FINAL:'):
+            final_seen = True
+        else:
+            if sig is None:
+                raise HashStringFormatError("%s has no digest header" % name)
+            fields = l.split(' ')
+            sig.add(fields[0].decode('hex'), int(fields[1]),
+                    [c.decode('hex') for c in fields[2:]])
+
+    if not final_seen:
+        raise TruncatedHashfileError("'FINAL:' line of %s appears "
+                                     "to be missing!" % name)
+    if sig is None:
+        raise HashStringFormatError("%s has no digest header" % name)
+    return sig
@@ -27,7 +27,6 @@
 
 from __future__ import print_function
 
-import gzip
 import logging
 import os
 import os.path
@@ -35,10 +34,19 @@ import tempfile
 import urllib2
 import urlparse
 
-from fetch import fetch_contents, fetch_needed, delete_not_needed
+from chunksig import CHUNKS_SUFFIX, chunks_from_lines
+from fetch import (fetch_contents, fetch_lines, fetch_needed,
+                   delete_not_needed, FetchException)
 from filehash import *
+from hashcache import CACHE_SUFFIX, HashCache
+from hashengine import UnknownDigestError, engine as hash_engine
+from hashlist_mmap import MmapHashList
 from hashlist_op_impl import (sigfile_write, hashlist_from_stringlist,
-                              hashlist_check)
+                              hashlist_from_sigbin, hashlist_check)
+from sigjournal import (JOURNAL_SUFFIX, SigJournal, journal_lines,
+                        remove_journal, with_journal)
+from subtree import subtree_digests_from_lines
+from keepalive import ConnectionPool, keepalive_handlers
 from local_pwmgr import InstrumentedHTTPPassManager
 from lockfile import LockFileManager
 from utility import cano_url
@@ -103,48 +111,63 @@ def dest_side(opt, args):
         handlers.extend(list(proxy_handlers))
     if auth_handler is not None:
         handlers.append(auth_handler)
+    if not opt.no_http_keepalive:
+        handlers.extend(_configure_http_keepalive(opt))
 
-    if handlers:
-        log.debug("Building opener: Handlers %s", handlers)
-        opener = urllib2.build_opener(*handlers)
+    # Always install an opener, so one left over from a previous run isn't
+    # used by accident.
+    log.debug("Building opener: Handlers %s", handlers)
+    opener = urllib2.build_opener(*handlers)
 
-        log.debug("Installing urllib2 opener: %s", opener)
-        urllib2.install_opener(opener)
+    log.debug("Installing urllib2 opener: %s", opener)
+    urllib2.install_opener(opener)
 
-    (hashurl, shortname, compressed_sig) = _configure_hashurl(opt)
+    (hashurl, shortname, compressed_sig, binary_sig) = _configure_hashurl(opt)
 
     # Fetch the signature file.
     if not opt.quiet:
         print("Fetching remote hashfile")
 
-    hashfile_contents = fetch_contents(hashurl, opt,
-                                       short_name=shortname,
-                                       include_in_total=False)
+    try:
+        if opt.include:
+            src_hashlist = _read_remote_mmap(hashurl, shortname,
+                                             compressed_sig, opt)
+        elif binary_sig:
+            src_hashlist = _read_remote_sigbin(hashurl, shortname, opt)
+        else:
+            src_hashlist = _read_remote_hashlist(hashurl, shortname,
+                                                 compressed_sig, opt)
+    except FetchException as e:
+        log.error("Failed to retrieve signature file from '%s': %s",
+                  hashurl, e)
+        return False
+    except UnknownDigestError as e:
+        log.error("Can't use signature file from '%s': %s", hashurl, e)
+        return False
 
-    if hashfile_contents is None:
+    if src_hashlist is None:
         # We're not coming back from this.
         log.error("Failed to retrieve signature file from '%s", hashurl)
         return False
 
-    if compressed_sig:
-        gziptmp = tempfile.NamedTemporaryFile()
-        with gziptmp:
-            gziptmp.file.write(hashfile_contents)
-            gziptmp.file.close()
-            src_strfile = []
-            for l in gzip.open(gziptmp.name):
-                src_strfile.append(l.rstrip())
-    else:
-        src_strfile = hashfile_contents.splitlines()
+    # Check our files with the same algorithm as the source.
+    if src_hashlist.digest_name is None:
+        log.error("Signature file from '%s' has conflicting digest headers",
+                  hashurl)
+        return False
+    hash_engine.use_digest(src_hashlist.digest_name)
+    if opt.verbose:
+        print("Signature digest algorithm: %s" % src_hashlist.digest_name)
 
-    # Release hashfile contents from memory.
-    hashfile_contents = None
+    src_tree = None
+    if opt.remote_sig_tree:
+        src_tree = _read_remote_tree(hashurl, shortname, compressed_sig,
+                                     binary_sig, opt)
 
-    if not src_strfile[-1].startswith("FINAL:"):
-        raise TruncatedHashfileError("'FINAL:'' line of hashfile %s appears "
-                                     "to be missing!" % hashurl)
-    src_hashlist = hashlist_from_stringlist(src_strfile, opt,
-                                            root=opt.dest_dir)
+    src_chunks = None
+    if opt.remote_sig_chunks:
+        src_chunks = _read_remote_chunks(hashurl, compressed_sig, binary_sig,
+                                         opt)
 
     opt.source_url = cano_url(opt.source_url, slash=True)
     log.debug("Source url '%s", opt.source_url)
@@ -159,10 +182,155 @@ def dest_side(opt, args):
 
     with LockFileManager(abs_lockfile):
 
-        return _dest_impl(abs_hashfile, src_hashlist, shortname, opt)
+        return _dest_impl(abs_hashfile, src_hashlist, shortname, opt,
+                          src_tree=src_tree, src_chunks=src_chunks)
+
+
+def _read_remote_hashlist(hashurl, shortname, compressed_sig, opt):
+    '''
+    Fetch and parse the remote signature file. The lines are parsed (and
+    decompressed, if need be) as they arrive, so the whole file is never
+    held in memory or written to disk.
+
+    Returns None if the file can't be fetched.
+    '''
+
+    src_strfile = fetch_lines(hashurl, opt, compressed=compressed_sig,
+                              short_name=shortname,
+                              include_in_total=False)
+    if src_strfile is None:
+        return None
+
+    return hashlist_from_stringlist(src_strfile, opt, root=opt.dest_dir,
+                                    require_final=True,
+                                    name="hashfile %s" % hashurl)
+
 
+def _read_remote_sigbin(hashurl, shortname, opt):
+    '''
+    Fetch and load a remote binary signature file. It's read through mmap,
+    so unless it's a local file it's fetched to a temporary file first.
+
+    Returns None if the file can't be fetched.
+    '''
+
+    up = urlparse.urlparse(hashurl)
+    if up.scheme == 'file':
+        try:
+            f = open(up.path, 'rb')
+        except IOError as e:
+            log.debug("Failed to open '%s': %s", up.path, e)
+            return None
+    else:
+        f = tempfile.TemporaryFile(prefix='hsync-sigbin.')
+        if fetch_contents(hashurl, opt, outfile=f, short_name=shortname,
+                          include_in_total=False) is None:
+            f.close()
+            return None
+        f.flush()
+
+    with f:
+        return hashlist_from_sigbin(f, opt, root=opt.dest_dir,
+                                    name="hashfile %s" % hashurl)
+
+
+def _read_remote_mmap(hashurl, shortname, compressed_sig, opt):
+    '''
+    Fetch a remote signature file, text or binary, and return a hashlist
+    that only decodes the entries that are visited. That makes -I/--include
+    of a small part of a large tree cheap. Unless it's an uncompressed local
+    file, it's fetched (and decompressed) to a temporary file first.
+
+    Returns None if the file can't be fetched.
+    '''
+
+    up = urlparse.urlparse(hashurl)
+    if up.scheme == 'file' and not compressed_sig:
+        try:
+            f = open(up.path, 'rb')
+        except IOError as e:
+            log.debug("Failed to open '%s': %s", up.path, e)
+            return None
+    else:
+        f = tempfile.TemporaryFile(prefix='hsync-sig.')
+        if fetch_contents(hashurl, opt, outfile=f, compressed=compressed_sig,
+                          short_name=shortname,
+                          include_in_total=False) is None:
+            f.close()
+            return None
+        f.flush()
 
-def _dest_impl(abs_hashfile, src_hashlist, shortname, opt):
+    return MmapHashList(f, opt, root=opt.dest_dir,
+                        name="hashfile %s" % hashurl)
+
+
+def _read_remote_tree(hashurl, shortname, compressed_sig, binary_sig, opt):
+    '''
+    Fetch the remote subtree file, which lives next to the text signature
+    file. It's only an optimisation, so if it can't be had, say so and
+    return None.
+    '''
+
+    treeurl = _sidecar_url(hashurl, '.tree', compressed_sig, binary_sig)
+
+    lines = fetch_lines(treeurl, opt, short_name=os.path.basename(treeurl),
+                        include_in_total=False)
+    try:
+        if lines is not None:
+            return subtree_digests_from_lines(lines,
+                                              name="subtree file %s" % treeurl)
+    except (FetchException, TruncatedHashfileError) as e:
+        log.debug("Failed to read '%s': %s", treeurl, e)
+
+    log.warn("Couldn't read subtree file '%s', checking every entry",
+             treeurl)
+    return None
+
+
+def _read_remote_chunks(hashurl, compressed_sig, binary_sig, opt):
+    '''
+    Fetch the remote chunk file, which lives next to the text signature
+    file. It's only an optimisation, so if it can't be had or doesn't match
+    the signature file, say so and return None.
+    '''
+
+    chunksurl = _sidecar_url(hashurl, CHUNKS_SUFFIX, compressed_sig,
+                             binary_sig)
+
+    lines = fetch_lines(chunksurl, opt,
+                        short_name=os.path.basename(chunksurl),
+                        include_in_total=False)
+    try:
+        if lines is not None:
+            chunks = chunks_from_lines(lines,
+                                       name="chunk file %s" % chunksurl)
+            if chunks.digest_name == hash_engine.digest_name:
+                if opt.verbose:
+                    print("Read chunk digests for %d files" % len(chunks))
+                return chunks
+            log.debug("'%s' uses digest %s", chunksurl, chunks.digest_name)
+    except (FetchException, TruncatedHashfileError, HashStringFormatError,
+            UnknownDigestError, ValueError, TypeError) as e:
+        log.debug("Failed to read '%s': %s", chunksurl, e)
+
+    log.warn("Couldn't read chunk file '%s', fetching whole files",
+             chunksurl)
+    return None
+
+
+def _sidecar_url(hashurl, suffix, compressed_sig, binary_sig):
+    '''
+    The subtree and chunk files are next to the text signature file.
+    '''
+    if compressed_sig and hashurl.endswith('.gz'):
+        hashurl = hashurl[:-len('.gz')]
+    elif binary_sig and hashurl.endswith('.bin'):
+        hashurl = hashurl[:-len('.bin')]
+    return hashurl + suffix
+
+
+def _dest_impl(abs_hashfile, src_hashlist, shortname, opt, src_tree=None,
+               src_chunks=None):
 
     existing_hl = None
 
@@ -174,31 +342,65 @@ def _dest_impl(abs_hashfile, src_hashlist, shortname, opt):
             print("Reading existing hashfile")
 
         # Fetch the signature file.
-        hashfile_contents = fetch_contents('file://' + abs_hashfile, opt,
-                                           short_name=shortname,
-                                           remote_flag=False,
-                                           include_in_total=False)
-        dst_strfile = hashfile_contents.splitlines()
-        existing_hl = hashlist_from_stringlist(dst_strfile, opt,
-                                               root=opt.dest_dir)
+        dst_strfile = fetch_lines('file://' + abs_hashfile, opt,
+                                  short_name=shortname,
+                                  remote_flag=False,
+                                  include_in_total=False)
+        if dst_strfile is not None:
+            # Anything fetched by an interrupted run is in the journal, and
+            # later entries win.
+            journal = journal_lines(abs_hashfile + JOURNAL_SUFFIX)
+            if journal and opt.verbose:
+                print("Read %d entries from the signature journal" %
+                      len(journal))
+            try:
+                existing_hl = hashlist_from_stringlist(
+                    with_journal(dst_strfile, journal), opt,
+                    root=opt.dest_dir)
+            except UnknownDigestError as e:
+                log.warn("Ignoring existing hashfile: %s", e)
+            else:
+                # Digests made with another algorithm are no use to us.
+                if existing_hl.digest_name != hash_engine.digest_name:
+                    if not opt.quiet:
+                        print("Existing hashfile has a different digest "
+                              "algorithm, ignoring it")
+                    existing_hl.close()
+                    existing_hl = None
+
+    hash_cache = None
+    if opt.hash_cache:
+        hash_cache = HashCache(abs_hashfile + CACHE_SUFFIX,
+                               digest_name=hash_engine.digest_name)
 
     # Calculate the differences to the local filesystem.
     #
     # Since we've just done a scan, write the results to the disk - then,
     # if something goes wrong, at least we've saved the scan results.
-    (needed, not_needed, dst_hashlist) = \
-        hashlist_check(opt.dest_dir,
-                       src_hashlist, opt,
-                       existing_hashlist=existing_hl,
-                       opportunistic_write=True,
-                       opwrite_path=abs_hashfile,
-                       source_side=False)
+    try:
+        (needed, not_needed, dst_hashlist) = \
+            hashlist_check(opt.dest_dir,
+                           src_hashlist, opt,
+                           existing_hashlist=existing_hl,
+                           opportunistic_write=True,
+                           opwrite_path=abs_hashfile,
+                           source_side=False,
+                           src_tree=src_tree,
+                           hash_cache=hash_cache)
+    except:
+        if hash_cache is not None:
+            hash_cache.abandon()
+        raise
+
+    if hash_cache is not None:
+        hash_cache.close()
 
     if opt.verify_only:
         return _verify_impl(needed, not_needed, opt)
     else:
         return _fetch_remote_impl(needed, not_needed,
-                                  dst_hashlist, abs_hashfile, opt)
+                                  dst_hashlist, abs_hashfile, opt,
+                                  src_chunks=src_chunks)
 
 
 def _verify_impl(needed, not_needed, opt):
@@ -243,10 +445,26 @@ def _verify_impl(needed, not_needed, opt):
         return True
 
 
-def _fetch_remote_impl(needed, not_needed, dst_hashlist, abs_hashfile, opt):
+def _fetch_remote_impl(needed, not_needed, dst_hashlist, abs_hashfile, opt,
+                       src_chunks=None):
+
+    # The signature file written after the scan covers any old journal.
+    abs_journal = abs_hashfile + JOURNAL_SUFFIX
+    remove_journal(abs_journal)
+    journal = None
+    if not opt.no_write_hashfile:
+        journal = SigJournal(abs_journal, opt.checkpoint_files,
+                             opt.checkpoint_bytes,
+                             digest_name=hash_engine.digest_name)
 
     # fetch_needed() does almost all the work.
-    (fetch_added, fetch_err_count) = fetch_needed(needed, opt.source_url, opt)
+    try:
+        (fetch_added, fetch_err_count) = fetch_needed(needed, opt.source_url,
+                                                      opt, journal=journal,
+                                                      chunks=src_chunks)
+    finally:
+        if journal is not None:
+            journal.close()
 
     # Don't delete things if we had transfer problems. It's safer.
     delete_status = True
@@ -269,6 +487,7 @@ def _fetch_remote_impl(needed, not_needed, dst_hashlist, abs_hashfile, opt):
             log.error("Failed to write signature file '%s'",
                       os.path.join(opt.source_dir, opt.hash_file))
             return False
+        journal.remove()
 
     if not opt.quiet:
         if fetch_added:
@@ -360,14 +579,29 @@ def _configure_http_proxy(opt):
         return (proxy_handler,)
 
 
+def _configure_http_keepalive(opt):
+    '''
+    Configure persistent HTTP connections. Return a list of handlers to be
+    given to urllib2.build_opener(), replacing the default HTTP(S) handlers.
+    The handlers share a connection pool, which counts connections in
+    opt.stats.
+
+    '''
+    return keepalive_handlers(ConnectionPool(stats=opt.stats))
+
+
 def _configure_hashurl(opt):
 
     hashurl = None
     hashfile = opt.hash_file
     shortname = hashfile
     compressed_sig = False
+    binary_sig = False
 
-    if opt.remote_sig_compressed:
+    if opt.remote_sig_binary:
+        hashfile += '.bin'
+        binary_sig = True
+    elif opt.remote_sig_compressed:
         hashfile += '.gz'
         compressed_sig = True
 
@@ -379,24 +613,31 @@ def _configure_hashurl(opt):
         u_path = p_url.path
         shortname = os.path.basename(u_path)
 
-        if opt.signature_url.endswith('.gz'):
+        if opt.signature_url.endswith('.bin'):
+            log.debug("Assuming binary signature URL '%s'",
+                      opt.signature_url)
+            binary_sig = True
+
+        elif opt.signature_url.endswith('.gz'):
             log.debug("Assuming compression for signature URL '%s'",
                       opt.signature_url)
             compressed_sig = True
 
-        if opt.remote_sig_compressed:
+        if opt.remote_sig_compressed and not binary_sig:
             log.debug("Force remote signature compression mode")
             compressed_sig = True
 
     else:
-        if opt.remote_sig_compressed:
-            compressed_sig = True
+        if binary_sig:
+            shortname += '.bin'
+        elif compressed_sig:
             shortname += '.gz'
 
         hashurl = cano_url(opt.source_url, slash=True) + hashfile
         log.debug("Synthesised signature URL '%s'", hashurl)
 
     log.debug("_configure_hashurl(): hashurl=%s shortname=%s "
-              "compressed_sig=%s", hashurl, shortname, compressed_sig)
+              "compressed_sig=%s binary_sig=%s",
+              hashurl, shortname, compressed_sig, binary_sig)
 
-    return (hashurl, shortname, compressed_sig)
+    return (hashurl, shortname, compressed_sig, binary_sig)
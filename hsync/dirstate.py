@@ -0,0 +1,231 @@
+# Directory state for incremental scans.
+
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''
+An incremental scan doesn't list directories that haven't changed since
+the last scan. Adding, removing or renaming anything in a directory
+changes its mtime, so if a directory's mtime, inode and device are as they
+were when it was last listed, its contents can be taken from the last
+signature file instead.
+
+Changing a file in place doesn't change its directory, though. In 'stat'
+mode the files in unchanged directories are still lstat()'d, and rehashed
+if need be. In 'trust' mode they aren't looked at at all, and in-place
+changes are only seen at the next full scan (see --full-scan-interval).
+
+The state goes in a sidecar file, HSYNC.SIG.dirs, next to the signature.
+'''
+
+import cPickle
+import logging
+import os
+from random import SystemRandom
+import time
+
+log = logging.getLogger()
+
+STATE_VERSION = 1
+
+# Directories changed this recently aren't recorded, as a change in the
+# same clock tick wouldn't alter the mtime.
+RACY_SECONDS = 2
+
+
+def scan_key(opts):
+    '''
+    The options that change which objects a scan sees. A state recorded
+    with different options can't be used.
+    '''
+    return repr((sorted(opts.exclude_dir or []), opts.no_ignore_dirs,
+                 opts.no_ignore_files, opts.hash_file, opts.trim_path,
+                 opts.guess_sigfiles))
+
+
+class DirState(object):
+    '''
+    The mtime, inode and device of each directory when it was last listed,
+    and the names in it that were directories (or symlinks to them), keyed
+    on the directory's path relative to the top.
+    '''
+
+    def __init__(self, key, full_scan_time):
+        self.key = key
+        self.full_scan_time = full_scan_time
+        self.dirs = {}
+        # The size, mtime and inode of the signature file this state goes
+        # with.
+        self.sig_stat = None
+
+    @classmethod
+    def load(cls, path, sigpath):
+        '''
+        Load the state at path, or return None if there isn't a usable
+        one. It must go with the signature file at sigpath.
+        '''
+        try:
+            with open(path, 'rb') as f:
+                saved = cPickle.load(f)
+        except (IOError, EOFError, ValueError, TypeError,
+                cPickle.UnpicklingError) as e:
+            log.debug("Can't load directory state '%s': %s", path, e)
+            return None
+
+        if not isinstance(saved, tuple) or saved[0] != STATE_VERSION:
+            log.debug("Directory state '%s' has the wrong version, "
+                      "ignoring", path)
+            return None
+
+        (version, key, full_scan_time, sig_stat, dirs) = saved
+        state = cls(key, full_scan_time)
+        state.sig_stat = sig_stat
+        state.dirs = dirs
+
+        if state.sig_stat != _sig_stat(sigpath):
+            log.debug("Directory state '%s' doesn't match signature file "
+                      "'%s', ignoring", path, sigpath)
+            return None
+
+        return state
+
+    def save(self, path, sigpath):
+        '''
+        Save the state to path, recording the signature file it goes with.
+        '''
+        self.sig_stat = _sig_stat(sigpath)
+        path_tmp = path + ".%08x" % SystemRandom().randint(0, 0xffffffff)
+        log.debug("Writing directory state '%s'", path_tmp)
+        with open(path_tmp, 'wb') as f:
+            # Plain types only, so the file doesn't depend on how this
+            # module was imported.
+            cPickle.dump((STATE_VERSION, self.key, self.full_scan_time,
+                          self.sig_stat, self.dirs),
+                         f, cPickle.HIGHEST_PROTOCOL)
+        log.debug("Moving directory state into place: '%s' -> '%s'",
+                  path_tmp, path)
+        os.rename(path_tmp, path)
+
+
+def _sig_stat(sigpath):
+    try:
+        st = os.stat(sigpath)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+
+class IncrementalListing(object):
+    '''
+    Give fswalk.walk() the contents of unchanged directories, from the old
+    state and the hashlist read from the last signature file, and record
+    the new state as it goes.
+
+    If there's no usable old state, or the last full scan was more than
+    opts.full_scan_interval seconds ago, nothing is reused, and this scan
+    counts as a full one.
+    '''
+
+    def __init__(self, srcpath, opts, state=None, existing_hashlist=None,
+                 now=None):
+        self.srcpath = srcpath.rstrip(os.sep)
+        self.trim = opts.trim_path
+        self.stat_files = (opts.incremental_scan == 'stat')
+        if now is None:
+            now = time.time()
+        self.now = now
+        self.reused = 0
+
+        key = scan_key(opts)
+        self.old = None
+        full_scan_time = now
+        if state is None or existing_hashlist is None:
+            log.debug("IncrementalListing: no previous state, full scan")
+        elif state.key != key:
+            log.debug("IncrementalListing: options changed, full scan")
+        elif now - state.full_scan_time >= opts.full_scan_interval:
+            log.debug("IncrementalListing: full scan due")
+        else:
+            self.old = state
+            full_scan_time = state.full_scan_time
+            self.hashlist = existing_hashlist
+            # The children of the directory looked up last. Its files'
+            # entries are asked for straight after it's listed.
+            self.listed = (None, None)
+
+        self.new = DirState(key, full_scan_time)
+
+    @property
+    def full_scan(self):
+        return self.old is None
+
+    def _children(self, key):
+        '''The last signature file's entries in a directory, by name.'''
+        if self.listed[0] != key:
+            self.listed = (key, self.hashlist.children(key))
+        return self.listed[1]
+
+    def _rel(self, path):
+        return path[len(self.srcpath) + 1:]
+
+    def _key(self, path):
+        '''The hashlist's form of path.'''
+        if self.trim:
+            return self._rel(path)
+        return path
+
+    def get(self, path, st):
+        if self.old is None:
+            return None
+        rel = self._rel(path)
+        rec = self.old.dirs.get(rel)
+        if rec is None or rec[:3] != (st.st_mtime, st.st_ino, st.st_dev):
+            return None
+
+        dirs = rec[3]
+        dirset = set(dirs)
+        files = [name for name in self._children(self._key(path))
+                 if name not in dirset]
+        self.new.dirs[rel] = rec
+        self.reused += 1
+        log.debug("IncrementalListing: '%s' unchanged", path)
+        return (dirs, files, self.stat_files)
+
+    def put(self, path, st, dirs):
+        if st.st_mtime >= self.now - RACY_SECONDS:
+            log.debug("IncrementalListing: '%s' changed too recently to "
+                      "record", path)
+            return
+        self.new.dirs[self._rel(path)] = (st.st_mtime, st.st_ino, st.st_dev,
+                                          list(dirs))
+
+    def entry(self, path):
+        '''
+        Return the last signature file's entry for a file that wasn't
+        stat()'d.
+        '''
+        (dirname, name) = os.path.split(path)
+        return self._children(self._key(dirname))[name]
@@ -95,3 +95,7 @@ class InitialiserNotAHashListError(Exception):
 
 class UnexpectedDuplicateFilepathError(Exception):
     pass
+
+
+class ReadOnlyHashListError(Exception):
+    pass
@@ -0,0 +1,97 @@
+# External merge sort.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import cPickle
+import heapq
+import logging
+import tempfile
+
+log = logging.getLogger()
+
+# The number of records sorted in memory at a time.
+RUN_SIZE = 100000
+
+
+def external_sort(records, run_size=None, tmpdir=None):
+    '''
+    Generate the given records in sorted order, holding no more than
+    run_size (by default, RUN_SIZE) of them in memory at once.
+
+    Records are sorted in runs of run_size, and each run is written to a
+    temporary file in tmpdir. The runs are then merged. If there's only
+    one run, it never touches the disk.
+
+    Records must be picklable, and are compared as they are, so a tuple
+    with the sort key first is the usual thing.
+    '''
+    if run_size is None:
+        run_size = RUN_SIZE
+
+    runs = []
+    try:
+        buf = []
+        for rec in records:
+            buf.append(rec)
+            if len(buf) >= run_size:
+                runs.append(_write_run(buf, tmpdir))
+                buf = []
+
+        if not runs:
+            buf.sort()
+            for rec in buf:
+                yield rec
+            return
+
+        if buf:
+            runs.append(_write_run(buf, tmpdir))
+            buf = None
+
+        log.debug("external_sort: merging %d runs", len(runs))
+        for rec in heapq.merge(*[_read_run(f) for f in runs]):
+            yield rec
+
+    finally:
+        for f in runs:
+            f.close()
+
+
+def _write_run(buf, tmpdir):
+    buf.sort()
+    # The file disappears when it's closed.
+    f = tempfile.TemporaryFile(prefix='hsync-sort.', dir=tmpdir)
+    for rec in buf:
+        cPickle.dump(rec, f, cPickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+
+def _read_run(f):
+    while True:
+        try:
+            yield cPickle.load(f)
+        except EOFError:
+            return
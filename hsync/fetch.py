@@ -28,30 +28,57 @@
 from __future__ import print_function
 
 from BaseHTTPServer import BaseHTTPRequestHandler
-import hashlib
 import logging
 import os
 import re
 from random import SystemRandom
 import sys
+import threading
 import urllib
 import urllib2
 import urlparse
+import zlib
 
 from numformat import IECUnitConverter
 from stats import StatsCollector
 from exceptions import *
-from utility import is_path_included
+from hashengine import engine as hash_engine
+from utility import (GlobMatcher, PrefixSet, is_path_included,
+                     partial_path)
+from workerpool import WorkerPool
 
 log = logging.getLogger()
 
+# Serialises output from concurrent fetches.
+_output_lock = threading.Lock()
 
-def fetch_contents(fpath, opts, root='', no_trim=False, for_filehash=None,
-                   short_name=None, file_count_number=None,
-                   file_count_total=None, remote_flag=True,
-                   include_in_total=True):
+# Read size for files already on the destination, i.e. local copies and
+# partial downloads.
+LOCAL_COPY_BLOCK = 1024 * 1024
+
+
+def fetch_blocks(fpath, opts, root='', no_trim=False, for_filehash=None,
+                 short_name=None, file_count_number=None,
+                 file_count_total=None, remote_flag=True,
+                 include_in_total=True, hasher=None, concurrent=False,
+                 offset=0):
     '''
-    Wrap a fetch, which may be from a file or URL depending on the options.
+    Open a fetch, which may be from a file or URL depending on the options,
+    and return a generator of the blocks of the object as they arrive.
+
+    If offset is given, the object is fetched from there on, with a Range
+    request for HTTP or a seek for a file. Sizes and progress still count
+    the whole object. FetchRangeException is raised if the source can't
+    give us what we asked for.
+
+    The generator keeps the stats and shows progress as it goes. If hasher
+    is given (a hashlib object), it is updated with each block. If the
+    expected size is known, the generator stops as soon as more data than
+    expected arrives, and raises FetchSizeMismatchException if the size is
+    wrong at the end.
+
+    If concurrent is set, other fetches may be running in other threads, so
+    there's no incremental progress output, just a line when we're done.
 
     Returns None on a 404, re-raises the Exception otherwise.
     '''
@@ -61,7 +88,7 @@ def fetch_contents(fpath, opts, root='', no_trim=False, for_filehash=None,
     if not no_trim and opts.trim_path and root:
         fullpath = os.path.join(opts.source_url, fpath)
 
-    log.debug("fetch_contents: %s", fullpath)
+    log.debug("fetch_blocks: %s", fullpath)
 
     fh = None
     if for_filehash is not None:
@@ -88,10 +115,16 @@ def fetch_contents(fpath, opts, root='', no_trim=False, for_filehash=None,
         else:
             filecountstr = ' [file %d]' % file_count_number
 
+    if offset:
+        filecountstr += ' (resumed at %s)' % \
+            IECUnitConverter.bytes_to_unit(offset)
+
     # This part of the progress meter doesn't change, so cache it.
     pfx = "%s" % (filecountstr)
 
-    if not opts.quiet:
+    show_progress = opts.progress and not concurrent
+
+    if not opts.quiet and not concurrent:
         if opts.progress:
             progress_spacer = "\n\t"
             pfx = "\r" + pfx
@@ -100,24 +133,42 @@ def fetch_contents(fpath, opts, root='', no_trim=False, for_filehash=None,
 
         print('F: %s%s%s' % (fname, progress_spacer, pfx), end='')
 
-    outfile = ''
-
     try:
         if remote_flag and include_in_total:
-            opts.stats.content_fetches += 1
+            opts.stats.incr('content_fetches')
         else:
-            opts.stats.metadata_fetches += 1
+            opts.stats.incr('metadata_fetches')
 
-        url = urllib2.urlopen(fullpath)
+        request = fullpath
+        if offset:
+            request = urllib2.Request(
+                fullpath, headers={'Range': 'bytes=%d-' % offset})
+        url = urllib2.urlopen(request)
     except urllib2.HTTPError as e:
+        e.close()
         if e.code == 404:
             resp = BaseHTTPRequestHandler.responses
             log.warn("Failed to retrieve '%s': %s", fullpath, resp[404][0])
+        elif e.code == 416 and offset:
+            raise FetchRangeException(
+                "'%s': Can't resume at byte %d" % (fname, offset))
         return None
     except urllib2.URLError as e:
         log.warn("Failed to retrieve '%s': %s", fullpath, e)
         return None
 
+    skip = 0
+    if offset:
+        skip = _seek_response(url, offset)
+        if skip is None:
+            url.close()
+            raise FetchRangeException(
+                "'%s': Unexpected Content-Range '%s'" %
+                (fname, url.info().getheader('content-range')))
+        if skip:
+            log.debug("'%s': Range not honoured, skipping %d bytes",
+                      fname, skip)
+
     size = 0
     size_is_known = False
     block_size = int(opts.fetch_blocksize)
@@ -126,17 +177,16 @@ def fetch_contents(fpath, opts, root='', no_trim=False, for_filehash=None,
         size = fh.size
         size_is_known = True
 
-    elif 'content-length' in url.info()['content-length']:
-        size = int(url.info()['content-length'])
+    elif url.info().getheader('content-length') is not None:
+        size = int(url.info().getheader('content-length'))
         size_is_known = True
+        if url.getcode() == 206:
+            size += offset
 
-    if opts.progress and size_is_known:
+    if show_progress and size_is_known:
         sizestr = IECUnitConverter.bytes_to_unit(size)
 
-    bytes_read = 0
-    more_to_read = True
-
-    def progstr():
+    def progstr(bytes_read):
         if size_is_known:
             if size == 0:
                 pct = 100.0     # Seems logical.
@@ -156,45 +206,215 @@ def fetch_contents(fpath, opts, root='', no_trim=False, for_filehash=None,
                    IECUnitConverter.bytes_to_unit(bytes_read)),
                   end='')
 
-    if opts.progress:
-        progstr()
+    def blocks():
+        bytes_read = offset
+        to_skip = skip
+        more_to_read = True
 
-    while more_to_read:
-        # if log.isEnabledFor(logging.DEBUG):
-        #     log.debug("Read: %d bytes (%d/%d)",
-        #               block_size,bytes_read, size)
+        if show_progress:
+            progstr(bytes_read)
+
+        # Closing the URL lets a keep-alive connection go back to the pool
+        # once the body has been read.
         try:
-            new_bytes = url.read(block_size)
-            nblen = len(new_bytes)
-            if not new_bytes:
-                more_to_read = False
-            else:
-                bytes_read += nblen
-                if remote_flag:
-                    if include_in_total:
-                        opts.stats.bytes_transferred += nblen
-                    else:
-                        opts.stats.metadata_bytes_transferred += nblen
-
-                outfile += new_bytes
-                if opts.progress:
-                    progstr()
-
-        except urllib2.URLError as e:
-            log.warn("'%s' fetch failed: %s", str(e))
-            raise e
-
-    if not opts.progress:
-        # In progress mode, give the caller a chance to add information.
-        print('')
+            while more_to_read:
+                try:
+                    new_bytes = url.read(block_size)
+                except urllib2.URLError as e:
+                    log.warn("'%s' fetch failed: %s", fname, e)
+                    raise e
+
+                nblen = len(new_bytes)
+                if not new_bytes:
+                    more_to_read = False
+                else:
+                    if remote_flag:
+                        if include_in_total:
+                            opts.stats.incr('bytes_transferred', nblen)
+                        else:
+                            opts.stats.incr('metadata_bytes_transferred',
+                                            nblen)
+
+                    if to_skip:
+                        # We already have these.
+                        dropped = min(to_skip, nblen)
+                        to_skip -= dropped
+                        new_bytes = new_bytes[dropped:]
+                        nblen -= dropped
+                        if not new_bytes:
+                            continue
+
+                    bytes_read += nblen
+
+                    if hasher is not None:
+                        hasher.update(new_bytes)
+                    yield new_bytes
+                    if show_progress:
+                        progstr(bytes_read)
+
+                    if size_is_known and bytes_read > size:
+                        # No point reading any more, this can't be right.
+                        break
+        finally:
+            url.close()
+
+        if concurrent:
+            if not opts.quiet:
+                with _output_lock:
+                    print('F: %s%s' % (fname, filecountstr))
+        elif not opts.progress:
+            # In progress mode, give the caller a chance to add information.
+            print('')
+
+        if size_is_known and bytes_read != size:
+            # That's an error. No need for a cryptochecksum to tell that.
+            log.warn("'%s': Fetched %d bytes, expected %d bytes",
+                     fname, bytes_read, size)
+            raise FetchSizeMismatchException(
+                "'%s': Fetched %d bytes, expected %d bytes" %
+                (fname, bytes_read, size))
+
+    return blocks()
+
+
+def _seek_response(url, offset):
+    '''
+    Make sure a response to a request from offset onwards really starts
+    there. Returns the number of bytes to read and drop to get to offset,
+    which is all of them if the source ignored the Range header, or None if
+    the response doesn't make sense.
+    '''
+    code = url.getcode()
+
+    if code == 206:
+        m = re.match(r'bytes (\d+)-',
+                     url.info().getheader('content-range') or '')
+        if m is None or int(m.group(1)) > offset:
+            return None
+        return offset - int(m.group(1))
+
+    if code is None:
+        # A local file, which we can simply seek.
+        try:
+            url.fp.seek(offset)
+            return 0
+        except (AttributeError, IOError) as e:
+            log.debug("Can't seek '%s': %s", url.geturl(), e)
+
+    return offset
+
+
+def fetch_contents(fpath, opts, outfile=None, compressed=False, **kwargs):
+    '''
+    Wrap a fetch, which may be from a file or URL depending on the options.
+    Other arguments are as for fetch_blocks().
+
+    If outfile is given, each block is written to it as soon as it arrives
+    and the number of bytes fetched is returned, rather than the contents.
+    That keeps memory use constant regardless of the size of the object.
+
+    If compressed is True, the object is gunzip'd as it arrives, and the
+    count is of decompressed bytes.
+
+    Returns None on a 404 or if the size is wrong, re-raises the Exception
+    otherwise.
+    '''
+
+    blocks = fetch_blocks(fpath, opts, **kwargs)
+    if blocks is None:
+        return None
+    if compressed:
+        blocks = gunzip_blocks(blocks)
+
+    # Collect the blocks and join them at the end, rather than doing
+    # (quadratic) string concatenation as we go.
+    contents = []
+    if outfile is None:
+        write_block = contents.append
+    else:
+        write_block = outfile.write
 
-    if size_is_known and bytes_read != size:
-        # That's an error. No need for a cryptochecksum to tell that.
-        log.warn("'%s': Fetched %d bytes, expected %d bytes",
-                 fname, bytes_read, size)
+    bytes_read = 0
+    try:
+        for block in blocks:
+            write_block(block)
+            bytes_read += len(block)
+    except FetchSizeMismatchException:
         return None
 
-    return outfile
+    if outfile is not None:
+        return bytes_read
+
+    return ''.join(contents)
+
+
+def fetch_lines(fpath, opts, compressed=False, **kwargs):
+    '''
+    Like fetch_contents(), but return a generator of the lines of the
+    object, without line endings, as they arrive. Only a block or so is held
+    in memory at a time.
+
+    If compressed is True, the object is gzip'd, and is decompressed as it
+    arrives.
+
+    Returns None on a 404. The generator raises FetchSizeMismatchException
+    if the object turns out to be the wrong size.
+    '''
+
+    blocks = fetch_blocks(fpath, opts, **kwargs)
+    if blocks is None:
+        return None
+    if compressed:
+        blocks = gunzip_blocks(blocks)
+    return split_lines(blocks)
+
+
+def gunzip_blocks(blocks):
+    '''
+    Decompress an iterable of blocks of gzip data, generating blocks of the
+    uncompressed data. Handles concatenated gzip members, as gzip(1) does.
+
+    Raises TruncatedHashfileError if the data stops before the end of the
+    last member.
+    '''
+    # 16 + MAX_WBITS tells zlib to expect a gzip header and trailer.
+    wbits = 16 + zlib.MAX_WBITS
+    d = zlib.decompressobj(wbits)
+    for block in blocks:
+        while block:
+            data = d.decompress(block)
+            if data:
+                yield data
+            # Anything after the end of a member is the start of another.
+            block = d.unused_data
+            if block:
+                d = zlib.decompressobj(wbits)
+
+    # zlib doesn't say whether the last member was finished. If it was,
+    # anything more is left in unused_data rather than decompressed.
+    try:
+        d.decompress('\0')
+        finished = (d.unused_data == '\0')
+    except zlib.error:
+        finished = False
+    if not finished:
+        raise TruncatedHashfileError("Compressed data ends before the end "
+                                     "of the gzip stream")
+
+
+def split_lines(blocks):
+    '''
+    Turn an iterable of blocks of text into a generator of lines, without
+    line endings.
+    '''
+    partial = ''
+    for block in blocks:
+        lines = (partial + block).split('\n')
+        partial = lines.pop()
+        for l in lines:
+            yield l.rstrip('\r')
+    if partial:
+        yield partial.rstrip('\r')
 
 
 class FetchException(Exception):
@@ -209,17 +429,36 @@ class FetchFailedChecksumException(FetchException):
     pass
 
 
+class FetchSizeMismatchException(FetchException):
+    pass
+
+
+class FetchRangeException(FetchException):
+    pass
+
+
 class FetchFatalException(Exception):
     pass
 
 
-def fetch_needed(needed, source, opts):
+def fetch_needed(needed, source, opts, journal=None, chunks=None):
     '''
     Download/copy the necessary files from opts.source_url or opts.source_dir
     to opts.dest_dir.
 
     This is a bit fiddly, as it tries hard to get the modes right.
 
+    If journal is given (a SigJournal), each object is recorded in it as
+    it's brought up to date.
+
+    If chunks is given (a chunksig.ChunkSignature), files with chunk digests
+    are brought up to date by fetching just the chunks that differ from the
+    file already on the destination.
+
+    With opts.jobs > 1, file contents are fetched by a pool of worker
+    threads. Directories and links are still handled here, in order, so a
+    directory always exists before any file is placed in it.
+
     Returns a tuple (fetch_added, error_count), a list of FileHash objects we
     /added/ as a result of this run, and the number of errors in the run.
     '''
@@ -234,22 +473,21 @@ def fetch_needed(needed, source, opts):
     counters = StatsCollector('FetchStats', [
         'contents_differ_count',
         'differing_file_index',
-        'signature_checkpoint'
     ])
     counters.contents_differ_count = 0
     counters.differing_file_index = 0
-    counters.signature_checkpoint = 0
 
-    included_dirs = set()
+    included_dirs = PrefixSet()
 
     if opts.include:
         log.debug("Includes: %s", opts.include)
         re_globmatch = re.compile(r'[*?\[\]]')
         incset = set([d for d in opts.include if not re_globmatch.search(d)])
-        incset_glob = set([d for d in opts.include if d not in incset])
+        incset_glob = GlobMatcher(d for d in opts.include
+                                  if d not in incset)
     else:
         incset = set()
-        incset_glob = set()
+        incset_glob = GlobMatcher()
 
     # These are used to debug the -I filter.
     i_fetched = []
@@ -270,74 +508,106 @@ def fetch_needed(needed, source, opts):
     # This is used to get current information into the destination
     # hashlist. That way, current information is written to the client
     # HSYNC.SIG, saving on re-scans.
-    changed = StatsCollector('ChangeStatus',
-                             ['contents', 'uidgid', 'mode', 'mtime'])
-
-    for n, fh in enumerate(needed, start=1):
-
-        if opts.include and not is_path_included(fh.fpath,
-                                                 incset, incset_glob,
-                                                 included_dirs,
-                                                 is_dir=fh.is_dir):
-            log.debug("Inclusion filter: '%s' is not included, skipping",
-                      fh.fpath)
-            i_not_fetched.append(fh)
-            continue
+    changed = _new_change_status()
 
-        changed.contents = False
-        changed.uidgid = False
-        changed.mode = False
-        changed.mtime = False
+    pool = None
+    if opts.jobs > 1:
+        pool = WorkerPool(opts.jobs, max_cost=opts.max_inflight_bytes)
 
-        if log.isEnabledFor(logging.DEBUG):
-            if fh.is_dir:
-                log.debug("fetch_needed: dir %s", fh.fpath)
+    try:
+        for n, fh in enumerate(needed, start=1):
+
+            # Pick up any finished background fetches as we go.
+            if pool is not None:
+                for result in pool.completed():
+                    error_count += _file_fetch_result(
+                        result, i_fetched, i_not_fetched, fetch_added,
+                        journal)
+
+            if opts.include and not is_path_included(fh.fpath,
+                                                     incset, incset_glob,
+                                                     included_dirs,
+                                                     is_dir=fh.is_dir):
+                log.debug("Inclusion filter: '%s' is not included, "
+                          "skipping", fh.fpath)
+                i_not_fetched.append(fh)
+                continue
+
+            changed.contents = False
+            changed.uidgid = False
+            changed.mode = False
+            changed.mtime = False
+
+            if log.isEnabledFor(logging.DEBUG):
+                if fh.is_dir:
+                    log.debug("fetch_needed: dir %s", fh.fpath)
+                else:
+                    log.debug("fetch_needed: %s", fh.fpath)
+
+            quoted_fpath = urllib.quote(fh.fpath)
+            if log.isEnabledFor(logging.DEBUG):
+                if quoted_fpath != fh.fpath:
+                    log.debug("fetch_needed: escaping '%s' -> '%s'",
+                              fh.fpath, quoted_fpath)
+            source_url = urlparse.urljoin(source, quoted_fpath)
+
+            # Contents fetches go to the pool. Anything else is quick,
+            # and done here in order. Local copies are done here too, so
+            # a later copy from a renamed file finds it in place.
+            if pool is not None and fh.is_file and \
+                    (fh.dest_missing or fh.contents_differ) and \
+                    fh.local_copy_from is None:
+                pool.submit(_file_fetch_task,
+                            (fh, source_url, counters, r, opts, chunks),
+                            cost=fh.size, tag=(fh, source_url))
+                continue
+
+            success = False
+
+            if fh.is_file:
+                try:
+                    _file_fetch(fh, source_url, changed, counters, r, opts,
+                                chunks=chunks)
+                    success = True
+
+                except FetchException as e:
+                    log.warn("Fetch file %s failed: %s", source_url, e)
+                    error_count += 1
+
+            elif fh.is_link:
+                try:
+                    _link_fetch(fh, changed, opts)
+                    success = True
+
+                except FetchException as e:
+                    log.warn("Update link %s failed: %s", fh.fpath, e)
+                    error_count += 1
+
+            elif fh.is_dir:
+                try:
+                    _dir_fetch(fh, changed, opts)
+                    success = True
+
+                except FetchException as e:
+                    log.warn("Update dir %s failed: %s", fh.fpath, e)
+                    error_count += 1
+
+            # Update the client-side HSYNC.SIG data.
+            if success:
+                i_fetched.append(fh)
+                log.debug("Updating dest hash for '%s'", fh.fpath)
+                update_dest_filehash(fh, changed, fetch_added, journal)
             else:
-                log.debug("fetch_needed: %s", fh.fpath)
-
-        quoted_fpath = urllib.quote(fh.fpath)
-        if log.isEnabledFor(logging.DEBUG):
-            if quoted_fpath != fh.fpath:
-                log.debug("fetch_needed: escaping '%s' -> '%s'",
-                          fh.fpath, quoted_fpath)
-        source_url = urlparse.urljoin(source, quoted_fpath)
-
-        success = False
+                i_not_fetched.append(fh)
 
-        if fh.is_file:
-            try:
-                _file_fetch(fh, source_url, changed, counters, r, opts)
-                success = True
-
-            except FetchException as e:
-                log.warn("Fetch file %s failed: %s", source_url, e)
-                error_count += 1
-
-        elif fh.is_link:
-            try:
-                _link_fetch(fh, changed, opts)
-                success = True
-
-            except FetchException as e:
-                log.warn("Update link %s failed: %s", fh.fpath, e)
-                error_count += 1
-
-        elif fh.is_dir:
-            try:
-                _dir_fetch(fh, changed, opts)
-                success = True
-
-            except FetchException as e:
-                log.warn("Update dir %s failed: %s", fh.fpath, e)
-                error_count += 1
-
-        # Update the client-side HSYNC.SIG data.
-        if success:
-            i_fetched.append(fh)
-            log.debug("Updating dest hash for '%s'", fh.fpath)
-            update_dest_filehash(fh, changed, fetch_added)
-        else:
-            i_not_fetched.append(fh)
+        if pool is not None:
+            for result in pool.wait():
+                error_count += _file_fetch_result(result, i_fetched,
+                                                  i_not_fetched, fetch_added,
+                                                  journal)
+    finally:
+        if pool is not None:
+            pool.close()
 
     log.debug("fetch_needed(): done")
 
@@ -355,6 +625,47 @@ def fetch_needed(needed, source, opts):
     return (fetch_added, error_count)
 
 
+def _new_change_status():
+    '''
+    Return a StatsCollector recording what we changed about an object. All
+    attributes start out as 0, i.e. False.
+    '''
+    return StatsCollector('ChangeStatus',
+                          ['contents', 'uidgid', 'mode', 'mtime'])
+
+
+def _file_fetch_task(fh, source_url, counters, random, opts, chunks=None):
+    '''
+    Run _file_fetch() in a worker thread, with its own change status.
+    '''
+    changed = _new_change_status()
+    _file_fetch(fh, source_url, changed, counters, random, opts,
+                concurrent=True, chunks=chunks)
+    return changed
+
+
+def _file_fetch_result(result, i_fetched, i_not_fetched, fetch_added,
+                       journal=None):
+    '''
+    Deal with a (tag, changed, exc_info) result from a worker, in the
+    calling thread. Returns the number of errors (0 or 1). Exceptions other
+    than FetchException are re-raised, as they would be without workers.
+    '''
+    ((fh, source_url), changed, exc_info) = result
+
+    if exc_info is not None:
+        i_not_fetched.append(fh)
+        if issubclass(exc_info[0], FetchException):
+            log.warn("Fetch file %s failed: %s", source_url, exc_info[1])
+            return 1
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    i_fetched.append(fh)
+    log.debug("Updating dest hash for '%s'", fh.fpath)
+    update_dest_filehash(fh, changed, fetch_added, journal)
+    return 0
+
+
 def _fetch_debug(fetched, not_fetched, outfile=sys.stderr):
     print("XDEBUG BEGIN fetch i_fetched", file=outfile)
     for fh in fetched:
@@ -412,12 +723,17 @@ def delete_not_needed(not_needed, target, opts):
     return True
 
 
-def update_dest_filehash(src_fh, changed, fetch_added):
-
+def update_dest_filehash(src_fh, changed, fetch_added, journal=None):
+    '''
+    Bring the destination's record of src_fh up to date, after it's been
+    fetched or had its metadata changed. If journal is given, the record is
+    added to it.
+    '''
     if src_fh.associated_dest_object is None:
         log.debug("Saved new file '%s' for inclusion in sigfile",
                   src_fh.fpath)
         fetch_added.append(src_fh)
+        dst_fh = src_fh
 
     else:
         dst_fh = src_fh.associated_dest_object
@@ -437,8 +753,15 @@ def update_dest_filehash(src_fh, changed, fetch_added):
         if changed.mtime:
             dst_fh.mtime = src_fh.mtime
 
+    if journal is not None:
+        nbytes = 0
+        if changed.contents and src_fh.is_file:
+            nbytes = src_fh.size
+        journal.add(dst_fh, nbytes)
 
-def _file_fetch(fh, source_url, changed, counters, random, opts):
+
+def _file_fetch(fh, source_url, changed, counters, random, opts,
+                concurrent=False, chunks=None):
 
     tgt_file = os.path.join(opts.dest_dir, fh.fpath)
     tgt_file_rnd = tgt_file + ".%08x" % random.randint(0, 0xffffffff)
@@ -446,114 +769,67 @@ def _file_fetch(fh, source_url, changed, counters, random, opts):
     if fh.dest_missing or fh.contents_differ:
 
         contents_differ = getattr(fh, 'contents_differ', False)
-        counters.differing_file_index += 1
+        file_index = counters.incr('differing_file_index')
 
-        opts.stats.file_contents_differed += 1
+        opts.stats.incr('file_contents_differed')
 
         log.debug("Fetching: '%s' dest_missing %s contents_differ %s",
                   fh.fpath, fh.dest_missing, contents_differ)
 
-        if not opts.quiet and sys.stdout.isatty():
+        if not opts.quiet and not concurrent and sys.stdout.isatty():
             print("F: %s\r" % fh.fpath, end='')
 
-        # Fetch_contents will display progress information itself.
-        contents = fetch_contents(
-            source_url, opts,
-            for_filehash=fh,
-            file_count_number=counters.differing_file_index,
-            file_count_total=counters.contents_differ_count)
-
-        if contents is None:
-            if opts.fail_on_errors:
-                raise ContentsFetchFailedError(
-                    "Failed to fetch '%s'" % source_url)
-            else:
-                log.debug("Failed to fetch '%s'",
-                          fh.fpath)
-                raise FetchContentsFailedException(
-                    "Failed to fetch %s" % source_url)
-
-        else:
-
-            changed.contents = True  # If we fetched it, we changed it.
+        if os.path.exists(tgt_file):
+            if os.path.islink(tgt_file):
+                raise ParanoiaError(
+                    "Not overwriting existing symlink '%s' with "
+                    "file" % tgt_file)
+            if os.path.isdir(tgt_file):
+                raise DirWhereFileExpectedError(
+                    "Directory found where file expected at '%s'" %
+                    tgt_file)
+
+        if fh.local_copy_from is None or \
+                not _local_copy(fh, tgt_file, tgt_file_rnd, opts):
+            file_chunks = None
+            if chunks is not None and fh.digest is not None:
+                file_chunks = chunks.get(fh.digest)
+            _remote_fetch(fh, source_url, tgt_file, counters, file_index,
+                          opts, concurrent, chunks=file_chunks)
+
+        changed.contents = True  # If we fetched it, we changed it.
 
-            chk = hashlib.sha256()
-            log.debug("Hashing contents")
-
-            if opts.progress:
-                print(' checking...', end='')
+        expect_uid = fh.uid
+        expect_gid = fh.gid
 
-            chk.update(contents)
-            log.debug("Contents hash done (%s)", chk.hexdigest())
+        filestat = os.stat(tgt_file)
+        log.debug("'%s' uid %s gid %s mode %06o", tgt_file,
+                  filestat.st_uid, filestat.st_gid, filestat.st_mode)
 
-            if opts.progress:
-                print('done')
+        if filestat.st_uid != expect_uid or \
+                filestat.st_gid != expect_gid:
+            changed.uidgid = True
+            log.debug("Changing file %s ownership to %s/%s",
+                      tgt_file, fh.user, fh.group)
+            if os.chown(tgt_file, expect_uid, expect_gid) == -1:
+                log.warn("Failed to chown '%s' to user %s "
+                         "group %s",
+                         tgt_file, fh.user, fh.group)
 
-            if chk.hexdigest() != fh.hashstr:
-                log.warn("File '%s' failed checksum verification!",
-                         fh.fpath)
-                raise FetchFailedChecksumException(
-                    "File %s failed checksum verification" % fh.fpath)
-
-            log.debug("Will write to '%s'", tgt_file_rnd)
-            if os.path.exists(tgt_file):
-                if os.path.islink(tgt_file):
-                    raise ParanoiaError(
-                        "Not overwriting existing symlink '%s' with "
-                        "file" % tgt_file)
-                if os.path.isdir(tgt_file):
-                    raise DirWhereFileExpectedError(
-                        "Directory found where file expected at '%s'" %
-                        tgt_file)
-
-            # Dealing with file descriptors, use os.f*() variants.
-            tgt = os.open(tgt_file_rnd,
-                          os.O_CREAT | os.O_EXCL | os.O_WRONLY,
-                          fh.mode)
-            if tgt == -1:
-                raise OSOperationFailedError("Failed to open '%s'" %
-                                             tgt_file_rnd)
-
-            os.write(tgt, contents)
-            os.close(tgt)
-            log.debug("Moving into place: '%s' -> '%s'",
-                      tgt_file_rnd, tgt_file)
-            if os.rename(tgt_file_rnd, tgt_file) == -1:
-                raise OSOperationFailedError(
-                    "Failed to rename '%s' to '%s'" %
-                    (tgt_file_rnd, tgt_file))
-
-            expect_uid = fh.uid
-            expect_gid = fh.gid
+        # Don't rely on os.rename() preserving the mode.
+        if filestat.st_mode != fh.mode:
+            log.debug("'%s': Setting mode: %06o", fh.fpath, fh.mode)
+            if os.chmod(tgt_file, fh.mode) == -1:
+                log.warn("Failed to chmod '%s' to %06o",
+                         fh.fpath, fh.mode)
 
-            filestat = os.stat(tgt_file)
-            log.debug("'%s' uid %s gid %s mode %06o", tgt_file,
-                      filestat.st_uid, filestat.st_gid, filestat.st_mode)
-
-            if filestat.st_uid != expect_uid or \
-                    filestat.st_gid != expect_gid:
-                changed.uidgid = True
-                log.debug("Changing file %s ownership to %s/%s",
-                          tgt_file, fh.user, fh.group)
-                if os.chown(tgt_file, expect_uid, expect_gid) == -1:
-                    log.warn("Failed to chown '%s' to user %s "
-                             "group %s",
-                             tgt_file, fh.user, fh.group)
-
-            # Don't rely on os.rename() preserving the mode.
-            if filestat.st_mode != fh.mode:
-                log.debug("'%s': Setting mode: %06o", fh.fpath, fh.mode)
-                if os.chmod(tgt_file, fh.mode) == -1:
-                    log.warn("Failed to chmod '%s' to %06o",
-                             fh.fpath, fh.mode)
-
-            changed.mode = False  # We didn't change it, we created it.
+        changed.mode = False  # We didn't change it, we created it.
 
-            changed.mtime = True
-            os.utime(tgt_file, (fh.mtime, fh.mtime))
+        changed.mtime = True
+        os.utime(tgt_file, (fh.mtime, fh.mtime))
 
-            if changed.uidgid or changed.mtime or changed.mode:
-                opts.stats.file_metadata_differed += 1
+        if changed.uidgid or changed.mtime or changed.mode:
+            opts.stats.incr('file_metadata_differed')
 
     elif fh.metadata_differs:
 
@@ -598,7 +874,7 @@ def _file_fetch(fh, source_url, changed, counters, random, opts):
                       (filestat.st_mtime, fh.mtime), end='')
             os.utime(tgt_file, (fh.mtime, fh.mtime))
 
-        opts.stats.file_metadata_differed += 1
+        opts.stats.incr('file_metadata_differed')
 
         if not opts.quiet:
             print('')
@@ -613,7 +889,331 @@ def _file_fetch(fh, source_url, changed, counters, random, opts):
                                               filestat.st_mtime, fh.mtime))
 
         os.utime(tgt_file, (fh.mtime, fh.mtime))
-        opts.stats.file_metadata_differed += 1
+        opts.stats.incr('file_metadata_differed')
+
+
+def _remote_fetch(fh, source_url, tgt_file, counters, file_index, opts,
+                  concurrent, chunks=None):
+    '''
+    Fetch a file's contents, check them and move them into place at
+    tgt_file.
+
+    The contents are written to a partial file first (see partial_path()).
+    If the fetch is interrupted the partial file is kept, and the next
+    fetch of the same contents carries on from the end of it.
+
+    If chunks is given, as (chunk_size, chunk digests), the chunks of the
+    file already at tgt_file that match are used, and only the rest are
+    fetched.
+    '''
+    tgt_file_part = os.path.join(opts.dest_dir,
+                                 partial_path(fh.fpath, fh.hashstr))
+
+    # The contents are hashed as they arrive, so verification doesn't
+    # need another pass over the data. The hash of a partial file is
+    # picked up where it left off.
+    chk = hash_engine.new()
+    offset = _resume_offset(tgt_file_part, fh, chk)
+
+    if offset:
+        log.debug("Resuming '%s' at byte %d", fh.fpath, offset)
+        opts.stats.incr('file_fetches_resumed')
+        flags = os.O_WRONLY | os.O_APPEND
+    else:
+        log.debug("Will write to '%s'", tgt_file_part)
+        flags = os.O_CREAT | os.O_TRUNC | os.O_WRONLY
+
+    # Dealing with file descriptors, use os.f*() variants. The partial file
+    # must stay writable, so the mode is set once it's in place.
+    tgt = os.open(tgt_file_part, flags, 0600)
+    if tgt == -1:
+        raise OSOperationFailedError("Failed to open '%s'" %
+                                     tgt_file_part)
+
+    # Fetch_contents will display progress information itself. The
+    # contents go straight to the partial file, not to memory. If anything
+    # goes wrong, what we've got so far is kept, unless the source can't
+    # resume from there or we didn't get anything at all.
+    try:
+        with os.fdopen(tgt, 'ab') as tgtf:
+            delta_chk = None
+            if chunks is not None and not offset and \
+                    os.path.isfile(tgt_file):
+                delta_chk = _delta_fetch(fh, chunks, source_url, tgt_file,
+                                         tgtf, opts, concurrent)
+            if delta_chk is not None:
+                chk = delta_chk
+                bytes_fetched = fh.size
+            else:
+                bytes_fetched = fetch_contents(
+                    source_url, opts,
+                    for_filehash=fh,
+                    file_count_number=file_index,
+                    file_count_total=counters.contents_differ_count,
+                    outfile=tgtf, hasher=chk, concurrent=concurrent,
+                    offset=offset)
+    except FetchRangeException:
+        _unlink_quietly(tgt_file_part)
+        raise
+    except Exception:
+        _unlink_if_empty(tgt_file_part)
+        raise
+
+    if bytes_fetched is None:
+        _unlink_if_empty(tgt_file_part)
+        if opts.fail_on_errors:
+            raise ContentsFetchFailedError(
+                "Failed to fetch '%s'" % source_url)
+        else:
+            log.debug("Failed to fetch '%s'",
+                      fh.fpath)
+            raise FetchContentsFailedException(
+                "Failed to fetch %s" % source_url)
+
+    log.debug("Contents hash (%s)", chk.hexdigest())
+
+    if opts.progress and not concurrent:
+        print('')
+
+    if chk.hexdigest() != fh.hashstr:
+        log.warn("File '%s' failed checksum verification!",
+                 fh.fpath)
+        _unlink_quietly(tgt_file_part)
+        raise FetchFailedChecksumException(
+            "File %s failed checksum verification" % fh.fpath)
+
+    log.debug("Moving into place: '%s' -> '%s'",
+              tgt_file_part, tgt_file)
+    if os.rename(tgt_file_part, tgt_file) == -1:
+        raise OSOperationFailedError(
+            "Failed to rename '%s' to '%s'" %
+            (tgt_file_part, tgt_file))
+
+
+def _delta_fetch(fh, chunks, source_url, tgt_file, tgtf, opts, concurrent):
+    '''
+    Write fh's contents to tgtf, an empty partial file, taking the chunks
+    that match from the old file at tgt_file and fetching the others with
+    Range requests. Runs of chunks that differ are fetched together.
+
+    Returns a hash object that has seen the contents. If anything goes
+    wrong, tgtf is emptied again and None is returned, so the file can be
+    fetched whole.
+    '''
+    (chunk_size, digests) = chunks
+    try:
+        have = hash_engine.hash_path(tgt_file, chunk_size=chunk_size).chunks
+    except IOError as e:
+        log.debug("Can't read '%s' for a delta fetch: %s", tgt_file, e)
+        return None
+
+    nchunks = len(digests)
+    same = [n < len(have) and have[n] == digests[n] for n in xrange(nchunks)]
+    if not any(same):
+        log.debug("'%s': No chunks in common, fetching it whole", fh.fpath)
+        return None
+
+    chk = hash_engine.new()
+    reused = 0
+    fetched_chunks = 0
+    try:
+        with open(tgt_file, 'rb') as basis:
+            n = 0
+            while n < nchunks:
+                start = n * chunk_size
+                if same[n]:
+                    basis.seek(start)
+                    data = basis.read(min(chunk_size, fh.size - start))
+                    chk.update(data)
+                    tgtf.write(data)
+                    reused += len(data)
+                    n += 1
+                    continue
+
+                end = n
+                while end < nchunks and not same[end]:
+                    end += 1
+                for block in fetch_range(source_url, start,
+                                         min(end * chunk_size, fh.size),
+                                         opts):
+                    chk.update(block)
+                    tgtf.write(block)
+                fetched_chunks += end - n
+                n = end
+
+    except (IOError, FetchException) as e:
+        log.warn("Delta fetch of '%s' failed, fetching it whole: %s",
+                 fh.fpath, e)
+        tgtf.seek(0)
+        tgtf.truncate()
+        return None
+
+    opts.stats.incr('file_delta_fetches')
+    opts.stats.incr('delta_bytes_reused', reused)
+    if not opts.quiet:
+        with _output_lock:
+            print("F: %s (fetched %d of %d chunks)" %
+                  (fh.fpath, fetched_chunks, nchunks))
+    return chk
+
+
+def fetch_range(fpath, start, end, opts):
+    '''
+    Fetch bytes start to end-1 of the object at URL fpath, and return a
+    generator of the blocks as they arrive. If the source ignores the Range
+    header, the bytes before start are read and dropped.
+
+    Raise FetchRangeException if the source can't give us the range, and
+    FetchSizeMismatchException if it ends early.
+    '''
+    log.debug("fetch_range: %s %d-%d", fpath, start, end)
+    opts.stats.incr('content_fetches')
+    request = urllib2.Request(fpath,
+                              headers={'Range': 'bytes=%d-%d' %
+                                       (start, end - 1)})
+    try:
+        url = urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        e.close()
+        raise FetchRangeException("'%s': Can't fetch bytes %d-%d: %s" %
+                                  (fpath, start, end - 1, e))
+    except urllib2.URLError as e:
+        raise FetchRangeException("'%s': Can't fetch bytes %d-%d: %s" %
+                                  (fpath, start, end - 1, e))
+
+    skip = _seek_response(url, start)
+    if skip is None:
+        url.close()
+        raise FetchRangeException(
+            "'%s': Unexpected Content-Range '%s'" %
+            (fpath, url.info().getheader('content-range')))
+
+    block_size = int(opts.fetch_blocksize)
+
+    def blocks():
+        to_skip = skip
+        left = end - start
+        try:
+            while left:
+                new_bytes = url.read(min(block_size, to_skip + left))
+                if not new_bytes:
+                    raise FetchSizeMismatchException(
+                        "'%s': Range ended %d bytes early" % (fpath, left))
+                opts.stats.incr('bytes_transferred', len(new_bytes))
+                if to_skip:
+                    dropped = min(to_skip, len(new_bytes))
+                    to_skip -= dropped
+                    new_bytes = new_bytes[dropped:]
+                new_bytes = new_bytes[:left]
+                left -= len(new_bytes)
+                if new_bytes:
+                    yield new_bytes
+        finally:
+            url.close()
+
+    return blocks()
+
+
+def _resume_offset(tgt_file_part, fh, hasher):
+    '''
+    If there's a partial download for fh at tgt_file_part, feed its
+    contents to hasher and return its size. A partial file that's no use is
+    removed, and 0 is returned.
+    '''
+    try:
+        partial_size = os.path.getsize(tgt_file_part)
+    except OSError:
+        return 0
+
+    if partial_size == 0 or partial_size >= fh.size:
+        log.debug("Discarding partial file '%s' (%d bytes)",
+                  tgt_file_part, partial_size)
+        _unlink_quietly(tgt_file_part)
+        return 0
+
+    offset = 0
+    with open(tgt_file_part, 'rb') as f:
+        for block in iter(lambda: f.read(LOCAL_COPY_BLOCK), ''):
+            hasher.update(block)
+            offset += len(block)
+    return offset
+
+
+def _local_copy(fh, tgt_file, tgt_file_rnd, opts):
+    '''
+    Put a file in place at tgt_file by renaming or copying
+    fh.local_copy_from, which is already on the destination. Copies are
+    checked as they're made.
+
+    Returns True on success, False if the file should be fetched after all.
+    '''
+    src_file = os.path.join(opts.dest_dir, fh.local_copy_from)
+
+    try:
+        if fh.local_copy_rename:
+            log.debug("Renaming '%s' -> '%s'", src_file, tgt_file)
+            os.rename(src_file, tgt_file)
+            opts.stats.incr('file_local_renames')
+            verb = 'moved'
+
+        else:
+            log.debug("Copying '%s' -> '%s'", src_file, tgt_file_rnd)
+            chk = hash_engine.new()
+            with open(src_file, 'rb') as srcf:
+                tgt = os.open(tgt_file_rnd,
+                              os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                              fh.mode)
+                with os.fdopen(tgt, 'wb') as tgtf:
+                    for block in iter(lambda: srcf.read(LOCAL_COPY_BLOCK),
+                                      ''):
+                        chk.update(block)
+                        tgtf.write(block)
+
+            if chk.hexdigest() != fh.hashstr:
+                log.warn("Local copy of '%s' from '%s' failed checksum "
+                         "verification, fetching it instead",
+                         fh.fpath, fh.local_copy_from)
+                _unlink_quietly(tgt_file_rnd)
+                return False
+
+            os.rename(tgt_file_rnd, tgt_file)
+            opts.stats.incr('file_local_copies')
+            verb = 'copied'
+
+    except (IOError, OSError) as e:
+        log.warn("Local copy of '%s' from '%s' failed, fetching it "
+                 "instead: %s", fh.fpath, fh.local_copy_from, e)
+        _unlink_quietly(tgt_file_rnd)
+        return False
+
+    if not opts.quiet:
+        with _output_lock:
+            print("F: %s (%s from %s)" % (fh.fpath, verb, fh.local_copy_from))
+
+    return True
+
+
+def _unlink_quietly(fpath):
+    '''
+    Remove a temporary file, ignoring errors. Used to clean up after a failed
+    fetch.
+    '''
+    try:
+        os.unlink(fpath)
+    except OSError as e:
+        log.debug("Failed to remove '%s': %s", fpath, e)
+
+
+def _unlink_if_empty(fpath):
+    '''
+    Remove a partial file that a failed fetch left empty. There's nothing
+    in it to resume from.
+    '''
+    try:
+        if os.path.getsize(fpath) == 0:
+            _unlink_quietly(fpath)
+    except OSError as e:
+        log.debug("Failed to check '%s': %s", fpath, e)
 
 
 def _link_fetch(fh, changed, opts):
@@ -31,6 +31,7 @@ import os.path
 import re
 from stat import *
 
+from hashengine import engine as hash_engine
 from idmapper import *
 from exceptions import *
 
@@ -79,7 +80,35 @@ dirignore = [
 ]
 
 
+# The raw form of FileHash.blankhash. Directories and symlinks all share it.
+_blank_digest = '\0' * 32
+
+_missing = object()
+
+
 class FileHash(object):
+    '''
+    One filesystem object, as scanned from disk or read from a signature
+    file.
+
+    There can be millions of these in memory at once, so the class uses
+    __slots__ rather than a per-instance __dict__, keeps the content hash
+    as a raw digest where it can, and shares user and group name strings.
+    '''
+
+    __slots__ = (
+        'hash_safe', 'associated_dest_object', 'size_is_known',
+        'is_local_file', 'fullpath', 'fpath', 'defer_read',
+        'has_read_contents',
+        'mode', 'uid', 'user', 'gid', 'group', 'size', 'mtime',
+        'copy_by_creation', 'copy_by_copying', 'size_comparison_valid',
+        'is_file', 'is_dir', 'is_link', 'ignore', 'dest_missing',
+        'has_real_hash', '_hash', '_hash_is_raw',
+        'link_target', 'link_normalised', 'link_relpath', 'link_is_external',
+        'strhash_value', 'hash_value',
+        'contents_differ', 'metadata_differs', 'mtime_differs',
+        'local_copy_from', 'local_copy_rename',
+    )
 
     blankhash = "0" * 64
     notsethash = "F" * 64
@@ -91,9 +120,66 @@ class FileHash(object):
         self.hash_safe = False
         self.associated_dest_object = None
         self.size_is_known = False
+        self.local_copy_from = None
+
+    def __getstate__(self):
+        # Slotted objects have no __dict__ for pickle to use. Unset slots
+        # are left out, so they stay unset when unpickled.
+        return dict((k, v) for (k, v) in
+                    ((k, getattr(self, k, _missing)) for k in self.__slots__)
+                    if v is not _missing)
+
+    def __setstate__(self, state):
+        for (k, v) in state.iteritems():
+            setattr(self, k, v)
+
+    def _get_hashstr(self):
+        if self._hash_is_raw:
+            return self._hash.encode('hex')
+        return self._hash
+
+    def _set_hashstr(self, value):
+        '''
+        Store canonical (lowercase, even-length) hex strings as raw bytes,
+        and anything else (e.g. notsethash) as-is.
+        '''
+        if value == self.blankhash:
+            self._hash = _blank_digest
+            self._hash_is_raw = True
+            return
+        try:
+            raw = value.decode('hex')
+        except TypeError:
+            raw = None
+        if raw and raw.encode('hex') == value:
+            self._hash = raw
+            self._hash_is_raw = True
+        else:
+            self._hash = value
+            self._hash_is_raw = False
+
+    hashstr = property(_get_hashstr, _set_hashstr)
+
+    def _get_digest(self):
+        if self._hash_is_raw:
+            return self._hash
+        return None
+
+    def _set_digest(self, value):
+        self._hash = value
+        self._hash_is_raw = True
+
+    # The raw content digest, or None if we don't have one.
+    digest = property(_get_digest, _set_digest)
 
     @classmethod
-    def init_from_file(cls, fpath, trim=False, root='', defer_read=False):
+    def init_from_file(cls, fpath, trim=False, root='', defer_read=False,
+                       stat_result=None):
+        '''
+        Create a FileHash for a local filesystem object. If the caller has
+        already done an os.lstat() of fpath, pass the result in stat_result
+        to save doing it again.
+        '''
 
         self = cls()
         self.is_local_file = True
@@ -116,15 +202,18 @@ class FileHash(object):
             self.fpath = self.fullpath[len(root):]
         else:
             self.fpath = self.fullpath
-        self.stat = os.lstat(self.fullpath)
-        mode = self.mode = self.stat.st_mode
-        self.uid = self.stat.st_uid
-        self.user = self.mapper.get_name_for_uid(self.uid)
-        self.gid = self.stat.st_gid
-        self.group = self.mapper.get_group_for_gid(self.gid)
-        self.size = self.stat.st_size
+        if stat_result is not None:
+            st = stat_result
+        else:
+            st = os.lstat(self.fullpath)
+        mode = self.mode = st.st_mode
+        self.uid = st.st_uid
+        self.user = intern(self.mapper.get_name_for_uid(self.uid))
+        self.gid = st.st_gid
+        self.group = intern(self.mapper.get_group_for_gid(self.gid))
+        self.size = st.st_size
         self.size_is_known = True
-        self.mtime = int(self.stat.st_mtime)
+        self.mtime = int(st.st_mtime)
 
         # Safe defaults.
         self.copy_by_creation = False
@@ -139,7 +228,7 @@ class FileHash(object):
             self.is_dir = True
             # It makes no sense to 'copy' remote filesystem metadata.
             self.copy_by_creation = True
-            self.hashstr = self.blankhash[:]
+            self.hashstr = self.blankhash
 
         elif S_ISLNK(mode):
             self.is_link = True
@@ -154,7 +243,7 @@ class FileHash(object):
             # length path, so the target will be a different length.
             self.has_real_hash = False
             # For the same reason, the hash is meaningless.
-            self.hashstr = self.blankhash[:]
+            self.hashstr = self.blankhash
             self.link_normalised = False
 
             if root:
@@ -174,7 +263,7 @@ class FileHash(object):
         else:
             self.is_dir = False
             self.is_file = False
-            self.hashstr = self.blankhash[:]
+            self.hashstr = self.blankhash
             raise UnsupportedFileTypeException(
                 "%s: File type '%s' is unsupported" %
                 (self.fullpath, self._type_to_string(mode)))
@@ -186,22 +275,59 @@ class FileHash(object):
     @classmethod
     def init_from_string(cls, string, trim=False, root=''):
 
-        self = cls()
-        self.is_local_file = False
-
         if log.isEnabledFor(logging.DEBUG):
             log.debug("init_from_string: %s", string)
 
         (md, smode, user, group, mtime, size, fpath) = string.split(None, 6)
-        self.hashstr = md
-        mode = self.mode = int(smode, 8)
-        self.user = user
-        self.uid = self.mapper.get_uid_for_name(user)
-        self.group = group
-        self.gid = self.mapper.get_gid_for_group(group)
+        mode = int(smode, 8)
+
+        link_target = None
+        if S_ISLNK(mode):
+            if '>>>' not in fpath:
+                raise BadSymlinkFormatError(
+                    "%s: Expected '>>>' in symlink hash" % fpath)
+            (link, target) = fpath.split('>>>', 1)
+            if not link or not target:
+                raise BadSymlinkFormatError(
+                    "%s: Bogus symlink hash" % fpath)
+            fpath = link
+            link_target = target.lstrip()  # Optional whitespace after '>>>'.
+
         # Robustness principle - old versions have float mtime.
-        self.mtime = int(float(mtime))
-        self.size = int(size)  # XXX int length?
+        return cls.init_from_fields(md, mode, user, group, int(float(mtime)),
+                                    int(size), fpath, link_target,
+                                    trim=trim, root=root)
+
+    @classmethod
+    def init_from_fields(cls, md, mode, user, group, mtime, size, fpath,
+                         link_target=None, trim=False, root='',
+                         uid=None, gid=None, digest=None):
+        '''
+        Create a FileHash for a remote object from the already-parsed fields
+        of a signature entry. md is the hex hash string; if the raw digest is
+        to hand, pass it as digest instead, with md None. If the caller
+        already knows the uid and gid for user and group, they can be
+        passed in too.
+        '''
+
+        self = cls()
+        self.is_local_file = False
+
+        if digest is not None:
+            self.digest = digest
+        else:
+            self.hashstr = md
+        self.mode = mode
+        self.user = intern(user)
+        if uid is None:
+            uid = self.mapper.get_uid_for_name(user)
+        self.uid = uid
+        self.group = intern(group)
+        if gid is None:
+            gid = self.mapper.get_gid_for_group(group)
+        self.gid = gid
+        self.mtime = mtime
+        self.size = size
         self.size_is_known = True
 
         self.fpath = fpath
@@ -228,23 +354,13 @@ class FileHash(object):
 
         elif S_ISLNK(mode):
             self.is_link = True
-            self.has_real_hash = True
-            if '>>>' not in fpath:
-                raise BadSymlinkFormatError(
-                    "%s: Expected '>>>' in symlink hash" % fpath)
-            (link, target) = fpath.split('>>>', 1)
-            if not link or not target:
-                raise BadSymlinkFormatError(
-                    "%s: Bogus symlink hash" % fpath)
-            target = target.lstrip()  # Optional whitespace right of '>>>'.
-            self.fpath = link
-            self.link_target = target
+            self.link_target = link_target
             # Size comparisons are not valid because we are likely to be
             # copied into a different-length path, implying that the link
             # target has different length.
             self.has_real_hash = False
             # For the same reason, the hash is meaningless.
-            self.hashstr = self.blankhash[:]
+            self.hashstr = self.blankhash
             # For the same reason again, we just create links.
             self.copy_by_creation = True
             if root:
@@ -259,7 +375,7 @@ class FileHash(object):
         else:
             self.is_dir = False
             self.is_file = False
-            self.hashstr = self.blankhash[:]
+            self.hashstr = self.blankhash
             raise UnsupportedFileTypeException(
                 "%s: File type '%s' is unsupported" %
                 (self.fullpath, self._type_to_string(mode)))
@@ -303,7 +419,8 @@ class FileHash(object):
 
         '''
         log.debug("inherit_attributes('%s'): grabbing hash", self.fpath)
-        self.hashstr = other.hashstr
+        self._hash = other._hash
+        self._hash_is_raw = other._hash_is_raw
         self.has_read_contents = True
 
     def _type_to_string(self, mode):
@@ -327,7 +444,7 @@ class FileHash(object):
         Provide a stable hash for this object.
         '''
         assert self.hash_safe, "Hash available"
-        md = hashlib.sha256()
+        md = hash_engine.new()
         md.update(self.fpath)
         md.update(str(self.mode))
         md.update(self.user)
@@ -336,20 +453,16 @@ class FileHash(object):
         return md.hexdigest()
 
     def hash_file(self):
+        '''
+        Read and hash the file's contents, and return the HashResult.
+        '''
         log.debug("File: %s", self.fullpath)
-        block_size = 10 * 1000 * 1000
-        f = open(self.fullpath, 'rb')
-        md = hashlib.sha256()
-
-        while True:
-            data = f.read(block_size)
-            if not data:
-                break
-            md.update(data)
-
-        log.debug("Hash for %s: %s", self.fpath, md.hexdigest())
-        self.contents_hash = md.digest()
-        self.hashstr = md.hexdigest()
+        result = hash_engine.hash_path(self.fullpath)
+        log.debug("Hash for %s: %s (%d bytes in %.3fs)", self.fpath,
+                  result.digest.encode('hex'), result.nbytes, result.seconds)
+        self._hash = result.digest
+        self._hash_is_raw = True
+        return result
 
     def presentation_format(self):
         fpath = self.fpath
@@ -377,7 +490,8 @@ class FileHash(object):
                 "%s (rhs) isn't comparable" % other.fpath)
 
         log.debug("compare_contents: %s, %s", self, other)
-        return self.hashstr == other.hashstr
+        return self._hash == other._hash and \
+            self._hash_is_raw == other._hash_is_raw
 
     def compare(self, other,
                 ignore_name=False,
@@ -439,9 +553,8 @@ class FileHash(object):
         if not mtime_skip:
             # If we're a local file, we may be able to save some time.
             if self.is_local_file:
-                if self.defer_read and not self.has_contents():
-                    self.hash_file()
-                    self.has_read_contents = True
+                if self.defer_read and not self.has_read_contents:
+                    self.read_file_contents()
 
             if self.can_compare(other):
                 if not self.compare_contents(other):
@@ -0,0 +1,185 @@
+# Filesystem walker that caches stat results.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import os
+from stat import S_ISDIR, S_ISLNK
+
+log = logging.getLogger()
+
+
+def walk(top, stats=None, listing=None, dir_hook=None, recurse=True,
+         _top_stat=None):
+    '''
+    Top-down directory walk, like os.walk(top) but with one lstat() per
+    object.
+
+    Yields (root, dirs, files, stat_cache) tuples. As with os.walk(), the
+    caller may prune dirs in place to stop the walk descending into them.
+    stat_cache maps each name in dirs and files to its lstat() result, so
+    the caller doesn't need to stat the objects again.
+
+    os.walk() stats every entry to split dirs from files, and lstats every
+    directory again before descending into it; the caller then does an
+    lstat() of its own for each object. Here, symlinks are the only objects
+    that get a second call, a stat() to see if they point to a directory.
+    Symlinks to directories are listed in dirs, as os.walk() does, but
+    not followed.
+
+    If stats is given (a StatsCollector with stat_calls and
+    stat_calls_saved attributes), it counts the calls made here, and the
+    calls saved relative to os.walk().
+
+    If listing is given, it can save listing directories that haven't
+    changed (see dirstate.IncrementalListing). listing.get(path, st)
+    returns (dirs, files, stat_files) for an unchanged directory, or None.
+    The dirs are always lstat()'d, the files only if stat_files is True;
+    otherwise they're left out of stat_cache. Directories that are listed
+    are passed to listing.put(path, st, dirs).
+
+    If dir_hook is given, it's called with the path of each directory just
+    before it's listed. If recurse is False, only top is listed.
+    '''
+
+    if dir_hook is not None:
+        dir_hook(top)
+
+    cached = None
+    st_top = _top_stat
+    if listing is not None:
+        if st_top is None:
+            try:
+                st_top = os.lstat(top)
+            except OSError as e:
+                log.debug("walk: can't stat '%s': %s", top, e)
+                return
+            if stats is not None:
+                stats.incr('stat_calls')
+        cached = listing.get(top, st_top)
+
+    if cached is not None:
+        (dirs, files, stat_files) = cached
+        (dirs, files, stat_cache, calls) = _stat_cached(top, dirs, files,
+                                                        stat_files)
+        # os.walk() would have listed the directory and classified all
+        # of it.
+        walk_calls = len(dirs) + len(files)
+
+    else:
+        try:
+            names = os.listdir(top)
+        except OSError as e:
+            # os.walk() ignores these too.
+            log.debug("walk: can't list '%s': %s", top, e)
+            return
+
+        (dirs, files, stat_cache, calls) = _stat_names(top, names)
+        walk_calls = len(stat_cache)
+        if listing is not None:
+            listing.put(top, st_top, dirs)
+
+    if stats is not None:
+        stats.incr('stat_calls', calls)
+        stats.incr('stat_calls_saved', walk_calls - calls)
+
+    yield top, dirs, files, stat_cache
+
+    if not recurse:
+        return
+
+    for name in dirs:
+        st = stat_cache[name]
+        if S_ISLNK(st.st_mode):
+            continue
+        # os.walk() would have checked for a symlink again here.
+        if stats is not None:
+            stats.incr('stat_calls_saved')
+        for x in walk(os.path.join(top, name), stats, listing, dir_hook,
+                      _top_stat=st):
+            yield x
+
+
+def _stat_names(top, names):
+    '''
+    lstat() the names in top, and split them into dirs and files.
+    '''
+    dirs = []
+    files = []
+    stat_cache = {}
+    calls = 0
+
+    for name in names:
+        fpath = os.path.join(top, name)
+        try:
+            st = os.lstat(fpath)
+        except OSError as e:
+            log.debug("walk: '%s' vanished: %s", fpath, e)
+            continue
+        calls += 1
+        stat_cache[name] = st
+
+        is_dir = S_ISDIR(st.st_mode)
+        if S_ISLNK(st.st_mode):
+            calls += 1
+            try:
+                is_dir = S_ISDIR(os.stat(fpath).st_mode)
+            except OSError:
+                # Broken symlink.
+                is_dir = False
+
+        if is_dir:
+            dirs.append(name)
+        else:
+            files.append(name)
+
+    return (dirs, files, stat_cache, calls)
+
+
+def _stat_cached(top, dirs, files, stat_files):
+    '''
+    lstat() the names from a cached listing of top, which are already split
+    into dirs and files. Names that have gone are dropped.
+    '''
+    stat_cache = {}
+
+    def present(names):
+        for name in names:
+            fpath = os.path.join(top, name)
+            try:
+                stat_cache[name] = os.lstat(fpath)
+            except OSError as e:
+                log.debug("walk: '%s' vanished: %s", fpath, e)
+                continue
+            yield name
+
+    dirs = list(present(dirs))
+    if stat_files:
+        files = list(present(files))
+    else:
+        files = list(files)
+
+    return (dirs, files, stat_cache, len(stat_cache))
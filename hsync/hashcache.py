@@ -0,0 +1,187 @@
+# Content digest cache for destination files.
+
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''
+The hash cache maps a file's identity (device, inode, size, mtime and
+ctime) to the digest of its contents. Nearly anything that could change the
+contents changes the ctime, so while all five match the digest can be
+trusted without reading the file. That holds even if the signature file has
+been lost, or the file has been renamed.
+
+It's kept in an sqlite database next to the signature, HSYNC.SIG.cache.
+Each scan writes a fresh table of what it saw, which replaces the old one
+when the scan finishes, so files that have gone drop out.
+
+Python 2 has no st_mtime_ns, so the float times from stat are used as
+they are. sqlite stores them exactly.
+
+The digests are only good for the algorithm they were made with, which is
+recorded too. If it's changed, the old cache is ignored.
+'''
+
+import logging
+import os
+import sqlite3
+import time
+
+from dirstate import RACY_SECONDS
+from hashengine import DEFAULT_DIGEST
+
+log = logging.getLogger()
+
+CACHE_SUFFIX = '.cache'
+
+# Bump this if the tables change.
+CACHE_VERSION = 2
+
+# Rows are buffered and written with executemany() in batches this size.
+INSERT_BATCH = 1000
+
+_SCHEMA = ('dev integer, ino integer, size integer, mtime real, '
+           'ctime real, digest blob, primary key (dev, ino)')
+
+
+def _signed(n):
+    # sqlite integers are signed 64-bit.
+    if n >= 1 << 63:
+        return n - (1 << 64)
+    return n
+
+
+class HashCache(object):
+    '''
+    A persistent digest cache, keyed on file identity. Lookups are in the
+    cache as it was when it was opened; add() builds the new one, and
+    close() replaces the old one with it.
+    '''
+
+    def __init__(self, path, digest_name=DEFAULT_DIGEST, now=None):
+        self.path = path
+        self.digest_name = digest_name
+        if now is None:
+            now = time.time()
+        self.now = now
+        self.hits = 0
+        self.misses = 0
+        self.pending = []
+        self.dbconn = None
+        try:
+            self._open()
+        except sqlite3.DatabaseError as e:
+            log.warn("Hash cache '%s' is unusable, starting again: %s",
+                     path, e)
+            self._discard()
+            self._open()
+
+    def _open(self):
+        self.dbconn = sqlite3.connect(self.path)
+        # The cache is only an optimisation, and a rollback journal file
+        # would show up in the scan.
+        self.dbconn.execute('pragma journal_mode=memory')
+        if self.dbconn.execute('pragma user_version').fetchone()[0] != \
+                CACHE_VERSION:
+            self.dbconn.execute('drop table if exists cache')
+            self.dbconn.execute('drop table if exists info')
+            self.dbconn.execute('pragma user_version=%d' % CACHE_VERSION)
+        self.dbconn.execute('create table if not exists cache (%s)' %
+                            _SCHEMA)
+        self.dbconn.execute('create table if not exists info (digest text)')
+        row = self.dbconn.execute('select digest from info').fetchone()
+        if row is None or row[0] != self.digest_name:
+            log.debug("Hash cache '%s' digest algorithm changed, ignoring "
+                      "it", self.path)
+            self.dbconn.execute('delete from cache')
+            self.dbconn.execute('delete from info')
+            self.dbconn.execute('insert into info values (?)',
+                                (self.digest_name,))
+        self.dbconn.execute('drop table if exists new')
+        self.dbconn.execute('create table new (%s)' % _SCHEMA)
+
+    def _discard(self):
+        if self.dbconn is not None:
+            self.dbconn.close()
+            self.dbconn = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def lookup(self, st):
+        '''
+        Return the raw digest for the file with stat result st, or None if
+        it isn't known.
+        '''
+        row = self.dbconn.execute(
+            'select size, mtime, ctime, digest from cache '
+            'where dev = ? and ino = ?',
+            (_signed(st.st_dev), _signed(st.st_ino))).fetchone()
+        if row is not None and \
+                (row[0], row[1], row[2]) == \
+                (st.st_size, st.st_mtime, st.st_ctime):
+            self.hits += 1
+            return str(row[3])
+        self.misses += 1
+        return None
+
+    def add(self, st, digest):
+        '''
+        Record the raw digest of the file with stat result st. Files changed
+        too recently to be sure of are left out.
+        '''
+        if max(st.st_mtime, st.st_ctime) > self.now - RACY_SECONDS:
+            return
+        self.pending.append((_signed(st.st_dev), _signed(st.st_ino),
+                             st.st_size, st.st_mtime, st.st_ctime,
+                             sqlite3.Binary(digest)))
+        if len(self.pending) >= INSERT_BATCH:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self.dbconn.executemany(
+                'insert or replace into new values (?, ?, ?, ?, ?, ?)',
+                self.pending)
+            self.pending = []
+
+    def close(self):
+        '''Replace the old cache with the one built by add().'''
+        if self.dbconn is None:
+            return
+        self._flush()
+        self.dbconn.execute('drop table cache')
+        self.dbconn.execute('alter table new rename to cache')
+        self.dbconn.commit()
+        self.dbconn.close()
+        self.dbconn = None
+
+    def abandon(self):
+        '''Close the cache, leaving it as it was.'''
+        if self.dbconn is not None:
+            self.dbconn.rollback()
+            self.dbconn.close()
+            self.dbconn = None
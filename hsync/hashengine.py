@@ -0,0 +1,319 @@
+# File content hashing.
+
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Files are read into a buffer that's allocated once per thread and reused,
+with readinto(), so hashing a big tree doesn't churn through large
+strings. Where posix_fadvise() is available, the kernel is told the file
+will be read sequentially, and that the pages already hashed won't be
+needed again, so a big scan doesn't push everything else out of the page
+cache.
+
+Files aren't mmap()'d. Python 2's mmap can't advise the kernel about the
+pages, so a mapped file would stay in the page cache just the same.
+
+The digest algorithm can be chosen. Every algorithm offered makes a 256-bit
+digest, so the fixed-width fields in the binary signature and elsewhere
+fit any of them. Signature files name the algorithm in a header comment:
+
+    # digest: blake2b-256
+
+A signature without one is SHA-256, as they all were before. Python 2's
+hashlib has no BLAKE2, so the BLAKE2 algorithms are only available if the
+pyblake2 module is installed.
+'''
+
+from collections import namedtuple
+import ctypes
+import ctypes.util
+import functools
+import hashlib
+import io
+import logging
+import os
+import sys
+import threading
+import time
+
+if hasattr(hashlib, 'blake2b'):
+    _blake2 = hashlib
+else:
+    try:
+        import pyblake2 as _blake2
+    except ImportError:
+        _blake2 = None
+
+log = logging.getLogger()
+
+# Read size, and the size of each thread's buffer.
+HASH_BLOCKSIZE = 1024 * 1024
+
+# How much is hashed between asking the kernel to drop pages.
+DONTNEED_INTERVAL = 64 * 1024 * 1024
+
+# From <fcntl.h>, Linux values.
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+# chunks is a list of the raw digests of each chunk of the file, if they
+# were asked for, otherwise None.
+HashResult = namedtuple('HashResult',
+                        ['digest', 'nbytes', 'seconds', 'chunks'])
+
+_fadvise = None
+_fadvise_checked = False
+
+
+class UnknownDigestError(Exception):
+    pass
+
+
+DEFAULT_DIGEST = 'sha256'
+
+# The signature file header line, followed by the algorithm name.
+DIGEST_HEADER = '# digest: '
+
+# Every algorithm we know of, with the number used for it in binary
+# signatures. Don't reuse numbers.
+DIGEST_IDS = {
+    'sha256': 0,
+    'blake2b-256': 1,
+    'blake2s-256': 2,
+}
+
+# The constructors for the algorithms we can actually use.
+_constructors = {'sha256': hashlib.sha256}
+if _blake2 is not None:
+    _constructors['blake2b-256'] = functools.partial(_blake2.blake2b,
+                                                     digest_size=32)
+    _constructors['blake2s-256'] = _blake2.blake2s
+
+
+def digest_names():
+    '''Return the names of the algorithms available here, sorted.'''
+    return sorted(_constructors)
+
+
+def check_digest(name):
+    '''
+    Raise UnknownDigestError unless name is an algorithm we can use.
+    '''
+    if name not in DIGEST_IDS:
+        raise UnknownDigestError("Unknown digest algorithm '%s'" % name)
+    if name not in _constructors:
+        raise UnknownDigestError("Digest algorithm '%s' isn't available "
+                                 "(is pyblake2 installed?)" % name)
+
+
+def new_digest(name):
+    '''Return a new hash object for the named algorithm.'''
+    check_digest(name)
+    return _constructors[name]()
+
+
+def digest_header(name):
+    '''Return the signature header line naming the algorithm.'''
+    return DIGEST_HEADER + name
+
+
+def header_digest(line):
+    '''
+    If line is a digest header, return the algorithm it names, otherwise
+    None. Raise UnknownDigestError if it names one we can't use.
+    '''
+    if not line.startswith(DIGEST_HEADER):
+        return None
+    name = line[len(DIGEST_HEADER):].strip()
+    check_digest(name)
+    return name
+
+
+def _get_fadvise():
+    '''
+    Return the C library's posix_fadvise(), or None if we can't use it.
+    '''
+    global _fadvise, _fadvise_checked
+    if not _fadvise_checked:
+        _fadvise_checked = True
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or
+                                   'libc.so.6', use_errno=True)
+                fn = getattr(libc, 'posix_fadvise64', None) or \
+                    libc.posix_fadvise
+                fn.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                               ctypes.c_int]
+                _fadvise = fn
+            except (OSError, AttributeError) as e:
+                log.debug("posix_fadvise() unavailable: %s", e)
+    return _fadvise
+
+
+class HashEngine(object):
+    '''
+    Hash files with a reusable per-thread buffer. hash_path() returns a
+    HashResult for the file, and the totals over all calls are kept in
+    files, nbytes and seconds.
+
+    digest_name is the algorithm used, unless the call names another. Set
+    it with use_digest().
+
+    Chunk digests can be recorded as files are hashed, so they're to hand
+    when the chunk signature is written, without reading the files again.
+    See record_chunks().
+    '''
+
+    def __init__(self, block_size=HASH_BLOCKSIZE, fadvise=True,
+                 digest_name=DEFAULT_DIGEST):
+        self.block_size = block_size
+        self.use_digest(digest_name)
+        self.fadvise = fadvise
+        self.files = 0
+        self.nbytes = 0
+        self.seconds = 0.0
+        self.chunk_size = None
+        self.chunk_min_size = None
+        self._chunks = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def use_digest(self, name):
+        '''
+        Make name the default algorithm. Raise UnknownDigestError if it
+        can't be used.
+        '''
+        check_digest(name)
+        self.digest_name = name
+
+    def new(self):
+        '''Return a new hash object for the default algorithm.'''
+        return new_digest(self.digest_name)
+
+    def record_chunks(self, chunk_size, min_size):
+        '''
+        From now on, when a file of at least min_size bytes is hashed with
+        the default algorithm, keep its chunk digests. Fetch them with
+        take_chunks(). A chunk_size of None stops recording, and forgets
+        anything recorded so far.
+        '''
+        with self._lock:
+            self.chunk_size = chunk_size
+            self.chunk_min_size = min_size
+            if chunk_size is None:
+                self._chunks = {}
+
+    def take_chunks(self, digest):
+        '''
+        Return and forget the recorded chunk digests for the contents with
+        raw digest digest, or None.
+        '''
+        with self._lock:
+            return self._chunks.pop(digest, None)
+
+    def _buffer(self):
+        buf = getattr(self._local, 'buf', None)
+        if buf is None or len(buf) != self.block_size:
+            buf = self._local.buf = bytearray(self.block_size)
+        return buf
+
+    def _advise(self, fd, offset, length, advice):
+        fn = _get_fadvise() if self.fadvise else None
+        if fn is not None:
+            # Advice is only advice; don't fail if it's not taken.
+            fn(fd, offset, length, advice)
+
+    def hash_path(self, path, digest_name=None, chunk_size=None):
+        '''
+        Hash the contents of the file at path. If chunk_size is given, each
+        chunk_size piece of the file is hashed as well.
+        '''
+        start = time.time()
+        buf = self._buffer()
+        view = memoryview(buf)
+        digest_name = digest_name or self.digest_name
+        md = new_digest(digest_name)
+        nbytes = 0
+        dropped = 0
+        record = False
+
+        with io.open(path, 'rb', buffering=0) as f:
+            fd = f.fileno()
+            if chunk_size is None and self.chunk_size is not None and \
+                    digest_name == self.digest_name and \
+                    os.fstat(fd).st_size >= self.chunk_min_size:
+                chunk_size = self.chunk_size
+                record = True
+            chunks = None
+            if chunk_size is not None:
+                chunks = []
+                chunk_md = new_digest(digest_name)
+                chunk_left = chunk_size
+
+            self._advise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                md.update(view[:n])
+                nbytes += n
+                pos = 0
+                while chunks is not None and pos < n:
+                    take = min(chunk_left, n - pos)
+                    chunk_md.update(view[pos:pos + take])
+                    pos += take
+                    chunk_left -= take
+                    if not chunk_left:
+                        chunks.append(chunk_md.digest())
+                        chunk_md = new_digest(digest_name)
+                        chunk_left = chunk_size
+                if nbytes - dropped >= DONTNEED_INTERVAL:
+                    self._advise(fd, dropped, nbytes - dropped,
+                                 POSIX_FADV_DONTNEED)
+                    dropped = nbytes
+            self._advise(fd, 0, 0, POSIX_FADV_DONTNEED)
+
+        if chunks is not None and chunk_left != chunk_size:
+            chunks.append(chunk_md.digest())
+
+        result = HashResult(md.digest(), nbytes, time.time() - start, chunks)
+        with self._lock:
+            self.files += 1
+            self.nbytes += nbytes
+            self.seconds += result.seconds
+            if record:
+                self._chunks[result.digest] = chunks
+        return result
+
+    def totals(self):
+        '''Return (files, nbytes, seconds) over all calls so far.'''
+        with self._lock:
+            return (self.files, self.nbytes, self.seconds)
+
+
+# The engine used by FileHash.
+engine = HashEngine()
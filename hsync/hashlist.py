@@ -29,13 +29,25 @@ from __future__ import print_function
 
 from collections import OrderedDict
 import logging
+import os
 
 from exceptions import *
 from filehash import FileHash
+from hashengine import DEFAULT_DIGEST
 
 log = logging.getLogger()
 
 
+def dir_prefix(dirname):
+    '''
+    The prefix of the paths directly in dirname, as os.path.split() would
+    split them.
+    '''
+    if not dirname or dirname.endswith(os.sep):
+        return dirname
+    return dirname + os.sep
+
+
 class HashList(object):
     '''
     A memory-backed list of objects. Fast, but requires that all the objects
@@ -52,12 +64,19 @@ class HashList(object):
         self.write_count = 0
         self.write_total = 0
         self.read_total = 0
+        # True while the entries are known to be in path order, which is
+        # the case if they were appended in order, or just sorted.
+        self.path_ordered = True
+        self.last_path = None
+        # The algorithm the content digests were made with.
+        self.digest_name = DEFAULT_DIGEST
         self.storage_init()
 
     def storage_init(self):
         log.debug("HashList _storage_init()")
         self.list = []
         self.dup_detect = set()
+        self.child_map = None
 
     def close(self, want_sync=False):
         if log.isEnabledFor(logging.DEBUG):
@@ -80,6 +99,12 @@ class HashList(object):
         if type(fh) is not FileHash:
             raise NotAFileHashError()
 
+    def _note_path(self, fh):
+        '''Keep track of whether entries are being appended in path order.'''
+        if self.last_path is not None and fh.fpath < self.last_path:
+            self.path_ordered = False
+        self.last_path = fh.fpath
+
     def write_increment(self):
         self.write_count += 1
         self.write_total += 1
@@ -109,6 +134,8 @@ class HashList(object):
             self.dup_detect.add(strhash)
 
         self.list.append(fh)
+        self.child_map = None
+        self._note_path(fh)
         self.write_increment()
 
     def extend(self, fhlist):
@@ -141,6 +168,38 @@ class HashList(object):
         '''Sort the hashlist by the FileHash.fpath field.'''
         log.debug("HashList.sort_by_path()")
         self.list.sort(key=lambda fh: fh.fpath)
+        self._sorted()
+
+    def path_index(self):
+        '''
+        Return a mapping of path to list index, iterating in path order. If
+        a path appears more than once, the last entry wins.
+        '''
+        path_to_index = {}
+        for n, fh in enumerate(self):
+            path_to_index[fh.fpath] = n
+
+        index = OrderedDict()
+        for path in sorted(path_to_index.iterkeys()):
+            index[path] = path_to_index[path]
+        return index
+
+    def children(self, dirname):
+        '''
+        Return a dict of the entries directly in directory dirname, keyed on
+        name. If a path appears more than once, the last entry wins.
+        '''
+        if self.child_map is None:
+            self.child_map = {}
+            for fh in self:
+                (parent, name) = os.path.split(fh.fpath)
+                self.child_map.setdefault(parent, {})[name] = fh
+        return self.child_map.get(dirname, {})
+
+    def _sorted(self):
+        self.path_ordered = True
+        if len(self) > 0:
+            self.last_path = self[-1].fpath
 
 
 class HashDict(object):
@@ -161,17 +220,9 @@ class HashDict(object):
         if log.isEnabledFor(logging.DEBUG):
             log.debug("HashDict._dict_from_list()")
 
-        # Create a hash mapping path to list index.
-        path_to_index = {}
-        for n, fh in enumerate(self.hl):
-            path_to_index[fh.fpath] = n
-
-        # Create an OrderedDict in pathname order. Now, an enumeration of
-        # the dict will walk the tree in path order, returning the index into
-        # the list of FileHash objects.
-        self.hd = OrderedDict()
-        for path in sorted(path_to_index.iterkeys()):
-            self.hd[path] = path_to_index[path]
+        # An enumeration of the index walks the tree in path order,
+        # returning the index into the list of FileHash objects.
+        self.hd = self.hl.path_index()
 
     def __getitem__(self, key):
         if key is None or key == '':
@@ -0,0 +1,357 @@
+# Lazily-decoded hashlist over an mmap'd signature file.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import print_function
+
+from array import array
+from collections import OrderedDict
+import logging
+import mmap
+import os
+from stat import S_ISLNK
+
+from exceptions import *
+from filehash import FileHash
+from hashengine import header_digest
+from hashlist import HashList, dir_prefix
+from sigbin import MAGIC, SigBinReader
+from utility import is_hashfile
+
+log = logging.getLogger()
+
+# The number of decoded entries to keep for __getitem__().
+CACHE_SIZE = 1024
+
+
+class MmapHashList(HashList):
+    '''
+    A read-only hashlist over a signature file, text or binary, read
+    through mmap. Entries are only decoded into FileHash objects when
+    they're visited, and only the most recently used few are kept.
+
+    Signature files are always written in path order, so the entries for a
+    subtree can be found by binary search; see subtree_ranges(). The
+    searches work in positions, which are record numbers in a binary file
+    and byte offsets in a text one, so a text file needn't be indexed
+    line by line to be searched. The line index is only built if entries
+    are asked for by number.
+
+    Hash and lock files are left out, as hashlist_from_stringlist() leaves
+    them out.
+
+    f must be a real file, and it's closed along with the hashlist.
+    '''
+
+    def __init__(self, f, opts, root=None, name='hashfile',
+                 cache_size=CACHE_SIZE):
+        self.f = f
+        self.trim = opts.trim_path
+        self.root = root
+        self.name = name
+        self.cache_size = cache_size
+        self.hash_file = opts.hash_file
+        self.guess_sigfiles = opts.guess_sigfiles
+        super(MmapHashList, self).__init__(warn_on_duplicates=False,
+                                           raise_on_duplicates=False)
+
+    def storage_init(self):
+        log.debug("MmapHashList.storage_init(): %s", self.name)
+        self.cache = OrderedDict()
+        self.m = None
+        self.reader = None
+        self.offsets = None
+        self.count = None
+
+        if os.fstat(self.f.fileno()).st_size == 0:
+            raise TruncatedHashfileError("'FINAL:' line of %s appears "
+                                         "to be missing!" % self.name)
+
+        m = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        if m[:len(MAGIC)] == MAGIC:
+            m.close()
+            self.reader = SigBinReader(self.f, name=self.name)
+            self.digest_name = self.reader.digest_name
+            self.start_pos = 0
+            self.end_pos = len(self.reader)
+        else:
+            self.m = m
+            self._find_text_ends()
+
+    def _find_text_ends(self):
+        '''
+        Find where the entries of a text file start and end: after the
+        header comments, and before the FINAL: line, which must be there.
+        '''
+        m = self.m
+        size = len(m)
+        pos = 0
+        while pos < size and m[pos] == '#':
+            end = self._line_end(pos)
+            digest_name = header_digest(m[pos:end].rstrip('\r'))
+            if digest_name is not None:
+                self.digest_name = digest_name
+            pos = end + 1
+        self.start_pos = min(pos, size)
+
+        # The last line, not counting the newline at the end of the file.
+        last = m.rfind('\n', 0, size - 1) + 1
+        if m[last:last + 6] != 'FINAL:':
+            raise TruncatedHashfileError("'FINAL:' line of %s appears "
+                                         "to be missing!" % self.name)
+        self.end_pos = max(last, self.start_pos)
+        log.debug("MmapHashList: entries at bytes %d-%d of %s",
+                  self.start_pos, self.end_pos, self.name)
+
+    def _line_end(self, pos):
+        end = self.m.find('\n', pos)
+        if end < 0:
+            end = len(self.m)
+        return end
+
+    def _text_positions(self, lo, hi):
+        '''
+        Generate the positions of the text entries whose lines start in
+        [lo, hi). lo must be the start of a line.
+        '''
+        m = self.m
+        pos = lo
+        while pos < hi:
+            end = self._line_end(pos)
+            if end > pos and m[pos] != '#' and m[pos:pos + 6] != 'FINAL:':
+                yield pos
+            pos = end + 1
+
+    def _positions(self, lo, hi):
+        '''
+        Generate the positions of the entries in [lo, hi), leaving out hash
+        and lock files. In a text file, lo must be the start of a line.
+        '''
+        if self.reader is not None:
+            positions = xrange(lo, hi)
+        else:
+            positions = self._text_positions(lo, hi)
+        for pos in positions:
+            if self._wanted(pos):
+                yield pos
+
+    def _wanted(self, pos):
+        fname = os.path.basename(self._path_at(pos))
+        if is_hashfile(fname, self.hash_file,
+                       guess_sigfiles=self.guess_sigfiles):
+            log.debug("Skipping hash or lock file %s", fname)
+            return False
+        return True
+
+    def _index(self):
+        '''
+        Find the position of each entry, for access by number. A binary
+        file's record numbers serve, unless some have been left out.
+        '''
+        if self.count is None:
+            offsets = array('L', self._positions(self.start_pos,
+                                                 self.end_pos))
+            self.count = len(offsets)
+            if self.reader is None or self.count < self.end_pos:
+                self.offsets = offsets
+            log.debug("MmapHashList: %d entries in %s", self.count,
+                      self.name)
+
+    def close(self, want_sync=False):
+        super(MmapHashList, self).close(want_sync=want_sync)
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        if self.m is not None:
+            self.m.close()
+            self.m = None
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def _line_at(self, pos):
+        return self.m[pos:self._line_end(pos)].rstrip('\r')
+
+    def _decode_at(self, pos):
+        if self.reader is not None:
+            return self.reader.filehash(pos, self.trim, root=self.root)
+        return FileHash.init_from_string(self._line_at(pos), self.trim,
+                                         root=self.root)
+
+    def _path_at(self, pos):
+        if self.reader is not None:
+            return self.reader.path(pos)
+        (md, smode, user, group, mtime, size, fpath) = \
+            self._line_at(pos).split(None, 6)
+        if S_ISLNK(int(smode, 8)):
+            fpath = fpath.split('>>>', 1)[0]
+        return fpath
+
+    def _position(self, index):
+        self._index()
+        if self.offsets is None:
+            return index
+        return self.offsets[index]
+
+    def path(self, n):
+        '''
+        Return the path of entry n, without decoding the rest of it.
+        '''
+        return self._path_at(self._position(n))
+
+    def append(self, fh):
+        raise ReadOnlyHashListError("%s is read-only" % self.name)
+
+    def __len__(self):
+        self._index()
+        return self.count
+
+    def __getitem__(self, index):
+        count = len(self)
+        if index < 0:
+            index += count
+        if index < 0 or index >= count:
+            raise IndexError("MmapHashList index out of range")
+        self.read_total += 1
+
+        fh = self.cache.pop(index, None)
+        if fh is None:
+            fh = self._decode_at(self._position(index))
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[index] = fh
+        return fh
+
+    def list_generator(self):
+        return self.entries(self.start_pos, self.end_pos)
+
+    def entries(self, lo, hi):
+        '''
+        Generate freshly-decoded entries from position lo up to position
+        hi, bypassing the cache.
+        '''
+        for pos in self._positions(lo, hi):
+            yield self._decode_at(pos)
+
+    def sort_by_path(self):
+        '''Signature files are written in path order already.'''
+        self._sorted()
+
+    def _sorted(self):
+        self.path_ordered = True
+
+    def _lower_bound(self, path):
+        '''The position of the first entry whose path is >= path.'''
+        if self.reader is not None:
+            lo = 0
+            hi = self.end_pos
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._path_at(mid) < path:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+        # Bisect the bytes. Every entry starting before lo has a smaller
+        # path, and every entry starting at or after hi doesn't. lo is
+        # always the start of a line.
+        lo = self.start_pos
+        hi = self.end_pos
+        while lo < hi:
+            mid = (lo + hi) // 2
+            # The first line starting at or after mid.
+            start = mid
+            if mid > lo:
+                start = self._line_end(mid - 1) + 1
+            pos = next(self._text_positions(start, hi), None)
+            if pos is None:
+                # No entry starts between mid and hi.
+                hi = mid
+            elif self._path_at(pos) < path:
+                lo = self._line_end(pos) + 1
+            else:
+                hi = pos
+        return next(self._text_positions(lo, self.end_pos), self.end_pos)
+
+    def find(self, path):
+        '''
+        Return the position of the first entry for path, or None.
+        '''
+        pos = self._lower_bound(path)
+        if pos < self.end_pos and self._path_at(pos) == path and \
+                self._wanted(pos):
+            return pos
+        return None
+
+    def prefix_range(self, prefix):
+        '''
+        Return the (lo, hi) position range of the entries whose paths start
+        with prefix.
+        '''
+        if not prefix:
+            return (self.start_pos, self.end_pos)
+        after = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return (self._lower_bound(prefix), self._lower_bound(after))
+
+    def children(self, dirname):
+        '''
+        Return a dict of the entries directly in directory dirname, keyed on
+        name, decoding only the entries under it.
+        '''
+        prefix = dir_prefix(dirname)
+        children = {}
+        for fh in self.entries(*self.prefix_range(prefix)):
+            name = fh.fpath[len(prefix):]
+            if name and os.sep not in name:
+                children[name] = fh
+        return children
+
+    def subtree_ranges(self, paths):
+        '''
+        Return a sorted list of non-overlapping (lo, hi) position ranges
+        that cover the entries for each of paths and everything under them.
+        '''
+        ranges = []
+        for path in paths:
+            path = path.rstrip(os.sep)
+            # The path itself, then everything under it. These aren't
+            # necessarily next to each other: 'a-b' sorts between 'a' and
+            # 'a/b'.
+            for (lo, hi) in ((self._lower_bound(path),
+                              self._lower_bound(path + '\0')),
+                             self.prefix_range(path + os.sep)):
+                if lo < hi:
+                    ranges.append((lo, hi))
+
+        ranges.sort()
+        merged = []
+        for (lo, hi) in ranges:
+            if merged and lo <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(hi, merged[-1][1]))
+            else:
+                merged.append((lo, hi))
+        return merged
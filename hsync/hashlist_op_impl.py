@@ -27,6 +27,7 @@
 
 from __future__ import print_function
 
+from collections import deque
 import gzip
 import logging
 import os
@@ -35,16 +36,31 @@ import re
 import sys
 
 from exceptions import *
+from extsort import external_sort
 from filehash import *
+from hashengine import (DEFAULT_DIGEST, digest_header, header_digest,
+                        engine as hash_engine)
+from fswalk import walk
 from hashlist import *
-from utility import (get_hashlist, is_dir_excluded,
-                     is_path_pre_excluded, is_hashfile)
+from hashlist_sqlite import SqliteHashList
+from sigbin import SigBinReader, SigBinWriter
+from subtree import (SubtreeHasher, subtree_digests, subtree_file_write,
+                     unchanged_prefixes)
+from utility import (GlobMatcher, PrefixSet, get_hashlist,
+                     is_dir_excluded, is_path_pre_excluded, is_hashfile,
+                     is_partial, partial_path)
+from workerpool import WorkerPool
 
 log = logging.getLogger()
 
+# With --jobs, the number of scanned entries that can wait for an earlier
+# file to be hashed before we stop and wait for it.
+MAX_PENDING_HASHES = 10000
+
 
 def hashlist_generate(srcpath, opts, source_mode=True,
-                      existing_hashlist=None):
+                      existing_hashlist=None, listing=None, hash_cache=None,
+                      partials=None, dir_hook=None):
     '''
     Generate the hashlist for the given path.
 
@@ -61,6 +77,22 @@ def hashlist_generate(srcpath, opts, source_mode=True,
     behaviour, which is to ignore of common dirs (CVS, .git, .svn) and files
     (*~, *.swp).
 
+    With opts.jobs > 1, files are hashed by a pool of worker threads while
+    the scan carries on. Entries are still added to the hashlist in scan
+    order, so the result doesn't depend on the number of jobs.
+
+    listing, if given, is a dirstate.IncrementalListing, used to skip
+    listing directories that haven't changed since the last scan.
+
+    hash_cache, if given, is a hashcache.HashCache. It's checked before any
+    file is read, and the digest of every file scanned is added to it.
+
+    On the destination (source_mode False), partial downloads (see
+    partial_path()) are left out of the hashlist. If partials is a list, a
+    FileHash for each one found is appended to it.
+
+    dir_hook is passed to fswalk.walk().
+
     '''
 
     log.debug("hashlist_generate: srcpath %s source_mode %s",
@@ -99,6 +131,118 @@ def hashlist_generate(srcpath, opts, source_mode=True,
             print("Comparing local filesystem to signature file%s" %
                   (source_extramsg))
 
+    (hashed_files, hashed_bytes, hashed_secs) = hash_engine.totals()
+    _scan(srcpath, srcpath, hashlist, lookup_existing, defer_fs_read,
+          source_mode, opts, listing, hash_cache, partials, dir_hook)
+
+    if opts.scan_debug:
+        _scan_debug(hashlist)
+
+    if opts.verbose:
+        print("Scan: %d stat calls, %d saved compared to os.walk()" %
+              (opts.stats.stat_calls, opts.stats.stat_calls_saved))
+        if listing is not None:
+            print("Scan: %d directories unchanged since the last scan" %
+                  listing.reused)
+        if hash_cache is not None:
+            print("Scan: %d files found in the hash cache, %d not" %
+                  (hash_cache.hits, hash_cache.misses))
+        (files, nbytes, secs) = hash_engine.totals()
+        files -= hashed_files
+        nbytes -= hashed_bytes
+        secs -= hashed_secs
+        if files:
+            print("Scan: hashed %d files, %d bytes in %.2fs (%.1f MB/s)" %
+                  (files, nbytes, secs,
+                   nbytes / 1e6 / secs if secs > 0 else 0.0))
+
+    log.debug("hashlist_generate: entries %d", len(hashlist))
+    return hashlist
+
+
+def hashlist_scan_dir(srcpath, path, opts, existing=None, recurse=True,
+                      dir_hook=None):
+    '''
+    Scan the directory path, inside srcpath, just as hashlist_generate()
+    scans it as part of srcpath, and return an in-memory hashlist of what's
+    there, in scan order. The entries have the same paths, and go through
+    the same filters. path itself has no entry.
+
+    If recurse is False, only the entries directly in path are scanned.
+    existing, if given, is a dict of old entries by fpath, used to avoid
+    rehashing files that haven't changed. dir_hook is passed to
+    fswalk.walk().
+    '''
+    hashlist = HashList()
+    _scan(srcpath, path, hashlist, existing, True, True, opts,
+          dir_hook=dir_hook, recurse=recurse)
+    return hashlist
+
+
+def _scan(srcpath, top, hashlist, lookup_existing, defer_fs_read,
+          source_mode, opts, listing=None, hash_cache=None, partials=None,
+          dir_hook=None, recurse=True):
+    '''
+    Add the entries under top, inside srcpath, to hashlist in scan order,
+    hashing with a pool of workers if opts.jobs > 1.
+    '''
+    pool = None
+    if opts.jobs > 1:
+        pool = WorkerPool(opts.jobs)
+    # Scanned entries, as [fh, ready] lists, in scan order.
+    pending = deque()
+
+    try:
+        _hashlist_walk(srcpath, top, hashlist, pool, pending,
+                       lookup_existing, defer_fs_read, source_mode, opts,
+                       listing, hash_cache, partials, dir_hook, recurse)
+        if pool is not None:
+            for result in pool.wait():
+                _hash_done(result)
+        _add_ready(pending, hashlist, hash_cache)
+        assert not pending, "All scanned entries added"
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def _hash_done(result):
+    '''
+    Mark a pending entry hashed by a worker as ready.
+    '''
+    (entry, dummy, exc_info) = result
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+    entry[1] = True
+
+
+def _add_ready(pending, hashlist, hash_cache=None):
+    '''
+    Move entries from the front of the pending queue to the hashlist, up to
+    the first one that's still being hashed. Files scanned from the
+    filesystem carry their stat result, for the hash cache.
+    '''
+    while pending and pending[0][1]:
+        entry = pending.popleft()
+        fh = entry[0]
+        log.debug("'%s': Adding to hash list", fh.fpath)
+        assert fh.hashstr != fh.notsethash
+        hashlist.append(fh)
+        if hash_cache is not None and len(entry) > 2 and \
+                fh.digest is not None:
+            hash_cache.add(entry[2], fh.digest)
+
+
+def _hashlist_walk(srcpath, top, hashlist, pool, pending, lookup_existing,
+                   defer_fs_read, source_mode, opts, listing=None,
+                   hash_cache=None, partials=None, dir_hook=None,
+                   recurse=True):
+    '''
+    Walk top, which is srcpath or a directory inside it, queueing FileHash
+    objects on pending in scan order. File contents are hashed here, or by
+    pool if it's not None.
+    '''
+
     if opts.progress and source_mode:
         verb = "Add"
     else:
@@ -109,20 +253,21 @@ def hashlist_generate(srcpath, opts, source_mode=True,
     if opts.exclude_dir:
         excdirs = set([d for d in opts.exclude_dir
                        if not re_globmatch.search(d)])
-        excdirs_glob = set([d for d in opts.exclude_dir
-                            if d not in excdirs])
+        excdirs_glob = GlobMatcher(d for d in opts.exclude_dir
+                                   if d not in excdirs)
     else:
         excdirs = set()
 
     ##
     # Walk the filesystem.
     ##
-    for root, dirs, files in os.walk(srcpath):
+    for root, dirs, files, stat_cache in walk(top, opts.stats, listing,
+                                              dir_hook, recurse):
 
         relroot = root[len(srcpath) + 1:]
 
         if log.isEnabledFor(logging.DEBUG):
-            log.debug("os.walk: root %s dirs %s files %s",
+            log.debug("walk: root %s dirs %s files %s",
                       root, dirs, files)
 
         # See if the directory list can be pruned.
@@ -170,13 +315,16 @@ def hashlist_generate(srcpath, opts, source_mode=True,
             fpath = os.path.join(root, dirname)
             fh = FileHash.init_from_file(fpath, trim=opts.trim_path,
                                          root=srcpath,
-                                         defer_read=defer_fs_read)
+                                         defer_read=defer_fs_read,
+                                         stat_result=stat_cache[dirname])
+            opts.stats.incr('stat_calls_saved')
             if opts.progress:
                 print("D: %s dir %s (dir-in-dir %d/%d)" %
                       (verb, fpath, n, len(dirs)))
             elif opts.verbose:
                 print("%s dir: %s" % (verb, fpath))
-            hashlist.append(fh)
+            pending.append([fh, True])
+            _add_ready(pending, hashlist, hash_cache)
 
         files.sort()
 
@@ -184,9 +332,19 @@ def hashlist_generate(srcpath, opts, source_mode=True,
 
             fpath = os.path.join(root, filename)
 
-            # Don't include hashfiles or lockfiles.
+            if partials is not None and not source_mode and \
+                    is_partial(filename):
+                partials.append(
+                    FileHash.init_from_file(fpath, trim=opts.trim_path,
+                                            root=srcpath, defer_read=True,
+                                            stat_result=stat_cache.get(
+                                                filename)))
+
+            # Don't include hashfiles or lockfiles, or partial downloads on
+            # the destination.
             if is_hashfile(filename, custom_hashfile=opts.hash_file,
-                           guess_sigfiles=opts.guess_sigfiles):
+                           guess_sigfiles=opts.guess_sigfiles,
+                           allow_partials=not source_mode):
                 log.debug("Skipping hash file or lock '%s'", filename)
                 continue
 
@@ -204,21 +362,34 @@ def hashlist_generate(srcpath, opts, source_mode=True,
 
             log.debug("Add file: %s", fpath)
 
+            if filename not in stat_cache:
+                # An incremental scan is trusting the last signature file.
+                log.debug("'%s': reusing old entry", fpath)
+                pending.append([listing.entry(fpath), True])
+                _add_ready(pending, hashlist, hash_cache)
+                continue
+
             if opts.progress:
                 print("F: %s [dir %s] file %s (file-in-dir %d/%d)" %
                       (verb, root, filename, n, len(files)))
             elif opts.verbose:
                 print("%s file: %s" % (verb, fpath))
 
+            # With a pool, always defer the read so the workers can do it.
+            st = stat_cache[filename]
             fh = FileHash.init_from_file(fpath, trim=opts.trim_path,
                                          root=srcpath,
-                                         defer_read=defer_fs_read)
+                                         defer_read=(defer_fs_read or
+                                                     pool is not None),
+                                         stat_result=st)
+            opts.stats.incr('stat_calls_saved')
 
-            if not opts.always_checksum and fh.is_file:
+            do_checksum = False
+            if fh.is_file and not fh.has_read_contents:
                 # Attempt to bypass the checksum, if the old HSYNC.SIG has it.
                 do_checksum = True
 
-                if lookup_existing is not None:
+                if not opts.always_checksum and lookup_existing is not None:
                     if fh.fpath in lookup_existing:
                         oldfh = lookup_existing[fh.fpath]
                         log.debug("'%s': Found old entry (%s)",
@@ -227,19 +398,39 @@ def hashlist_generate(srcpath, opts, source_mode=True,
                             do_checksum = False
                             fh.inherit_attributes(oldfh)
 
-                if do_checksum:
-                    log.debug("'%s': fall back to reading file", fh.fpath)
+                if do_checksum and hash_cache is not None and \
+                        not opts.always_checksum:
+                    digest = hash_cache.lookup(st)
+                    if digest is not None:
+                        log.debug("'%s': found in hash cache", fh.fpath)
+                        do_checksum = False
+                        fh.digest = digest
+                        fh.has_read_contents = True
+
+            entry = [fh, True, st]
+
+            if do_checksum:
+                log.debug("'%s': fall back to reading file", fh.fpath)
+                if pool is not None:
+                    entry[1] = False
+                    pool.submit(fh.read_file_contents, cost=fh.size,
+                                tag=entry)
+                else:
                     fh.read_file_contents()
 
-            log.debug("'%s': Adding to hash list", fh.fpath)
-            assert fh.hashstr != fh.notsethash
-            hashlist.append(fh)
+            pending.append(entry)
 
-    if opts.scan_debug:
-        _scan_debug(hashlist)
+            if pool is not None:
+                for result in pool.completed():
+                    _hash_done(result)
+                # Don't let the queue grow without limit behind one big
+                # file.
+                while len(pending) > MAX_PENDING_HASHES and \
+                        not pending[0][1]:
+                    _hash_done(pool.next_result())
+                    _add_ready(pending, hashlist, hash_cache)
 
-    log.debug("hashlist_generate: entries %d", len(hashlist))
-    return hashlist
+            _add_ready(pending, hashlist, hash_cache)
 
 
 def _scan_debug(hashlist, outfile=sys.stderr):
@@ -250,7 +441,15 @@ def _scan_debug(hashlist, outfile=sys.stderr):
 
 
 def sigfile_write(hashlist, abs_path, opts,
-                  use_tmp=False, verb='Generating', no_compress=False):
+                  use_tmp=False, verb='Generating', no_compress=False,
+                  binary_path=None, tree_path=None, subtree_hasher=None):
+    '''
+    Write the hashlist to a signature file at abs_path. If binary_path is
+    given, write a binary signature file there too, in the same pass.
+
+    If tree_path is given, write the subtree digests there. Each entry is
+    also added to subtree_hasher, if there is one.
+    '''
 
     compress = False
     if not no_compress:
@@ -265,10 +464,6 @@ def sigfile_write(hashlist, abs_path, opts,
         print("%s signature file %s compress %s" %
               (verb, abs_path, compress))
 
-    log.debug("Sorting signature file")
-    # hashlist.sort(key=lambda fh: fh.fpath)
-    hashlist.sort_by_path()
-
     writemode = 'w'
 
     if use_tmp:
@@ -281,14 +476,55 @@ def sigfile_write(hashlist, abs_path, opts,
         log.debug("Writing hash file '%s'", abs_path)
         sigfile = open(abs_path, writemode)
 
-    for fh in hashlist:
-        assert fh.hashstr != fh.notsethash, \
-            "Hash should not be the 'not set' value"
-        print(fh.presentation_format(), file=sigfile)
-
-    print("FINAL: %s" % (hash_of_hashlist(hashlist)), file=sigfile)
+    binfile = None
+    if binary_path is not None:
+        if not opts.quiet:
+            print("%s binary signature file %s" % (verb, binary_path))
+        binary_path_tmp = binary_path + ".%08x" % \
+            SystemRandom().randint(0, 0xffffffff)
+        binfile = SigBinWriter(binary_path_tmp,
+                               digest_name=hash_engine.digest_name)
+
+    if tree_path is not None and subtree_hasher is None:
+        subtree_hasher = SubtreeHasher()
+
+    # Older clients can't read the header, so leave it out for the
+    # default, which they can check.
+    if hash_engine.digest_name != DEFAULT_DIGEST:
+        print(digest_header(hash_engine.digest_name), file=sigfile)
+
+    md = hash_engine.new()
+    for (fh, line, sha) in _sigfile_entries(hashlist,
+                                            os.path.dirname(abs_path)):
+        print(line, file=sigfile)
+        md.update(sha)
+        if fh is None and (binfile is not None or
+                           subtree_hasher is not None):
+            fh = FileHash.init_from_string(line, trim=True)
+        if binfile is not None:
+            binfile.add(fh)
+        if subtree_hasher is not None:
+            subtree_hasher.add(fh, line)
+
+    print("FINAL: %s" % (md.hexdigest()), file=sigfile)
     sigfile.close()
 
+    if binfile is not None:
+        binfile.close(md.hexdigest())
+        log.debug("Moving binary hashfile into place: '%s' -> '%s'",
+                  binary_path_tmp, binary_path)
+        os.rename(binary_path_tmp, binary_path)
+
+    if tree_path is not None:
+        if not opts.quiet:
+            print("%s subtree file %s" % (verb, tree_path))
+        tree_path_tmp = tree_path + ".%08x" % \
+            SystemRandom().randint(0, 0xffffffff)
+        subtree_file_write(subtree_hasher.digests(), tree_path_tmp)
+        log.debug("Moving subtree file into place: '%s' -> '%s'",
+                  tree_path_tmp, tree_path)
+        os.rename(tree_path_tmp, tree_path)
+
     if use_tmp:
         log.debug("Moving hashfile into place: '%s' -> '%s'",
                   abs_path_tmp, abs_path)
@@ -312,6 +548,39 @@ def sigfile_write(hashlist, abs_path, opts,
     return True
 
 
+def _sigfile_entries(hashlist, tmpdir):
+    '''
+    Generate (fh, line, sha_hash) for each signature file entry, in path
+    order. A sqlite hashlist that isn't in order sorts itself in SQL. Any
+    other is put in order with an external sort, spilling to tmpdir, so
+    that the sort doesn't need another copy of the list in memory. Only
+    the line and its hash go through the sort, so fh is None for those.
+    '''
+    if not hashlist.path_ordered and isinstance(hashlist, SqliteHashList):
+        log.debug("Sorting signature file in SQL")
+        hashlist.sort_by_path()
+
+    if hashlist.path_ordered:
+        for fh in hashlist:
+            assert fh.hashstr != fh.notsethash, \
+                "Hash should not be the 'not set' value"
+            yield (fh, fh.presentation_format(), fh.sha_hash())
+        return
+
+    log.debug("Sorting signature file")
+
+    def records():
+        # The index keeps entries with the same path in their original
+        # order, as a stable sort would.
+        for n, fh in enumerate(hashlist):
+            assert fh.hashstr != fh.notsethash, \
+                "Hash should not be the 'not set' value"
+            yield (fh.fpath, n, fh.presentation_format(), fh.sha_hash())
+
+    for (fpath, n, line, sha) in external_sort(records(), tmpdir=tmpdir):
+        yield (None, line, sha)
+
+
 def hash_of_hashlist(hashlist):
     '''
     Take a created hashlist and hash its digests and paths, to get
@@ -319,7 +588,7 @@ def hash_of_hashlist(hashlist):
     '''
 
     log.debug("hash_of_hashlist(): start")
-    md = hashlib.sha256()
+    md = hash_engine.new()
     for fh in hashlist:
         md.update(fh.sha_hash())
 
@@ -336,16 +605,41 @@ def hashlist_to_dict(hashlist):
     return HashDict(hashlist)
 
 
-def hashlist_from_stringlist(strfile, opts, root=None):
+def hashlist_from_stringlist(strfile, opts, root=None, require_final=False,
+                             name='hashfile'):
+    '''
+    Build a hashlist from the lines of a signature file. strfile can be any
+    iterable of lines without line endings, so the lines can be parsed as
+    they arrive rather than all being held in memory first.
+
+    If require_final is True, raise TruncatedHashfileError if the last line
+    isn't the 'FINAL:' line. name is used in the error message.
+
+    The hashlist's digest_name is set from the digest header. If the lines
+    have more than one header, and they don't agree, it's set to None.
+    '''
 
     log.debug("hashlist_from_stringlist():")
     hashlist = get_hashlist(opts)
+    final_seen = False
+    header_seen = False
     for l in strfile:
+        final_seen = False
         if l.startswith("#"):
-            pass  # FFR
-        if l.startswith("FINAL: "):
-            pass  # FFR
+            digest_name = header_digest(l)
+            if digest_name is None:
+                pass  # FFR
+            elif not header_seen:
+                hashlist.digest_name = digest_name
+                header_seen = True
+            elif digest_name != hashlist.digest_name:
+                log.debug("%s: digest headers disagree", name)
+                hashlist.digest_name = None
+        elif l.startswith("FINAL:"):
+            final_seen = True
         else:
+            # Entries without a header before them are the default.
+            header_seen = True
             fh = FileHash.init_from_string(l, opts.trim_path, root=root)
             fname = os.path.basename(fh.fullpath)
             if is_hashfile(fname, opts.hash_file,
@@ -354,12 +648,40 @@ def hashlist_from_stringlist(strfile, opts, root=None):
             else:
                 hashlist.append(fh)
 
+    if require_final and not final_seen:
+        raise TruncatedHashfileError("'FINAL:' line of %s appears "
+                                     "to be missing!" % name)
+
+    return hashlist
+
+
+def hashlist_from_sigbin(f, opts, root=None, name='hashfile'):
+    '''
+    Build a hashlist from a binary signature file. f must be a real file,
+    as it's read through mmap.
+    '''
+
+    log.debug("hashlist_from_sigbin():")
+    hashlist = get_hashlist(opts)
+    reader = SigBinReader(f, name=name)
+    hashlist.digest_name = reader.digest_name
+    try:
+        for fh in reader.filehashes(opts.trim_path, root=root):
+            fname = os.path.basename(fh.fullpath)
+            if is_hashfile(fname, opts.hash_file,
+                           guess_sigfiles=opts.guess_sigfiles):
+                log.debug("Skipping hash or lock file %s", fh.fullpath)
+            else:
+                hashlist.append(fh)
+    finally:
+        reader.close()
+
     return hashlist
 
 
 def hashlist_check(dstpath, src_hashlist, opts, existing_hashlist=None,
                    opportunistic_write=False, opwrite_path=None,
-                   source_side=False):
+                   source_side=False, src_tree=None, hash_cache=None):
     '''
     Check the dstpath against the provided hashlist.
 
@@ -367,42 +689,75 @@ def hashlist_check(dstpath, src_hashlist, opts, existing_hashlist=None,
     of filepaths that need to be fetched, and notneeded is a list of filepaths
     that are not present on the target, so may be removed. dst_hashlist is
     a list of FileHash objects for the destination path.
+
+    Both hashlists are walked together in path order, so no lookup
+    structures are needed. They're sorted first if they're not already in
+    path order; a hashlist read from a signature file always is.
+
+    src_tree is an optional dict of the source's subtree digests. Where a
+    directory's digest matches the destination's, nothing under it is
+    compared. The destination's digests come from its scan, so that's still
+    done in full.
+
+    hash_cache is passed on to hashlist_generate() for the destination scan.
     '''
 
     log.debug("hashlist_check():")
 
-    src_fdict = hashlist_to_dict(src_hashlist)
+    if not src_hashlist.path_ordered:
+        log.debug("Sorting source hashlist")
+        src_hashlist.sort_by_path()
 
     # Take the simple road. Generate a hashlist for the destination.
+    partials = []
     dst_hashlist = hashlist_generate(dstpath, opts, source_mode=False,
-                                     existing_hashlist=existing_hashlist)
+                                     existing_hashlist=existing_hashlist,
+                                     hash_cache=hash_cache,
+                                     partials=partials)
+    if partials:
+        partials = _add_source_partials(dst_hashlist, src_hashlist,
+                                        partials)
 
     no_compress = False
     if source_side:
         no_compress = True
 
+    if not dst_hashlist.path_ordered:
+        log.debug("Sorting destination hashlist")
+        dst_hashlist.sort_by_path()
+
+    # --set-user and --set-group change the source entries before they're
+    # compared, so the digests don't tell us anything.
+    use_tree = src_tree is not None and \
+        not (opts.set_user or opts.set_group)
+    dst_hasher = None
+    if use_tree:
+        dst_hasher = SubtreeHasher()
+
     if opportunistic_write:
         assert opwrite_path is not None
         sigfile_write(dst_hashlist, opwrite_path, opts,
                       use_tmp=True, verb='Caching scanned',
-                      no_compress=no_compress)
-
-    dst_fdict = hashlist_to_dict(dst_hashlist)
+                      no_compress=no_compress, subtree_hasher=dst_hasher)
+        dst_tree = dst_hasher.digests() if use_tree else None
+    elif use_tree:
+        dst_tree = subtree_digests(dst_hashlist)
 
     re_globmatch = re.compile(r'[*?\[\]]')
 
     if opts.exclude_dir:
         direx = set([d for d in opts.exclude_dir
                      if not re_globmatch.search(d)])
-        direx_glob = set([d for d in opts.exclude_dir
-                          if d not in direx])
+        direx_glob = GlobMatcher(d for d in opts.exclude_dir
+                                 if d not in direx)
     else:
         direx = set()
-        direx_glob = set()
+        direx_glob = GlobMatcher()
 
-    # Now compare the two dictionaries.
+    # Now compare the two lists.
     needed = get_hashlist(opts)
-    excluded_dirs = set()
+    not_needed = get_hashlist(opts)
+    excluded_dirs = PrefixSet()
 
     mapper = UidGidMapper()
     if opts.set_user:
@@ -410,14 +765,48 @@ def hashlist_check(dstpath, src_hashlist, opts, existing_hashlist=None,
     if opts.set_group:
         mapper.set_default_group(opts.set_group)
 
-    for fpath, fh in src_fdict.iteritems():
+    src_entries = src_hashlist
+    dst_entries = dst_hashlist
+    include_paths = None
+    if opts.include and \
+            not any(re_globmatch.search(i) for i in opts.include):
+        # Only the included subtrees can be fetched, so don't look at
+        # anything else.
+        include_paths = opts.include
+        src_entries = included_entries(src_hashlist, include_paths)
+        dst_entries = included_entries(dst_hashlist, include_paths)
+
+    if use_tree:
+        skip = unchanged_prefixes(src_tree, dst_tree)
+        if opts.verbose:
+            print("Check: %d unchanged subtrees skipped" % len(skip))
+        if skip:
+            src_entries = entries_outside(src_entries, skip)
+            dst_entries = entries_outside(dst_entries, skip)
+
+    for fh, dst_fh in merge_by_path(src_entries, dst_entries):
+
+        if fh is None:
+            # Only on the destination.
+            fpath = dst_fh.fpath
+            filename = os.path.basename(fpath)
+            if filename != '' and \
+                    is_hashfile(filename, custom_hashfile=opts.hash_file,
+                                guess_sigfiles=opts.guess_sigfiles):
+                log.debug("not_needed: skipping hash file or lock '%s'",
+                          filename)
+                continue
+
+            log.debug("%s: not found in source", fpath)
+            not_needed.append(dst_fh)
+            continue
+
+        fpath = fh.fpath
 
         # Generate (pointless) stat.
         if not fh.is_dir and fh.size_is_known:
             opts.stats.bytes_total += fh.size
 
-        assert fpath == fh.fpath
-
         # Process exclusions.
 
         filename = os.path.basename(fpath)
@@ -444,17 +833,16 @@ def hashlist_check(dstpath, src_hashlist, opts, existing_hashlist=None,
             fh.gid = mapper.default_gid
             fh.group = mapper.default_group
 
-        if fpath in dst_fdict:
+        if dst_fh is not None:
 
-            if not src_fdict[fpath].compare(dst_fdict[fpath],
-                                            ignore_mode=opts.ignore_mode,
-                                            trust_mtime=(
-                                                not opts.always_checksum)):
+            if not fh.compare(dst_fh,
+                              ignore_mode=opts.ignore_mode,
+                              trust_mtime=(not opts.always_checksum)):
                 log.debug("%s: needed", fpath)
                 # Store a reference to the object at the destination.
                 # This can be used to update the dest's HSYNC.SIG file and
                 # save on rechecks.
-                fh.associated_dest_object = dst_fdict[fpath]
+                fh.associated_dest_object = dst_fh
                 needed.append(fh)
 
         else:
@@ -462,24 +850,283 @@ def hashlist_check(dstpath, src_hashlist, opts, existing_hashlist=None,
             fh.dest_missing = True
             needed.append(fh)
 
-    not_needed = get_hashlist(opts)
-    for fpath, fh in dst_fdict.iteritems():
+    if include_paths is not None:
+        # Files outside the includes aren't compared, but if the source
+        # doesn't have them they're still deleted, as they are with glob
+        # includes.
+        _add_excluded_not_needed(not_needed, src_hashlist, dst_hashlist,
+                                 include_paths, opts)
+
+    if not source_side:
+        _add_stale_partials(not_needed, needed, partials)
+
+    if not source_side and not opts.no_local_copy:
+        # Only copy from the part of the destination that was compared.
+        dst_view = dst_hashlist
+        if include_paths is not None:
+            dst_view = included_entries(dst_hashlist, include_paths)
+        (needed, not_needed) = plan_local_copies(needed, not_needed,
+                                                 dst_view, opts)
+
+    if opts.check_debug:
+        _check_debug(needed, not_needed)
 
+    return (needed, not_needed, dst_hashlist)
+
+
+def _add_source_partials(dst_hashlist, src_hashlist, partials):
+    '''
+    A file the source lists isn't a partial download, whatever its name, so
+    add the partials the source has to dst_hashlist. Return the others.
+    '''
+    paths = set(fh.fpath for fh in partials)
+    if hasattr(src_hashlist, 'find'):
+        listed = set(p for p in paths if src_hashlist.find(p) is not None)
+    else:
+        listed = set(fh.fpath for fh in src_hashlist if fh.fpath in paths)
+    if not listed:
+        return partials
+
+    rest = []
+    for fh in partials:
+        if fh.fpath in listed:
+            log.debug("%s: listed by the source, not a partial", fh.fpath)
+            fh.read_file_contents()
+            dst_hashlist.append(fh)
+        else:
+            rest.append(fh)
+    return rest
+
+
+def _add_stale_partials(not_needed, needed, partials):
+    '''
+    Add the partial downloads (see partial_path()) that don't belong to a
+    needed file to not_needed, so they're deleted as usual. The others are
+    left alone so they can be resumed.
+    '''
+    if not partials:
+        return
+
+    keep = set(partial_path(fh.fpath, fh.hashstr) for fh in needed
+               if fh.is_file and (fh.dest_missing or fh.contents_differ))
+    added = False
+    for fh in partials:
+        if fh.fpath in keep:
+            log.debug("%s: keeping partial download", fh.fpath)
+            continue
+        log.debug("%s: stale partial download", fh.fpath)
+        not_needed.append(fh)
+        added = True
+
+    if added:
+        not_needed.sort_by_path()
+
+
+def plan_local_copies(needed, not_needed, dst_hashlist, opts):
+    '''
+    Look for needed files whose contents are already somewhere on the
+    destination, and arrange for them to be copied locally rather than
+    fetched. A file that's due to be deleted is renamed into place instead,
+    so a directory renamed on the source is renamed on the destination too.
+
+    Files that are about to be overwritten are never used, and if deletes
+    are off nothing is renamed. dst_hashlist can be any path-ordered
+    iterable of destination entries.
+
+    Returns (needed, not_needed), which are new lists if anything changed.
+    '''
+    wanted = set()
+    rewritten = set()
+    for fh in needed:
+        if fh.is_file and (fh.dest_missing or fh.contents_differ):
+            wanted.add(fh.hashstr)
+            if not fh.dest_missing:
+                rewritten.add(fh.fpath)
+    if not wanted:
+        return (needed, not_needed)
+
+    deletable = set()
+    if not opts.no_delete:
+        deletable = set(fh.fpath for fh in not_needed if fh.is_file)
+
+    # Index the destination's copies of the contents we want.
+    keep = {}
+    spare = {}
+    for dst_fh in _last_per_path(dst_hashlist):
+        if not dst_fh.is_file or dst_fh.fpath in rewritten:
+            continue
+        hashstr = dst_fh.hashstr
+        if hashstr not in wanted:
+            continue
+        if dst_fh.fpath in deletable:
+            spare.setdefault(hashstr, []).append(dst_fh.fpath)
+        elif hashstr not in keep:
+            keep[hashstr] = dst_fh.fpath
+
+    if not keep and not spare:
+        return (needed, not_needed)
+
+    new_needed = get_hashlist(opts)
+    renamed = set()
+    for fh in needed:
+        if fh.is_file and (fh.dest_missing or fh.contents_differ):
+            hashstr = fh.hashstr
+            if spare.get(hashstr):
+                fh.local_copy_from = spare[hashstr].pop(0)
+                fh.local_copy_rename = True
+                renamed.add(fh.local_copy_from)
+                # Further copies come from the file we've just moved.
+                keep.setdefault(hashstr, fh.fpath)
+            elif hashstr in keep:
+                fh.local_copy_from = keep[hashstr]
+                fh.local_copy_rename = False
+            if fh.local_copy_from is not None:
+                log.debug("%s: local %s from '%s'", fh.fpath,
+                          'rename' if fh.local_copy_rename else 'copy',
+                          fh.local_copy_from)
+        new_needed.append(fh)
+
+    if opts.verbose:
+        print("Check: %d files can be copied locally, %d of them renamed" %
+              (sum(1 for fh in new_needed if fh.local_copy_from is not None),
+               len(renamed)))
+
+    if renamed:
+        new_not_needed = get_hashlist(opts)
+        for fh in not_needed:
+            if fh.fpath not in renamed:
+                new_not_needed.append(fh)
+        not_needed = new_not_needed
+
+    return (new_needed, not_needed)
+
+
+def merge_by_path(src_hashlist, dst_hashlist):
+    '''
+    Walk two path-ordered hashlists together, generating (src_fh, dst_fh)
+    pairs in path order. If a path is only in one of the lists, the other
+    half of the pair is None.
+
+    If a path appears more than once in a list, only the last entry is
+    used, as it would be by a HashDict.
+    '''
+    src = _last_per_path(src_hashlist)
+    dst = _last_per_path(dst_hashlist)
+    s = next(src, None)
+    d = next(dst, None)
+
+    while s is not None or d is not None:
+        if d is None or (s is not None and s.fpath < d.fpath):
+            yield s, None
+            s = next(src, None)
+        elif s is None or d.fpath < s.fpath:
+            yield None, d
+            d = next(dst, None)
+        else:
+            yield s, d
+            s = next(src, None)
+            d = next(dst, None)
+
+
+def _is_included(fpath, exact, prefixes):
+    return fpath in exact or fpath.startswith(prefixes)
+
+
+def _include_sets(paths):
+    exact = set(p.rstrip(os.sep) for p in paths)
+    return (exact, tuple(p + os.sep for p in exact))
+
+
+def included_entries(hashlist, paths):
+    '''
+    Generate, in order, the entries of a path-ordered hashlist that are at
+    or under any of paths. If the hashlist can find subtrees itself (as an
+    MmapHashList can), only those entries are visited.
+    '''
+    if hasattr(hashlist, 'subtree_ranges'):
+        for (lo, hi) in hashlist.subtree_ranges(paths):
+            for fh in hashlist.entries(lo, hi):
+                yield fh
+        return
+
+    (exact, prefixes) = _include_sets(paths)
+    for fh in hashlist:
+        if _is_included(fh.fpath, exact, prefixes):
+            yield fh
+
+
+def _add_excluded_not_needed(not_needed, src_hashlist, dst_hashlist, paths,
+                             opts):
+    '''
+    Add to not_needed the destination entries that aren't at or under any
+    of paths, and that the source doesn't have. If the source can find
+    paths itself (as an MmapHashList can), its entries aren't decoded.
+    '''
+    if hasattr(src_hashlist, 'find'):
+        def src_has(fpath):
+            return src_hashlist.find(fpath) is not None
+    else:
+        src_paths = set(fh.fpath for fh in src_hashlist)
+        src_has = src_paths.__contains__
+
+    (exact, prefixes) = _include_sets(paths)
+    added = False
+    for dst_fh in _last_per_path(dst_hashlist):
+        fpath = dst_fh.fpath
+        if _is_included(fpath, exact, prefixes) or src_has(fpath):
+            continue
         filename = os.path.basename(fpath)
         if filename != '' and \
                 is_hashfile(filename, custom_hashfile=opts.hash_file,
                             guess_sigfiles=opts.guess_sigfiles):
-            log.debug("not_needed: skipping hash file or lock '%s'", filename)
             continue
+        log.debug("%s: not found in source", fpath)
+        not_needed.append(dst_fh)
+        added = True
 
-        if fpath not in src_fdict:
-            log.debug("%s: not found in source", fpath)
-            not_needed.append(fh)
+    if added:
+        not_needed.sort_by_path()
 
-    if opts.check_debug:
-        _check_debug(needed, not_needed)
 
-    return (needed, not_needed, dst_hashlist)
+def entries_outside(hashlist, prefixes):
+    '''
+    Generate, in order, the entries of a path-ordered hashlist whose paths
+    don't start with any of prefixes, which must be sorted and not start
+    with each other (see unchanged_prefixes()). If the hashlist can find
+    prefixes itself (as an MmapHashList can), the rest aren't visited.
+    '''
+    if hasattr(hashlist, 'prefix_range'):
+        lo = hashlist.start_pos
+        for prefix in prefixes:
+            (start, end) = hashlist.prefix_range(prefix)
+            for fh in hashlist.entries(lo, start):
+                yield fh
+            lo = max(lo, end)
+        for fh in hashlist.entries(lo, hashlist.end_pos):
+            yield fh
+        return
+
+    # Entries with a given prefix are all together, and come after the
+    # prefix itself.
+    n = 0
+    for fh in hashlist:
+        fpath = fh.fpath
+        while n < len(prefixes) and prefixes[n] < fpath and \
+                not fpath.startswith(prefixes[n]):
+            n += 1
+        if n < len(prefixes) and fpath.startswith(prefixes[n]):
+            continue
+        yield fh
+
+
+def _last_per_path(hashlist):
+    prev = None
+    for fh in hashlist:
+        if prev is not None and prev.fpath != fh.fpath:
+            yield prev
+        prev = fh
+    if prev is not None:
+        yield prev
 
 
 def _check_debug(needed, not_needed, outfile=sys.stderr):
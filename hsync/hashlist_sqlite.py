@@ -36,15 +36,127 @@ import tempfile
 
 from exceptions import *
 from filehash import FileHash
-from hashlist import HashList
+from hashlist import HashList, dir_prefix
 
 log = logging.getLogger()
 
+# Rows are buffered and written with executemany() in batches this size.
+INSERT_BATCH = 1000
+
+# Boolean FileHash attributes, stored as bits in the flags column. Any that
+# aren't set on the object have their bit set in the unset column instead.
+_FLAGS = (
+    'hash_safe', 'size_is_known', 'is_local_file', 'defer_read',
+    'has_read_contents', 'copy_by_creation', 'copy_by_copying',
+    'size_comparison_valid', 'is_file', 'is_dir', 'is_link', 'ignore',
+    'dest_missing', 'has_real_hash', 'link_normalised', 'link_is_external',
+    'contents_differ', 'metadata_differs', 'mtime_differs',
+    'local_copy_rename',
+)
+
+# Optional string attributes, NULL if not set.
+_OPTIONAL = ('link_target', 'link_relpath', 'local_copy_from')
+
+_COLUMNS = (
+    'strhash', 'path', 'digest', 'mode', 'uid', 'gid', 'mtime', 'size',
+    'type', 'user', 'grp', 'fullpath', 'link_target', 'link_relpath',
+    'local_copy_from', 'flags', 'unset', 'assoc',
+)
+
+_SCHEMA = ('seq integer primary key, strhash text, path text, digest, '
+           'mode integer, uid integer, gid integer, mtime integer, '
+           'size integer, type text, user text, grp text, fullpath text, '
+           'link_target text, link_relpath text, local_copy_from text, '
+           'flags integer, unset integer, assoc blob')
+
+_INSERT = 'insert into %%s (%s) values (%s)' % (
+    ', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS)))
+
+_SELECT = 'select %s from fh' % ', '.join(_COLUMNS)
+
+
+def _type_of(fh):
+    if fh.is_file:
+        return 'f'
+    elif fh.is_dir:
+        return 'd'
+    elif fh.is_link:
+        return 'l'
+    return '?'
+
+
+def _row_from_fh(fh, strhash):
+    flags = unset = 0
+    for n, name in enumerate(_FLAGS):
+        v = getattr(fh, name, None)
+        if v is None:
+            unset |= 1 << n
+        elif v:
+            flags |= 1 << n
+
+    digest = fh.digest
+    if digest is not None:
+        digest = sqlite3.Binary(digest)
+    else:
+        digest = fh.hashstr
+
+    # Only objects that need fetching carry one of these, so it's rare
+    # enough to pickle.
+    assoc = None
+    if fh.associated_dest_object is not None:
+        assoc = sqlite3.Binary(cPickle.dumps(fh.associated_dest_object,
+                                             cPickle.HIGHEST_PROTOCOL))
+
+    return (strhash, fh.fpath, digest, fh.mode, fh.uid, fh.gid, fh.mtime,
+            fh.size, _type_of(fh), fh.user, fh.group, fh.fullpath,
+            getattr(fh, 'link_target', None),
+            getattr(fh, 'link_relpath', None),
+            fh.local_copy_from, flags, unset, assoc)
+
+
+def _fh_from_row(row):
+    (strhash, path, digest, mode, uid, gid, mtime, size, ftype, user, group,
+     fullpath, link_target, link_relpath, local_copy_from, flags, unset,
+     assoc) = row
+
+    fh = FileHash()
+    fh.fpath = path
+    if isinstance(digest, buffer):
+        fh.digest = str(digest)
+    else:
+        fh.hashstr = digest
+    fh.mode = mode
+    fh.uid = uid
+    fh.gid = gid
+    fh.mtime = mtime
+    fh.size = size
+    fh.user = intern(user)
+    fh.group = intern(group)
+    fh.fullpath = fullpath
+    if link_target is not None:
+        fh.link_target = link_target
+    if link_relpath is not None:
+        fh.link_relpath = link_relpath
+    fh.local_copy_from = local_copy_from
+
+    for n, name in enumerate(_FLAGS):
+        bit = 1 << n
+        if not unset & bit:
+            setattr(fh, name, bool(flags & bit))
+
+    if assoc is not None:
+        fh.associated_dest_object = cPickle.loads(str(assoc))
+    fh.strhash_value = fh.hash_value = None
+    return fh
+
 
 class SqliteHashList(HashList):
     '''
     A disk-backed list of objects. Used when there are far more objects
     than can be comfortably stored in memory.
+
+    Each FileHash is stored as a row, in append order (seq). Appends are
+    buffered and written in batches, and sorting is done by sqlite.
     '''
 
     def __init__(self, *args, **kwargs):
@@ -56,12 +168,27 @@ class SqliteHashList(HashList):
         self.tmpname = tempfile.mktemp("", "hashlist.", self.tmpd)
         log.debug("Hashlist: open sqlite3 database on '%s'", self.tmpname)
         self.dbconn = sqlite3.connect(self.tmpname)
+        self.dbconn.text_factory = str
+        # The database is thrown away afterwards, so there's nothing to
+        # protect with a journal or fsync().
+        self.dbconn.execute("pragma journal_mode = off")
+        self.dbconn.execute("pragma synchronous = off")
 
         self.cur = self.dbconn.cursor()
-        self.cur.execute("create table fh (hash str, blob blob)")
-        self.cur.execute("create index fhindex on fh(hash)")
+        self._create_table('fh')
+
+        self.count = 0
+        self.indexed = False
+        self.pending = []
+        self.pending_hashes = set()
 
-        self.list = []
+    def _create_table(self, name):
+        self.cur.execute("create table %s (%s)" % (name, _SCHEMA))
+
+    def _create_indexes(self):
+        self.indexed = True
+        self.cur.execute("create index fh_strhash on fh(strhash)")
+        self.cur.execute("create index fh_path on fh(path)")
 
     def close(self, want_sync=False):
         log.debug("SqliteHashList.close()")
@@ -90,23 +217,32 @@ class SqliteHashList(HashList):
     def sync(self):
         if log.isEnabledFor(logging.DEBUG):
             log.debug("SqliteHashList.sync()")
+        self._flush()
         self.dbconn.commit()
 
-    def _insert(self, fh):
-        '''Insert the given filehash into the database.'''
-        pdata = cPickle.dumps(fh, cPickle.HIGHEST_PROTOCOL)
-        self.cur.execute('insert into fh (hash, blob) values (:hs, :blob)',
-                         {"hs": fh.strhash(), "blob": sqlite3.Binary(pdata)})
-
-    def _fetch(self, hashstr):
-        '''Retrieve filehashes with the given hashstr.'''
-        self.cur.execute('select (blob) from fh where hash = :hs',
-                         {"hs": hashstr})
-        fhlist = []
-        for row in self.cur:
-            fhlist.append(cPickle.loads(str(row[0])))
+    def _flush(self):
+        '''Write out any buffered rows.'''
+        if not self.pending:
+            return
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("SqliteHashList._flush(): %d rows", len(self.pending))
+        self.cur.executemany(_INSERT % 'fh', self.pending)
+        if not self.indexed:
+            # Index the table after the first batch, so it's built in one
+            # go rather than row by row.
+            self._create_indexes()
+        self.dbconn.commit()
+        self.pending = []
+        self.pending_hashes = set()
 
-        return fhlist
+    def _is_duplicate(self, strhash):
+        if strhash in self.pending_hashes:
+            return True
+        if not self.indexed:
+            return False  # Nothing written yet.
+        self.cur.execute('select 1 from fh where strhash = ? limit 1',
+                         (strhash,))
+        return self.cur.fetchone() is not None
 
     def append(self, fh):
         '''
@@ -118,31 +254,119 @@ class SqliteHashList(HashList):
             log.debug("SqliteHashList.append('%s') cursize %i", fh, len(self))
         strhash = fh.strhash()
         if self.raise_on_duplicates or self.warn_on_duplicates:
-            fhl = self._fetch(strhash)
-            if len(fhl) > 0:
+            if self._is_duplicate(strhash):
                 if self.raise_on_duplicates:
                     raise DuplicateEntryInHashListError()
                 if self.warn_on_duplicates:
                     log.warning("Duplicate entry for hash '%s' in "
                                 "SqliteHashList", strhash)
+            self.pending_hashes.add(strhash)
 
-        self._insert(fh)
-        self.list.append(strhash)
+        self.pending.append(_row_from_fh(fh, strhash))
+        self.count += 1
+        if len(self.pending) >= INSERT_BATCH:
+            self._flush()
+        self._note_path(fh)
         self.write_increment()
 
+    def __len__(self):
+        return self.count
+
     def __getitem__(self, index):
         if log.isEnabledFor(logging.DEBUG):
             log.debug("SqliteHashList.__getitem__[%i]", index)
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("SqliteHashList index out of range")
         self.read_total += 1
-        fh = self._fetch(self.list[index])
-        return fh[0]
+        self._flush()
+        self.cur.execute(_SELECT + ' where seq = ?', (index + 1,))
+        return _fh_from_row(self.cur.fetchone())
 
     def list_generator(self):
         if log.isEnabledFor(logging.DEBUG):
             log.debug("SqliteHashList.list_generator()")
-        for hashstr in self.list:
-            yield self._fetch(hashstr)[0]
+        self._flush()
+        # Use a cursor of our own, so lookups made while we're iterating
+        # don't disturb us.
+        for row in self.dbconn.execute(_SELECT + ' order by seq'):
+            yield _fh_from_row(row)
 
     def sort_by_path(self):
         '''Sort the hashlist by the FileHash.fpath field.'''
-        self.list.sort(key=lambda hashstr: self._fetch(hashstr)[0].fpath)
+        log.debug("SqliteHashList.sort_by_path()")
+        self._flush()
+        if self.count:
+            # Copy the rows into a new table in path order, so that seq
+            # (and so indexing) follows the new order.
+            self._create_table('fh_sorted')
+            self.cur.execute('insert into fh_sorted (%s) %s '
+                             'order by path, seq' %
+                             (', '.join(_COLUMNS), _SELECT))
+            self.cur.execute('drop table fh')
+            self.cur.execute('alter table fh_sorted rename to fh')
+            self._create_indexes()
+            self.dbconn.commit()
+        self._sorted()
+
+    def path_index(self):
+        self._flush()
+        return _SqlitePathIndex(self)
+
+    def children(self, dirname):
+        '''
+        Return a dict of the entries directly in directory dirname, keyed on
+        name, using the path index rather than reading the whole list. If a
+        path appears more than once, the last entry wins.
+        '''
+        self._flush()
+        prefix = dir_prefix(dirname)
+        query = _SELECT + ' where instr(substr(path, ?), ?) = 0'
+        args = (len(prefix) + 1, os.sep)
+        if prefix:
+            query += ' and path >= ? and path < ?'
+            args += (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+        children = {}
+        for row in self.dbconn.execute(query + ' order by seq', args):
+            name = row[1][len(prefix):]
+            if name:
+                children[name] = _fh_from_row(row)
+        return children
+
+
+class _SqlitePathIndex(object):
+    '''
+    Map paths to list indexes for a SqliteHashList using its path index,
+    rather than building the whole mapping in memory.
+    '''
+
+    def __init__(self, hashlist):
+        self.hl = hashlist
+
+    def _lookup(self, key):
+        cur = self.hl.dbconn.execute(
+            'select max(seq) from fh where path = ?', (key,))
+        seq = cur.fetchone()[0]
+        if seq is None:
+            return None
+        return seq - 1
+
+    def __getitem__(self, key):
+        index = self._lookup(key)
+        if index is None:
+            raise KeyError(key)
+        return index
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def iteritems(self):
+        for path, seq in self.hl.dbconn.execute(
+                'select path, max(seq) from fh group by path order by path'):
+            yield path, seq - 1
+
+    def iterkeys(self):
+        for path, index in self.iteritems():
+            yield path
@@ -30,7 +30,6 @@
 
 from __future__ import print_function
 
-import hashlib
 import logging
 import optparse
 import os.path
@@ -41,6 +40,8 @@ import urlparse
 from dest_impl import dest_side
 from exceptions import *
 from filehash import *
+from hashengine import (DEFAULT_DIGEST, UnknownDigestError, digest_names,
+                        engine as hash_engine)
 from idmapper import *
 from source_impl import source_side
 from stats import StatsCollector
@@ -58,6 +59,46 @@ def getopts(cmdargs):
                     help="Specify the source directory")
     send.add_option("-z", "--compress-signature", action="store_true",
                     help="Compress the signature file using zlib")
+    send.add_option("--digest", default=DEFAULT_DIGEST,
+                    help="Specify the digest algorithm for file contents, "
+                    "one of %s. The destination uses whichever the "
+                    "signature file names [default: %%default]" %
+                    ', '.join(digest_names()))
+    send.add_option("-b", "--binary-signature", action="store_true",
+                    help="Also write a binary signature file, which is much "
+                    "quicker for clients to load (see -B)")
+    send.add_option("-t", "--tree-signature", action="store_true",
+                    help="Also write a digest for each directory's subtree, "
+                    "so clients can skip unchanged directories (see -T)")
+    send.add_option("--chunk-signature", action="store_true",
+                    help="Also write digests of each chunk of large files, "
+                    "so clients can fetch just the chunks that have changed "
+                    "(see --remote-sig-chunks)")
+    send.add_option("--chunk-size", type="int", default=1024 * 1024,
+                    help="With --chunk-signature, the chunk size in bytes "
+                    "[default: %default]")
+    send.add_option("--chunk-min-size", type="int",
+                    default=16 * 1024 * 1024,
+                    help="With --chunk-signature, only files of at least "
+                    "this many bytes have chunk digests [default: %default]")
+    send.add_option("--incremental-scan", type="choice",
+                    choices=['stat', 'trust'],
+                    help="Don't list directories that haven't changed "
+                    "since the last scan. With 'stat', files in them are "
+                    "still checked for changes; with 'trust', they're taken "
+                    "from the signature file until the next full scan")
+    send.add_option("--watch", action="store_true",
+                    help="After the first scan, keep running and update the "
+                    "signature file as the source changes, using inotify "
+                    "(Linux only)")
+    send.add_option("--watch-delay", type="float", default=2.0,
+                    help="With --watch, wait until there have been no "
+                    "changes for this many seconds before updating the "
+                    "signature file [default: %default]")
+    send.add_option("--full-scan-interval", type="int", default=86400,
+                    help="With --incremental-scan, do a full scan if the "
+                    "last one was at least this many seconds ago "
+                    "[default: %default]")
     p.add_option_group(send)
 
     recv = optparse.OptionGroup(p, "Receive-side options")
@@ -74,14 +115,36 @@ def getopts(cmdargs):
     recv.add_option("--no-delete", action="store_true",
                     help="Never remove files from the destination, even if "
                     "they're not present on the source")
+    recv.add_option("--no-local-copy", action="store_true",
+                    help="Always fetch needed files, even if a file with "
+                    "the same contents is already on the destination")
     recv.add_option("-Z", "--remote-sig-compressed", action="store_true",
                     help="Fetch remote HSYNC.SIG.gz instead of HSYNC.SIG")
+    recv.add_option("-B", "--remote-sig-binary", action="store_true",
+                    help="Fetch remote HSYNC.SIG.bin instead of HSYNC.SIG")
+    recv.add_option("-T", "--remote-sig-tree", action="store_true",
+                    help="Fetch remote HSYNC.SIG.tree as well, and don't "
+                    "compare directories whose contents haven't changed")
+    recv.add_option("--remote-sig-chunks", action="store_true",
+                    help="Fetch remote HSYNC.SIG.chunks as well, and only "
+                    "fetch the chunks of large files that have changed")
     recv.add_option("--set-user",
                     help="Specify the owner for local files")
     recv.add_option("--set-group",
                     help="Specify the group for local files")
     recv.add_option("--no-write-hashfile", action="store_true",
                     help="Don't write a signature file after sync")
+    recv.add_option("--hash-cache", action="store_true",
+                    help="Keep a cache of file digests keyed on inode, size "
+                    "and times, to avoid reading files again")
+    recv.add_option("--checkpoint-files", type="int", default=1000,
+                    help="Make sure the signature journal is on disk after "
+                    "this many objects have been fetched "
+                    "[default: %default]")
+    recv.add_option("--checkpoint-bytes", type="int",
+                    default=64 * 1024 * 1024,
+                    help="Make sure the signature journal is on disk after "
+                    "this many bytes have been fetched [default: %default]")
     recv.add_option("--ignore-mode", action="store_true",
                     help="Ignore differences in file modes")
     recv.add_option("--http-user",
@@ -91,6 +154,9 @@ def getopts(cmdargs):
     recv.add_option("--http-auth-type", default='basic',
                     help="Specify HTTP auth type (basic|digest) "
                     "[default: %default]")
+    recv.add_option("--no-http-keepalive", action="store_true",
+                    help="Use a new connection for every HTTP request, "
+                    "rather than reusing connections")
     recv.add_option("--proxy-url",
                     help="Specify the proxy URL to use")
     recv.add_option("--proxy-user",
@@ -139,7 +205,15 @@ def getopts(cmdargs):
                     help="Specify the number of bytes to retrieve at a time "
                     "[default: %default]")
     meta.add_option("--use-less-memory", action="store_true",
-                    help="Use far less memory but run MUCH more slowly")
+                    help="Keep file lists on disk rather than in memory")
+    meta.add_option("-j", "--jobs", type="int", default=1,
+                    help="Specify the number of files to fetch or hash at "
+                    "the same time [default: %default]")
+    meta.add_option("--max-inflight-bytes", type="int",
+                    default=64 * 1024 * 1024,
+                    help="With --jobs, limit the total size of the files "
+                    "being fetched at once. A single larger file is still "
+                    "fetched on its own [default: %default]")
 
     # This kludge is used to pass stats around the app.
     meta.add_option("--stats", help=optparse.SUPPRESS_HELP)
@@ -189,6 +263,19 @@ def init_stats():
         'directory_metadata_differed',
         'link_contents_differed',
         'link_metadata_differed',
+        'file_local_copies',
+        'file_local_renames',
+        'file_fetches_resumed',
+        'file_delta_fetches',
+        'delta_bytes_reused',
+
+        # Filesystem scan.
+        'stat_calls',
+        'stat_calls_saved',
+
+        # HTTP connection reuse.
+        'http_connections_opened',
+        'http_connections_reused',
 
     ]
     return StatsCollector.init('AppStats', stattr)
@@ -234,15 +321,43 @@ def main(cmdargs):
         log.error("Send-side and receive-side options can't be mixed")
         return False
 
-    if log.isEnabledFor(logging.DEBUG):
-        log.debug("hashlib.algorithms: %s", hashlib.algorithms)
+    log.debug("Available digest algorithms: %s", digest_names())
 
-    if 'sha256' not in hashlib.algorithms:
-        log.error("No SHA256 implementation in hashlib!")
+    try:
+        hash_engine.use_digest(opt.digest)
+    except UnknownDigestError as e:
+        log.error("--digest: %s", e)
         return False
 
+    if opt.jobs < 1:
+        log.error("--jobs must be at least 1")
+        return False
+
+    if opt.watch_delay < 0:
+        log.error("--watch-delay can't be negative")
+        return False
+
+    if opt.full_scan_interval < 0:
+        log.error("--full-scan-interval can't be negative")
+        return False
+
+    if opt.chunk_size < 1 or opt.chunk_min_size < 1:
+        log.error("--chunk-size and --chunk-min-size must be at least 1")
+        return False
+
+    if opt.checkpoint_files < 1 or opt.checkpoint_bytes < 1:
+        log.error("--checkpoint-files and --checkpoint-bytes must be at "
+                  "least 1")
+        return False
+
+    # Chunk digests are only wanted for the source side's chunk file.
+    if opt.source_dir and opt.chunk_signature:
+        hash_engine.record_chunks(opt.chunk_size, opt.chunk_min_size)
+    else:
+        hash_engine.record_chunks(None, None)
+
     if opt.use_less_memory:
-        print("NOTE: --use-less-memory mode is much slower, and consumes "
+        print("NOTE: --use-less-memory mode is slower, and consumes "
               "more disk I/O")
 
     # Send-side.
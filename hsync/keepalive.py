@@ -0,0 +1,224 @@
+# HTTP keep-alive connection pooling for urllib2.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import httplib
+import logging
+import socket
+import threading
+import urllib2
+
+log = logging.getLogger()
+
+
+class ConnectionPool(object):
+    '''
+    Thread-safe store of idle HTTP connections, keyed by (connection class,
+    host, tunnel host).
+
+    If stats is given (a StatsCollector with http_connections_opened and
+    http_connections_reused attributes), connection use is counted there.
+    '''
+
+    def __init__(self, stats=None):
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, key):
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop()
+        return None
+
+    def put(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def close_all(self):
+        with self.lock:
+            for conns in self.idle.itervalues():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+    def count(self, name):
+        if self.stats is not None:
+            self.stats.incr(name)
+
+
+class PooledHTTPResponse(httplib.HTTPResponse):
+    '''
+    An HTTPResponse that hands its connection back to the pool when it's
+    closed, but only if the body was read to the end and the server is
+    prepared to keep the connection open.
+    '''
+
+    _in_read = False
+    _release = None
+
+    def read(self, amt=None):
+        # httplib closes the response itself as soon as it has read the
+        # end of the body. That's the only time it's safe to reuse the
+        # connection.
+        self._in_read = True
+        try:
+            return httplib.HTTPResponse.read(self, amt)
+        finally:
+            self._in_read = False
+
+    def close(self):
+        complete = self._in_read
+        httplib.HTTPResponse.close(self)
+        if self._release is not None:
+            release = self._release
+            self._release = None
+            release(complete and not self.will_close)
+
+
+class _KeepAliveMixin(object):
+
+    def __init__(self, pool=None, debuglevel=0):
+        self._pool = pool if pool is not None else ConnectionPool()
+        self._debuglevel = debuglevel
+
+    def do_open(self, http_class, req, **http_conn_args):
+        '''
+        Like urllib2.AbstractHTTPHandler.do_open(), but without forcing
+        'Connection: close', and using pooled connections where we can.
+        '''
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        tunnel_headers = {}
+        if req._tunnel_host:
+            proxy_auth_hdr = "Proxy-Authorization"
+            if proxy_auth_hdr in headers:
+                tunnel_headers[proxy_auth_hdr] = headers.pop(proxy_auth_hdr)
+
+        key = (http_class, host, req._tunnel_host)
+
+        r = None
+        conn = self._pool.get(key)
+        if conn is not None:
+            try:
+                r = self._request(conn, req, headers)
+                self._pool.count('http_connections_reused')
+            except (httplib.HTTPException, socket.error) as e:
+                # The server probably timed out the idle connection. Try
+                # again on a new one, if that's safe.
+                conn.close()
+                if req.get_method() not in ('GET', 'HEAD'):
+                    raise urllib2.URLError(e)
+                log.debug("Reused connection to '%s' failed (%s), "
+                          "reconnecting", host, e)
+                r = None
+
+        if r is None:
+            conn = http_class(host, timeout=req.timeout, **http_conn_args)
+            conn.set_debuglevel(self._debuglevel)
+            if req._tunnel_host:
+                conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            try:
+                r = self._request(conn, req, headers)
+            except socket.error as e:
+                conn.close()
+                raise urllib2.URLError(e)
+            self._pool.count('http_connections_opened')
+
+        pool = self._pool
+
+        def release(reusable):
+            if reusable and conn.sock is not None:
+                pool.put(key, conn)
+            else:
+                conn.close()
+
+        r._release = release
+
+        # This is what urllib2 does with the response.
+        r.recv = r.read
+        fp = socket._fileobject(r, close=True)
+
+        resp = urllib2.addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+    def _request(self, conn, req, headers):
+        conn.response_class = PooledHTTPResponse
+        conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        return conn.getresponse(buffering=True)
+
+
+class KeepAliveHTTPHandler(_KeepAliveMixin, urllib2.HTTPHandler):
+    '''
+    urllib2 handler that reuses persistent HTTP/1.1 connections. Passing
+    this to urllib2.build_opener() replaces the default HTTPHandler.
+    '''
+
+    def __init__(self, pool=None, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        _KeepAliveMixin.__init__(self, pool, debuglevel)
+
+    def http_open(self, req):
+        return self.do_open(httplib.HTTPConnection, req)
+
+
+# Only available if Python was built with SSL support.
+if hasattr(httplib, 'HTTPS'):
+
+    class KeepAliveHTTPSHandler(_KeepAliveMixin, urllib2.HTTPSHandler):
+        '''
+        HTTPS version of KeepAliveHTTPHandler. Reusing a connection also saves
+        the TLS handshake.
+        '''
+
+        def __init__(self, pool=None, debuglevel=0, context=None):
+            urllib2.HTTPSHandler.__init__(self, debuglevel, context)
+            _KeepAliveMixin.__init__(self, pool, debuglevel)
+
+        def https_open(self, req):
+            return self.do_open(httplib.HTTPSConnection, req,
+                                context=self._context)
+
+
+def keepalive_handlers(pool):
+    '''
+    Return a list of keep-alive handlers sharing pool, for
+    urllib2.build_opener().
+    '''
+    handlers = [KeepAliveHTTPHandler(pool)]
+    if hasattr(httplib, 'HTTPS'):
+        handlers.append(KeepAliveHTTPSHandler(pool))
+    return handlers
@@ -0,0 +1,294 @@
+# Binary signature file format.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''
+The binary signature file (HSYNC.SIG.bin) holds the same entries as the
+text one, in the same (path) order, laid out so they can be read without
+any parsing:
+
+    header      magic, version, digest algorithm, entry count, section
+                offsets and lengths, and the FINAL digest.
+    records     one fixed-width record per entry, with the numeric fields
+                packed and the strings given as offsets into...
+    strings     the paths and symlink targets, back to back.
+    names       the user and group names, NUL-separated. Records refer to
+                them by index.
+
+All integers are little-endian. Since the records are in path order, they
+double as a sorted index: find() does a binary search on them.
+'''
+
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from exceptions import *
+from filehash import FileHash
+from hashengine import (DEFAULT_DIGEST, DIGEST_IDS, UnknownDigestError,
+                        check_digest, new_digest)
+
+log = logging.getLogger()
+
+MAGIC = 'HSYNCBIN'
+VERSION = 1
+
+# magic, version, digest algorithm (see hashengine.DIGEST_IDS), count,
+# strings_off, strings_len, names_off, names_len, final digest.
+_HEADER = struct.Struct('<8sHHQQQQQ32s')
+
+# digest, size, mtime, mode, user index, group index, path offset,
+# path length, link target offset, link target length.
+_RECORD = struct.Struct('<32sQqIHHQIQI')
+
+# Just the path offset and length, for find().
+_RECORD_PATH = struct.Struct('<QI')
+_RECORD_PATH_OFFSET = struct.calcsize('<32sQqIHH')
+
+_MAX_NAMES = 0xffff
+
+
+class BadSigBinFormatError(Exception):
+    pass
+
+
+class SigBinWriter(object):
+    '''
+    Write a binary signature file. Call add() for each FileHash, in path
+    order, then close() with the FINAL digest.
+    '''
+
+    def __init__(self, path, digest_name=DEFAULT_DIGEST):
+        self.digest_id = DIGEST_IDS[digest_name]
+        self.f = open(path, 'wb')
+        self.f.write('\0' * _HEADER.size)
+        # The strings go at the end, so collect them separately.
+        self.strings = tempfile.TemporaryFile(prefix='hsync-sigbin.',
+                                              dir=os.path.dirname(path))
+        self.strings_len = 0
+        self.count = 0
+        self.name_index = {}
+        self.names = []
+
+    def _name(self, name):
+        n = self.name_index.get(name)
+        if n is None:
+            if len(self.names) > _MAX_NAMES:
+                raise BadSigBinFormatError("Too many user and group names")
+            n = self.name_index[name] = len(self.names)
+            self.names.append(name)
+        return n
+
+    def _string(self, s):
+        off = self.strings_len
+        self.strings.write(s)
+        self.strings_len += len(s)
+        return off
+
+    def add(self, fh):
+        digest = fh.digest
+        if digest is None:
+            raise BadSigBinFormatError("'%s': no digest for binary "
+                                       "signature" % fh.fpath)
+
+        if fh.is_link:
+            target = fh.link_target
+        else:
+            target = ''
+
+        self.f.write(_RECORD.pack(
+            digest, fh.size, fh.mtime, fh.mode,
+            self._name(fh.user), self._name(fh.group),
+            self._string(fh.fpath), len(fh.fpath),
+            self._string(target), len(target)))
+        self.count += 1
+
+    def close(self, final):
+        '''
+        Finish off the file. final is the FINAL hex digest, as written to
+        the text signature.
+        '''
+        strings_off = _HEADER.size + self.count * _RECORD.size
+        self.strings.seek(0)
+        shutil.copyfileobj(self.strings, self.f)
+        self.strings.close()
+
+        names = '\0'.join(self.names)
+        names_off = strings_off + self.strings_len
+        self.f.write(names)
+
+        self.f.seek(0)
+        self.f.write(_HEADER.pack(MAGIC, VERSION, self.digest_id,
+                                  self.count, strings_off, self.strings_len,
+                                  names_off, len(names),
+                                  final.decode('hex')))
+        self.f.close()
+
+
+class SigBinReader(object):
+    '''
+    Read a binary signature file through mmap. f must be a real file.
+
+    The FINAL digest in the header is checked against the records when the
+    file is opened, and TruncatedHashfileError is raised if they don't
+    agree, as for a text file without its 'FINAL:' line.
+    '''
+
+    def __init__(self, f, name='hashfile'):
+        size = os.fstat(f.fileno()).st_size
+        if size < _HEADER.size:
+            raise TruncatedHashfileError("%s is too short to be a binary "
+                                         "signature" % name)
+        self.m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, digest_id, self.count,
+         self.strings_off, strings_len,
+         names_off, names_len, final) = _HEADER.unpack_from(self.m)
+        if magic != MAGIC:
+            raise BadSigBinFormatError("%s is not a binary signature" % name)
+        if version != VERSION:
+            raise BadSigBinFormatError("%s: unsupported binary signature "
+                                       "version %d" % (name, version))
+        if names_off + names_len != size or \
+                self.strings_off != _HEADER.size + self.count * _RECORD.size:
+            raise TruncatedHashfileError("%s appears to be truncated" % name)
+
+        for (digest_name, n) in DIGEST_IDS.iteritems():
+            if n == digest_id:
+                check_digest(digest_name)
+                self.digest_name = digest_name
+                break
+        else:
+            raise UnknownDigestError("%s: unknown digest algorithm %d" %
+                                     (name, digest_id))
+
+        self.final = final.encode('hex')
+        if names_len:
+            self.names = self.m[names_off:names_off + names_len].split('\0')
+        else:
+            self.names = []
+        # uids and gids for the names, by name index, as they're needed.
+        self.uids = {}
+        self.gids = {}
+
+        try:
+            final_ok = (self._final() == self.final)
+        except (IndexError, struct.error):
+            final_ok = False
+        if not final_ok:
+            self.m.close()
+            raise TruncatedHashfileError("FINAL digest of %s doesn't match "
+                                         "its entries" % name)
+
+    def _final(self):
+        '''
+        Work out the FINAL digest from the records, as sigfile_write() does
+        for the text file, from each entry's FileHash.sha_hash().
+        '''
+        md = new_digest(self.digest_name)
+        names = self.names
+        for n in xrange(self.count):
+            (digest, size, mtime, mode, user, group,
+             path_off, path_len, target_off, target_len) = self._record(n)
+            off = self.strings_off + path_off
+            sha = new_digest(self.digest_name)
+            sha.update(self.m[off:off + path_len])
+            sha.update(str(mode))
+            sha.update(names[user])
+            sha.update(names[group])
+            sha.update(digest.encode('hex'))
+            md.update(sha.hexdigest())
+        return md.hexdigest()
+
+    def close(self):
+        self.m.close()
+
+    def __len__(self):
+        return self.count
+
+    def _record(self, n):
+        return _RECORD.unpack_from(self.m, _HEADER.size + n * _RECORD.size)
+
+    def path(self, n):
+        (path_off, path_len) = _RECORD_PATH.unpack_from(
+            self.m, _HEADER.size + n * _RECORD.size + _RECORD_PATH_OFFSET)
+        off = self.strings_off + path_off
+        return self.m[off:off + path_len]
+
+    def find(self, path):
+        '''
+        Return the index of the entry for path, or None.
+        '''
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.path(mid) < path:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.path(lo) == path:
+            return lo
+        return None
+
+    def filehash(self, n, trim=False, root=''):
+        '''
+        Return a FileHash for entry n.
+        '''
+        (digest, size, mtime, mode, user, group,
+         path_off, path_len, target_off, target_len) = self._record(n)
+
+        m = self.m
+        off = self.strings_off + path_off
+        fpath = m[off:off + path_len]
+        link_target = None
+        if target_len:
+            off = self.strings_off + target_off
+            link_target = m[off:off + target_len]
+
+        uid = self.uids.get(user)
+        if uid is None:
+            uid = self.uids[user] = \
+                FileHash.mapper.get_uid_for_name(self.names[user])
+        gid = self.gids.get(group)
+        if gid is None:
+            gid = self.gids[group] = \
+                FileHash.mapper.get_gid_for_group(self.names[group])
+
+        return FileHash.init_from_fields(
+            None, mode, self.names[user], self.names[group], mtime, size,
+            fpath, link_target, trim=trim, root=root, uid=uid, gid=gid,
+            digest=digest)
+
+    def filehashes(self, trim=False, root=''):
+        '''
+        Generate a FileHash for every entry, in path order.
+        '''
+        for n in xrange(self.count):
+            yield self.filehash(n, trim, root)
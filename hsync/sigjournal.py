@@ -0,0 +1,152 @@
+# Destination signature journal.
+
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''
+While a fetch runs, the entries it changes are appended to a journal
+alongside the destination's signature file (HSYNC.SIG.journal), in the
+signature file's line format. If the run is interrupted, the next one reads
+the journal after the signature file, so the files that were fetched don't
+need to be read again to be recognised.
+
+The journal is flushed to disk every so many files or bytes fetched, and
+removed once a complete signature file has been written. Like a signature
+file, it starts with a header naming the digest algorithm.
+'''
+
+import logging
+import os
+
+from hashengine import DEFAULT_DIGEST, digest_header
+
+log = logging.getLogger()
+
+JOURNAL_SUFFIX = '.journal'
+
+
+class SigJournal(object):
+    '''
+    An append-only journal of destination entries. It's only created when
+    the first entry is added.
+    '''
+
+    def __init__(self, path, checkpoint_files, checkpoint_bytes,
+                 digest_name=DEFAULT_DIGEST):
+        self.path = path
+        self.digest_name = digest_name
+        self.checkpoint_files = checkpoint_files
+        self.checkpoint_bytes = checkpoint_bytes
+        self.checkpoints = 0
+        self._f = None
+        self._files = 0
+        self._bytes = 0
+
+    def add(self, fh, nbytes=0):
+        '''
+        Record fh, which describes an object as it now is on the
+        destination. nbytes is the amount of data fetched for it.
+        '''
+        if self._f is None:
+            log.debug("Opening signature journal '%s'", self.path)
+            self._f = open(self.path, 'ab')
+            if os.fstat(self._f.fileno()).st_size == 0 and \
+                    self.digest_name != DEFAULT_DIGEST:
+                self._f.write(digest_header(self.digest_name) + '\n')
+
+        self._f.write(fh.presentation_format() + '\n')
+        self._files += 1
+        self._bytes += nbytes
+        if self._files >= self.checkpoint_files or \
+                self._bytes >= self.checkpoint_bytes:
+            self.checkpoint()
+
+    def checkpoint(self):
+        '''Make sure everything added so far is on disk.'''
+        if self._f is None:
+            return
+        log.debug("Checkpointing signature journal '%s'", self.path)
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self.checkpoints += 1
+        self._files = 0
+        self._bytes = 0
+
+    def close(self):
+        if self._f is not None:
+            self.checkpoint()
+            self._f.close()
+            self._f = None
+
+    def remove(self):
+        '''Close and remove the journal, as a signature file covers it.'''
+        self.close()
+        remove_journal(self.path)
+
+
+def journal_lines(path):
+    '''
+    Return the lines of the journal at path, without line endings. A last
+    line that was only partly written is ignored. If there's no journal,
+    return an empty list.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return []
+
+    lines = data.split('\n')
+    # The last element is either empty or an incomplete line.
+    if lines[-1]:
+        log.debug("Ignoring incomplete last line of journal '%s'", path)
+    return lines[:-1]
+
+
+def with_journal(sig_lines, journal):
+    '''
+    Generate the lines of a signature file followed by those of its
+    journal. A HashList won't take the same entry twice, so lines that are
+    repeated later on are left out. Comments, such as the digest headers,
+    are all kept.
+    '''
+    last = {}
+    for n, l in enumerate(journal):
+        last[l] = n
+
+    for l in sig_lines:
+        if l.startswith('#') or l not in last:
+            yield l
+    for n, l in enumerate(journal):
+        if l.startswith('#') or last[l] == n:
+            yield l
+
+
+def remove_journal(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
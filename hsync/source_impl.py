@@ -27,18 +27,22 @@
 
 from __future__ import print_function
 
-import gzip
 import logging
 import os
-import tempfile
+from random import SystemRandom
 import urlparse
 
-from fetch import fetch_contents
+from chunksig import CHUNKS_SUFFIX, chunk_file_write, chunks_from_lines
+from dirstate import DirState, IncrementalListing
+from fetch import fetch_lines
 from filehash import *
+from hashengine import UnknownDigestError, engine as hash_engine
 from hashlist_op_impl import (hashlist_generate, sigfile_write,
                               hashlist_from_stringlist)
+from inotify import InotifyUnavailableError, InotifyWatchError
 from lockfile import LockFileManager
 from utility import cano_url
+from watch import SourceWatcher
 
 log = logging.getLogger()
 
@@ -80,6 +84,8 @@ def source_side(opt, args):
 
     # Generate the new hashfile.
     with LockFileManager(abs_lockfile):
+        if opt.watch:
+            return source_watch(abs_hashfile, opt)
         return source_generate(abs_hashfile, opt)
 
 
@@ -89,26 +95,31 @@ def source_generate(abs_hashfile, opt):
     signatures to speed up the process.
     '''
 
-    existing_hl = None
+    existing_hl = _read_existing(abs_hashfile, opt)
 
-    if not opt.always_checksum and os.path.exists(abs_hashfile):
-        if not opt.quiet:
-            print("Reading existing hashfile")
-
-        existing_hl = _read_hashlist(abs_hashfile, opt)
+    listing = None
+    if opt.incremental_scan:
+        dirs_path = _sidecar_hashfile(abs_hashfile, '.dirs', opt)
+        state = None
+        if existing_hl is not None:
+            state = DirState.load(dirs_path, abs_hashfile)
+        listing = IncrementalListing(opt.source_dir, opt, state=state,
+                                     existing_hashlist=existing_hl)
+        if not opt.quiet and listing.full_scan:
+            print("Incremental scan: doing a full scan")
 
     hashlist = hashlist_generate(opt.source_dir, opt,
-                                 existing_hashlist=existing_hl)
+                                 existing_hashlist=existing_hl,
+                                 listing=listing)
 
     if hashlist is not None:
 
-        write_success = sigfile_write(hashlist, abs_hashfile, opt,
-                                      use_tmp=True)
-        if not write_success:
-            log.error("Failed to write signature file '%s'",
-                      os.path.join(opt.source_dir, opt.hash_file))
+        if not _write_signature(hashlist, abs_hashfile, opt):
             return False
 
+        if listing is not None:
+            listing.new.save(dirs_path, abs_hashfile)
+
         return True
 
     else:
@@ -116,6 +127,106 @@ def source_generate(abs_hashfile, opt):
         return False
 
 
+def source_watch(abs_hashfile, opt):
+    '''
+    Generate the signature, then keep it up to date as the local
+    filesystem changes, until interrupted.
+    '''
+
+    existing_hl = _read_existing(abs_hashfile, opt)
+
+    def write_signature(hashlist):
+        if not _write_signature(hashlist, abs_hashfile, opt):
+            raise OSOperationFailedError("Failed to write signature file "
+                                         "'%s'" % abs_hashfile)
+
+    watcher = SourceWatcher(opt.source_dir, opt, write_signature)
+    if not opt.quiet:
+        print("Watching '%s' for changes" % opt.source_dir)
+    try:
+        return watcher.run(existing_hashlist=existing_hl)
+    except (InotifyUnavailableError, InotifyWatchError) as e:
+        log.error("Can't watch for changes: %s", e)
+        return False
+
+
+def _read_existing(abs_hashfile, opt):
+    '''
+    Read the existing signature file, if there is one and we're allowed to
+    use it.
+    '''
+    if opt.always_checksum or not os.path.exists(abs_hashfile):
+        return None
+
+    if not opt.quiet:
+        print("Reading existing hashfile")
+    try:
+        hashlist = _read_hashlist(abs_hashfile, opt)
+    except UnknownDigestError as e:
+        log.warn("Ignoring existing hashfile: %s", e)
+        return None
+
+    # Digests made with another algorithm are no use to us.
+    if hashlist is not None and \
+            hashlist.digest_name != hash_engine.digest_name:
+        if not opt.quiet:
+            print("Existing hashfile has a different digest algorithm, "
+                  "ignoring it")
+        hashlist.close()
+        return None
+    return hashlist
+
+
+def _write_signature(hashlist, abs_hashfile, opt):
+    '''
+    Write the signature file, and any sidecar files we've been asked for.
+    '''
+    binary_path = None
+    if opt.binary_signature:
+        binary_path = _sidecar_hashfile(abs_hashfile, '.bin', opt)
+
+    tree_path = None
+    if opt.tree_signature:
+        tree_path = _sidecar_hashfile(abs_hashfile, '.tree', opt)
+
+    if not sigfile_write(hashlist, abs_hashfile, opt, use_tmp=True,
+                         binary_path=binary_path, tree_path=tree_path):
+        log.error("Failed to write signature file '%s'",
+                  os.path.join(opt.source_dir, opt.hash_file))
+        return False
+
+    if opt.chunk_signature:
+        _write_chunks(hashlist,
+                      _sidecar_hashfile(abs_hashfile, CHUNKS_SUFFIX, opt),
+                      opt)
+    return True
+
+
+def _write_chunks(hashlist, chunks_path, opt):
+    '''
+    Write the chunk file, reusing what we can from the last one.
+    '''
+    old = None
+    if os.path.exists(chunks_path):
+        try:
+            with open(chunks_path) as f:
+                old = chunks_from_lines((l.rstrip('\n') for l in f),
+                                        name="chunk file %s" % chunks_path)
+        except (IOError, ValueError, TypeError, HashStringFormatError,
+                TruncatedHashfileError, UnknownDigestError) as e:
+            log.warn("Ignoring existing chunk file: %s", e)
+
+    if not opt.quiet:
+        print("Generating chunk file %s" % chunks_path)
+    chunks_path_tmp = chunks_path + ".%08x" % \
+        SystemRandom().randint(0, 0xffffffff)
+    chunk_file_write(hashlist, chunks_path_tmp, opt.source_dir,
+                     opt.chunk_size, opt.chunk_min_size, old=old)
+    log.debug("Moving chunk file into place: '%s' -> '%s'",
+              chunks_path_tmp, chunks_path)
+    os.rename(chunks_path_tmp, chunks_path)
+
+
 def _generate_hashfile_url(opt):
 
     abs_hashfile = None
@@ -143,21 +254,25 @@ def _generate_hashfile_url(opt):
     return abs_hashfile
 
 
-def _read_hashlist(abs_hashfile, opt):
-    # Fetch the signature file.
-    hashfile_contents = fetch_contents('file://' + abs_hashfile, opt,
-                                       short_name=opt.hash_file)
-
-    if opt.compress_signature:
-        gziptmp = tempfile.NamedTemporaryFile()
-        with gziptmp:
-            gziptmp.file.write(hashfile_contents)
-            gziptmp.file.close()
-            strfile = []
-            for l in gzip.open(gziptmp.name):
-                strfile.append(l.rstrip())
+def _sidecar_hashfile(abs_hashfile, suffix, opt):
+    '''
+    The binary signature, subtree and directory state files live next to
+    the text signature, with suffix in place of any '.gz'.
+    '''
+    if opt.compress_signature and abs_hashfile.endswith('.gz'):
+        abs_hashfile = abs_hashfile[:-len('.gz')]
+    return abs_hashfile + suffix
 
-    else:
-        strfile = hashfile_contents.splitlines()
+
+def _read_hashlist(abs_hashfile, opt):
+    '''
+    Read an existing signature file, decompressing and parsing the lines as
+    they're read.
+    '''
+    strfile = fetch_lines('file://' + abs_hashfile, opt,
+                          compressed=opt.compress_signature,
+                          short_name=opt.hash_file)
+    if strfile is None:
+        return None
 
     return hashlist_from_stringlist(strfile, opt, root=opt.source_dir)
@@ -26,6 +26,7 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import logging
+import threading
 
 log = logging.getLogger()
 
@@ -44,6 +45,7 @@ class StatsCollector(object):
 
     def __init__(self, name, attrlist):
         self.__name = name
+        self._lock = threading.Lock()
         self.set_attributes(attrlist)
         self._freeze()
 
@@ -80,6 +82,16 @@ class StatsCollector(object):
         for k in self.keys():
             yield k, getattr(self, k)
 
+    def incr(self, name, value=1):
+        '''
+        Add value to the named attribute and return the new value. Safe to
+        call from several threads at once, unlike '+='.
+        '''
+        with self._lock:
+            newval = getattr(self, name) + value
+            setattr(self, name, newval)
+        return newval
+
     def set_attributes(self, attrlist):
         '''
         Change the current attribute list to attrlist. Add new keys and
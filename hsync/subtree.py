@@ -0,0 +1,159 @@
+# Per-directory subtree digests.
+
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''
+A subtree digest covers everything under a directory: the signature lines
+of the entries directly in it, and the subtree digests of the directories
+below it. If a directory's digest is the same on both sides, so is
+everything under it, and there's no need to look at the entries.
+
+The subtree file (HSYNC.SIG.tree) holds one '<digest> <dirpath>' line per
+directory, in path order, followed by a 'FINAL:' line. The top directory
+has the empty path.
+'''
+
+import logging
+import os
+
+from exceptions import *
+from hashengine import DEFAULT_DIGEST, new_digest
+
+log = logging.getLogger()
+
+
+class SubtreeHasher(object):
+    '''
+    Accumulate subtree digests. Call add() for each entry, in path order,
+    then digests() once.
+
+    Subtree digests are always SHA-256, whatever --digest is, as the
+    subtree file has no header to say otherwise. The signature lines they
+    cover still carry --digest digests.
+    '''
+
+    def __init__(self):
+        self.hashers = {}
+
+    def _hasher(self, dirpath):
+        md = self.hashers.get(dirpath)
+        if md is None:
+            md = self.hashers[dirpath] = new_digest(DEFAULT_DIGEST)
+            # Make sure every parent has a digest to fold this one into.
+            parent = os.path.dirname(dirpath)
+            if parent != dirpath and parent not in self.hashers:
+                self._hasher(parent)
+        return md
+
+    def add(self, fh, line=None):
+        '''
+        Add an entry. line is its signature line, if the caller already
+        has it.
+        '''
+        if fh.is_dir:
+            # Directory mtimes and sizes aren't kept in step on the
+            # destination, so leave them out.
+            line = "%s %06o %s %s %s" % (fh.hashstr, fh.mode, fh.user,
+                                         fh.group, fh.fpath)
+        elif line is None:
+            line = fh.presentation_format()
+        self._hasher(os.path.dirname(fh.fpath)).update(line + '\n')
+
+    def digests(self):
+        '''
+        Return a dict of hex subtree digests, keyed on directory path.
+        '''
+        result = {}
+        # Children have longer paths than their parents, so they're always
+        # finished first.
+        for dirpath in sorted(self.hashers, key=lambda d: (-len(d), d)):
+            digest = self.hashers[dirpath].hexdigest()
+            result[dirpath] = digest
+            parent = os.path.dirname(dirpath)
+            if parent != dirpath:
+                self.hashers[parent].update("%s %s\n" % (digest, dirpath))
+        self.hashers = None
+        return result
+
+
+def subtree_digests(hashlist):
+    '''
+    Return the subtree digests for a path-ordered hashlist.
+    '''
+    hasher = SubtreeHasher()
+    for fh in hashlist:
+        hasher.add(fh)
+    return hasher.digests()
+
+
+def subtree_file_write(digests, path):
+    log.debug("Writing subtree file '%s'", path)
+    with open(path, 'w') as f:
+        for dirpath in sorted(digests):
+            f.write("%s %s\n" % (digests[dirpath], dirpath))
+        f.write("FINAL: %s\n" % digests.get('', ''))
+
+
+def subtree_digests_from_lines(lines, name='subtree file'):
+    '''
+    Read subtree digests from the lines of a subtree file, without line
+    endings.
+    '''
+    digests = {}
+    final_seen = False
+    for l in lines:
+        final_seen = False
+        if l.startswith('#'):
+            pass  # FFR
+        elif l.startswith('FINAL:'):
+            final_seen = True
+        else:
+            (digest, dirpath) = l.split(' ', 1)
+            digests[dirpath] = digest
+
+    if not final_seen:
+        raise TruncatedHashfileError("'FINAL:' line of %s appears "
+                                     "to be missing!" % name)
+    return digests
+
+
+def unchanged_prefixes(src_digests, dst_digests):
+    '''
+    Return a sorted list of the path prefixes of the directories whose
+    subtree digests match, leaving out those already under another one.
+    The top directory's prefix is '', which covers everything.
+    '''
+    prefixes = sorted((d + os.sep if d else '')
+                      for (d, digest) in src_digests.iteritems()
+                      if dst_digests.get(d) == digest)
+    # Everything starting with a prefix sorts straight after it.
+    result = []
+    for prefix in prefixes:
+        if result and prefix.startswith(result[-1]):
+            continue
+        result.append(prefix)
+    return result
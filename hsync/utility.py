@@ -28,6 +28,7 @@
 import fnmatch
 import logging
 import os
+import re
 import urlparse
 
 from hashlist import HashList
@@ -89,8 +90,8 @@ def dumpframe(header="", depth=4):
 def get_hashlist(opts):
     '''
     If the user asks to reduce memory use, return a disk-backed HashList
-    object, which will obviously run much more slowly than the default
-    memory-backed HashList object.
+    object, which will run more slowly than the default memory-backed
+    HashList object.
     '''
 
     if opts.use_less_memory:
@@ -100,6 +101,139 @@ def get_hashlist(opts):
         log.debug("get_hashlist(): Returning memory-backed hashlist object")
         return HashList()
 
+#
+# Compiled path matching, for exclusion and inclusion processing.
+#
+
+def _glob_regex(glob):
+    '''
+    Return the regex for glob as a non-capturing group, without the flags
+    fnmatch.translate() puts on the end.
+    '''
+    pattern = fnmatch.translate(glob)
+    if pattern.endswith('(?ms)'):
+        pattern = pattern[:-len('(?ms)')]
+    return '(?:%s)' % pattern
+
+
+class GlobMatcher(object):
+    '''
+    A set of fnmatch() globs compiled into one regex, so a path is checked
+    against all of them in a single match rather than one fnmatch() each.
+    '''
+
+    def __init__(self, globs=()):
+        self.globs = list(globs)
+        if self.globs:
+            self.re = re.compile('(?ms)' +
+                                 '|'.join(_glob_regex(g) for g in self.globs))
+        else:
+            self.re = None
+
+    def match(self, fpath):
+        '''
+        Return True if any of the globs matches fpath.
+        '''
+        return self.re is not None and self.re.match(fpath) is not None
+
+    def __len__(self):
+        return len(self.globs)
+
+    def __iter__(self):
+        return iter(self.globs)
+
+
+class PrefixSet(object):
+    '''
+    A set of directory prefixes, each ending in os.sep, held as a trie of
+    path components. find() takes time in proportion to the depth of the
+    path, however many prefixes there are.
+    '''
+
+    def __init__(self, prefixes=()):
+        self.root = {}
+        self.prefixes = set()
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        if not prefix.endswith(os.sep):
+            raise ValueError("Prefix '%s' doesn't end in '%s'" %
+                             (prefix, os.sep))
+        if prefix in self.prefixes:
+            return
+        self.prefixes.add(prefix)
+        node = self.root
+        for part in prefix[:-1].split(os.sep):
+            node = node.setdefault(part, {})
+        # None can't be a path component, so it marks the end of a prefix.
+        node[None] = prefix
+
+    def find(self, fpath):
+        '''
+        Return a prefix that fpath starts with, or None.
+        '''
+        node = self.root
+        # The last component can't be under a prefix: 'a/' covers 'a/' and
+        # 'a/b', but not 'a'.
+        for part in fpath.split(os.sep)[:-1]:
+            node = node.get(part)
+            if node is None:
+                return None
+            prefix = node.get(None)
+            if prefix is not None:
+                return prefix
+        return None
+
+    def __contains__(self, prefix):
+        return prefix in self.prefixes
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    def __iter__(self):
+        return iter(self.prefixes)
+
+    def __repr__(self):
+        return 'PrefixSet(%r)' % sorted(self.prefixes)
+
+
+def _find_prefix(fpath, dirs):
+    '''
+    Return the entry in dirs that fpath starts with, or None. dirs is a
+    PrefixSet or any iterable of prefixes.
+    '''
+    if isinstance(dirs, PrefixSet):
+        return dirs.find(fpath)
+    for d in dirs:
+        if fpath.startswith(d):
+            return d
+    return None
+
+
+def _glob_match(fpath, globs):
+    '''
+    Return True if any of globs matches fpath. globs is a GlobMatcher or any
+    iterable of globs.
+    '''
+    if isinstance(globs, GlobMatcher):
+        return globs.match(fpath)
+    for glob in globs:
+        if fnmatch.fnmatch(fpath, glob):
+            return True
+    return False
+
+
+def _which_glob(fpath, globs):
+    '''
+    Return the first of globs that matches fpath, for log messages.
+    '''
+    for glob in globs:
+        if fnmatch.fnmatch(fpath, glob):
+            return glob
+    return None
+
+
 #
 # hashlist_op_impl exclusion processing.
 #
@@ -108,10 +242,13 @@ def is_dir_excluded(fpath, direx, direx_glob, excluded_dirs=None):
     '''
     Given a dir, return True if the user excluded the directory, false
     otherwise.
+
+    direx_glob is best given as a GlobMatcher and excluded_dirs as a
+    PrefixSet, though any iterables will do.
     '''
     exclude = False
     if excluded_dirs is None:
-        excluded_dirs = set()
+        excluded_dirs = PrefixSet()
 
     if fpath in direx:
         log.debug("'%s': Exclude dir", fpath)
@@ -122,19 +259,20 @@ def is_dir_excluded(fpath, direx, direx_glob, excluded_dirs=None):
 
     # Process directory globs.
     if not exclude:
-        for glob in direx_glob:
-            if fnmatch.fnmatch(fpath, glob):
-                log.debug("'%s': Exclude dir from glob '%s'", fpath, glob)
-                dpath = fpath.rstrip(os.sep) + os.sep
-                excluded_dirs.add(dpath)
-                log.debug("Added exclusion dir: '%s'", dpath)
-                exclude = True
+        if _glob_match(fpath, direx_glob):
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("'%s': Exclude dir from glob '%s'",
+                          fpath, _which_glob(fpath, direx_glob))
+            dpath = fpath.rstrip(os.sep) + os.sep
+            excluded_dirs.add(dpath)
+            log.debug("Added exclusion dir: '%s'", dpath)
+            exclude = True
 
     if not exclude:  # No point checking twice.
-        for exc in excluded_dirs:
-            if fpath.startswith(exc):
-                log.debug("Excluded '%s': Under '%s'", fpath, exc)
-                exclude = True
+        exc = _find_prefix(fpath, excluded_dirs)
+        if exc is not None:
+            log.debug("Excluded '%s': Under '%s'", fpath, exc)
+            exclude = True
 
     return exclude
 
@@ -147,11 +285,11 @@ def is_path_pre_excluded(fpath, excluded_dirs, is_dir=False):
     if is_dir:
         fpath += os.sep
 
-    for d in excluded_dirs:
-        if fpath.startswith(d):
-            log.debug("Excluding '%s' under excluded dir '%s'",
-                      fpath, d)
-            return True
+    d = _find_prefix(fpath, excluded_dirs)
+    if d is not None:
+        log.debug("Excluding '%s' under excluded dir '%s'",
+                  fpath, d)
+        return True
 
     return False
 
@@ -166,12 +304,13 @@ def is_path_included(fpath, inclist, inclist_glob, included_dirs=None,
     Given a path and the user's inclusion lists, return True if the path is
     specifically included by the user, False otherwise.
 
-    included_dirs is used as a cache for globs, so we don't have to fnmatch()
-    them each time.
+    included_dirs is used as a cache for globs, so we don't have to match
+    them each time. As with is_dir_excluded(), inclist_glob is best given as
+    a GlobMatcher and included_dirs as a PrefixSet.
     '''
     include = False
     if included_dirs is None:
-        included_dirs = set()
+        included_dirs = PrefixSet()
 
     # Use the is_dir to flag a directory, don't care about trailing slashes.
     fpath = fpath.rstrip(os.sep)
@@ -179,7 +318,7 @@ def is_path_included(fpath, inclist, inclist_glob, included_dirs=None,
     if log.isEnabledFor(logging.DEBUG):
         log.debug("is_path_included: '%s' inclist %s inclist_glob %s "
                   "is_dir %s included_dirs %s",
-                  fpath, inclist, inclist_glob, is_dir, included_dirs)
+                  fpath, inclist, list(inclist_glob), is_dir, included_dirs)
 
     if fpath in inclist:
         log.debug("'%s': Include", fpath)
@@ -189,20 +328,21 @@ def is_path_included(fpath, inclist, inclist_glob, included_dirs=None,
 
     if not include:
         # Check if it's underneath something that's already included.
-        for d in included_dirs:
-            if fpath.startswith(d):
-                log.debug("Including '%s' under included dir '%s'",
-                          fpath, d)
-                include = True
+        d = _find_prefix(fpath, included_dirs)
+        if d is not None:
+            log.debug("Including '%s' under included dir '%s'",
+                      fpath, d)
+            include = True
 
     if not include:
-        for glob in inclist_glob:
-            if fnmatch.fnmatch(fpath, glob):
-                log.debug("'%s': Include path from glob '%s'", fpath, glob)
-                include = True
-                if is_dir:
-                    included_dirs.add(fpath + os.sep)
-                    log.debug("Added inclusion dir '%s'", fpath)
+        if _glob_match(fpath, inclist_glob):
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("'%s': Include path from glob '%s'",
+                          fpath, _which_glob(fpath, inclist_glob))
+            include = True
+            if is_dir:
+                included_dirs.add(fpath + os.sep)
+                log.debug("Added inclusion dir '%s'", fpath)
 
     return include
 
@@ -212,13 +352,17 @@ def is_path_included(fpath, inclist, inclist_glob, included_dirs=None,
 #
 
 def is_hashfile(filename, custom_hashfile=None,
-                allow_locks=True, allow_compressed=True, guess_sigfiles=True):
+                allow_locks=True, allow_compressed=True, guess_sigfiles=True,
+                allow_partials=False):
 
     '''
     Given a path, return True if it looks like a hashfile, False
     otherwise.
 
-    Optionally, also return True if the path is a lockfile.
+    Optionally, also return True if the path is a lockfile. With
+    allow_partials, also return True for a partial download (see
+    partial_path()). Only the destination should ask for that; on the
+    source, such a name is an ordinary file.
     '''
 
     log.debug("is_hashfile(%s, custom_hashfile=%s, allow_locks=%s, "
@@ -229,11 +373,20 @@ def is_hashfile(filename, custom_hashfile=None,
     if custom_hashfile == '':
         raise Exception("Empty string is not a valid hashfile name")
 
-    # Always check for the default hashfile HSYNC.SIG{.gz}.
-    if filename == 'HSYNC.SIG':
+    # Always check for the default hashfile
+    # HSYNC.SIG{.gz,.bin,.tree,.dirs,.journal,.cache,.chunks}.
+    if filename in ('HSYNC.SIG', 'HSYNC.SIG.bin', 'HSYNC.SIG.tree',
+                    'HSYNC.SIG.dirs', 'HSYNC.SIG.journal',
+                    'HSYNC.SIG.cache', 'HSYNC.SIG.chunks'):
         return True
 
-    if guess_sigfiles and filename.endswith('-HSYNC.SIG'):
+    if guess_sigfiles and (filename.endswith('-HSYNC.SIG') or
+                           filename.endswith('-HSYNC.SIG.bin') or
+                           filename.endswith('-HSYNC.SIG.tree') or
+                           filename.endswith('-HSYNC.SIG.dirs') or
+                           filename.endswith('-HSYNC.SIG.journal') or
+                           filename.endswith('-HSYNC.SIG.cache') or
+                           filename.endswith('-HSYNC.SIG.chunks')):
         return True
 
     if allow_locks:
@@ -255,7 +408,13 @@ def is_hashfile(filename, custom_hashfile=None,
             return True
 
     if custom_hashfile is not None and custom_hashfile != 'HSYNC.SIG':
-        if filename == custom_hashfile:
+        if filename == custom_hashfile or \
+                filename == '%s.bin' % custom_hashfile or \
+                filename == '%s.tree' % custom_hashfile or \
+                filename == '%s.dirs' % custom_hashfile or \
+                filename == '%s.journal' % custom_hashfile or \
+                filename == '%s.cache' % custom_hashfile or \
+                filename == '%s.chunks' % custom_hashfile:
             return True
         if allow_locks and filename == '%s.lock' % custom_hashfile:
             return True
@@ -265,4 +424,31 @@ def is_hashfile(filename, custom_hashfile=None,
                 filename == '%s.gz.lock' % custom_hashfile):
             return True
 
+    if allow_partials and is_partial(filename):
+        return True
+
     return False
+
+
+def partial_path(fpath, hashstr):
+    '''
+    Return the path of the partial download of the file at fpath with
+    contents hashstr. It's in the same directory, so it can be renamed into
+    place, and it's named for the contents so a file that's changed since
+    isn't resumed from the wrong data.
+    '''
+    (dirname, basename) = os.path.split(fpath)
+    # Keep well within the usual 255-byte filename limit.
+    return os.path.join(dirname,
+                        '.%s.%s.part' % (basename[:200], hashstr[:16]))
+
+
+_re_partial = re.compile(r'^\..+\.[0-9a-f]{16}\.part$')
+
+
+def is_partial(filename):
+    '''
+    Return True if filename looks like a partial download (see
+    partial_path()).
+    '''
+    return _re_partial.match(filename) is not None
@@ -0,0 +1,305 @@
+# Keep a source signature up to date with inotify.
+
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import print_function
+
+import logging
+import os
+import time
+
+from hashlist_op_impl import hashlist_generate, hashlist_scan_dir
+from inotify import *
+from utility import get_hashlist
+
+log = logging.getLogger()
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE |
+              IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_ONLYDIR | IN_DONT_FOLLOW)
+
+# A steady trickle of changes can hold off a rewrite for at most this many
+# times the delay.
+MAX_DELAY_FACTOR = 10
+
+# How often to check if we've been asked to stop.
+POLL_INTERVAL = 1.0
+
+
+class SourceWatcher(object):
+    '''
+    Keep a source hashlist up to date by watching every directory in the
+    tree with inotify. Only the directories named in events are scanned
+    again, with hashlist_scan_dir(), and only files whose size or mtime
+    has changed are rehashed.
+
+    Once there have been no events for opts.watch_delay seconds, the
+    changes are applied and, if anything changed, write_signature() is
+    called with a path-ordered hashlist.
+    '''
+
+    def __init__(self, srcpath, opts, write_signature):
+        self.srcpath = srcpath.rstrip(os.sep)
+        self.opts = opts
+        self.write_signature = write_signature
+        self.delay = opts.watch_delay
+
+        self.inotify = None
+        # The tree, by fpath, and the names in each directory.
+        self.entries = {}
+        self.children = {}
+        # Watched directories, by full path and by watch descriptor.
+        self.dir_wds = {}
+        self.wds = {}
+        self.dirty = set()
+        self.overflow = False
+
+    def run(self, existing_hashlist=None, stop=None):
+        '''
+        Scan the tree and write the signature, then keep it up to date
+        until stop() returns True, if stop is given. Returns False if the
+        tree goes away.
+        '''
+        self.inotify = Inotify()
+        try:
+            self._rescan(existing_hashlist)
+            self.write_signature(self._hashlist())
+            return self._loop(stop)
+        finally:
+            self.inotify.close()
+            self.inotify = None
+
+    def _loop(self, stop):
+        first_event = last_event = None
+        while stop is None or not stop():
+            timeout = POLL_INTERVAL
+            if self.dirty:
+                timeout = min(timeout, max(0, last_event + self.delay -
+                                           time.time()))
+
+            for (wd, mask, cookie, name) in \
+                    self.inotify.read_events(timeout):
+                if not self._event(wd, mask, name):
+                    return False
+                last_event = time.time()
+                if first_event is None:
+                    first_event = last_event
+
+            if not self.dirty and not self.overflow:
+                continue
+            now = time.time()
+            if now - last_event < self.delay and \
+                    now - first_event < self.delay * MAX_DELAY_FACTOR:
+                continue
+
+            if self.overflow:
+                log.warn("inotify queue overflowed, rescanning")
+                self.dirty.clear()
+                self.overflow = False
+                changed = self._rescan(self._hashlist())
+            else:
+                dirty = self.dirty
+                self.dirty = set()
+                changed = self._update(dirty)
+
+            first_event = last_event = None
+            if changed:
+                if self.opts.verbose:
+                    print("Watch: signature updated")
+                self.write_signature(self._hashlist())
+
+        return True
+
+    def _event(self, wd, mask, name):
+        '''Note an event. Return False if the tree has gone.'''
+        if mask & IN_Q_OVERFLOW:
+            self.overflow = True
+            return True
+
+        path = self.wds.get(wd)
+        if mask & IN_IGNORED:
+            if path is not None:
+                del self.wds[wd]
+                if self.dir_wds.get(path) == wd:
+                    del self.dir_wds[path]
+                if path == self.srcpath:
+                    log.error("Source directory '%s' has gone",
+                              self.srcpath)
+                    return False
+            return True
+
+        if path is None:
+            # A watch we've dropped.
+            return True
+        if name:
+            if mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+                # The directory's mtime has changed too.
+                self.dirty.add(path)
+            path = os.path.join(path, name)
+        log.debug("watch: event %08x '%s'", mask, path)
+        self.dirty.add(path)
+        return True
+
+    def _fpath(self, path):
+        if self.opts.trim_path:
+            return path[len(self.srcpath) + 1:]
+        return path
+
+    def _hashlist(self):
+        hashlist = get_hashlist(self.opts)
+        for fpath in sorted(self.entries):
+            hashlist.append(self.entries[fpath])
+        return hashlist
+
+    def _rescan(self, existing_hashlist):
+        '''
+        Scan the whole tree, using existing_hashlist to avoid rehashing
+        files. Each directory is watched before it's listed, so anything
+        that changes during the scan shows up as an event.
+        '''
+        hashlist = hashlist_generate(self.srcpath, self.opts,
+                                     existing_hashlist=existing_hashlist,
+                                     dir_hook=self._watch)
+        self.entries = {}
+        self.children = {}
+        for fh in hashlist:
+            self._add(fh)
+
+        wanted = set([self.srcpath])
+        wanted.update(fh.fullpath for fh in self.entries.itervalues()
+                      if fh.is_dir)
+        for path in set(self.dir_wds) - wanted:
+            self._unwatch(path)
+        return True
+
+    def _watch(self, path):
+        try:
+            wd = self.inotify.add_watch(path, WATCH_MASK)
+        except InotifyWatchError:
+            if os.path.isdir(path):
+                raise
+            log.debug("watch: '%s' has gone", path)
+            return
+        self.wds[wd] = path
+        self.dir_wds[path] = wd
+
+    def _unwatch(self, path):
+        wd = self.dir_wds.pop(path, None)
+        if wd is not None:
+            self.inotify.rm_watch(wd)
+            self.wds.pop(wd, None)
+
+    def _add(self, fh):
+        self.entries[fh.fpath] = fh
+        (dirname, name) = os.path.split(fh.fpath)
+        self.children.setdefault(dirname, set()).add(name)
+
+    def _update(self, paths):
+        '''
+        Scan the directories holding paths again. Return True if anything
+        changed.
+        '''
+        dirs = set()
+        for path in paths:
+            if path != self.srcpath:
+                dirs.add(os.path.dirname(path))
+
+        # Parents first, so a directory that's gone is dropped before
+        # there's any attempt to scan it.
+        changed = False
+        for path in sorted(dirs):
+            fh = self.entries.get(self._fpath(path))
+            if path == self.srcpath or (fh is not None and fh.is_dir):
+                changed |= self._update_dir(path)
+        return changed
+
+    def _update_dir(self, path):
+        '''
+        Bring the entries directly in the directory path up to date.
+        Return True if anything changed.
+        '''
+        fpath = self._fpath(path)
+        old_names = self.children.get(fpath, set())
+        existing = {}
+        for name in old_names:
+            name_fpath = os.path.join(fpath, name)
+            existing[name_fpath] = self.entries[name_fpath]
+
+        try:
+            scanned = list(hashlist_scan_dir(self.srcpath, path, self.opts,
+                                             existing=existing,
+                                             recurse=False))
+        except (OSError, IOError) as e:
+            # It's changing under us. There'll be another event.
+            log.debug("watch: can't scan '%s': %s", path, e)
+            return False
+
+        changed = False
+        names = set(os.path.basename(fh.fpath) for fh in scanned)
+        # Removals first, so a directory that's moved is unwatched at its
+        # old path before it's watched at its new one.
+        for name in old_names - names:
+            changed |= self._remove(os.path.join(path, name))
+
+        for fh in scanned:
+            old = self.entries.get(fh.fpath)
+            if old is not None and old.is_dir != fh.is_dir:
+                self._remove(fh.fullpath)
+                old = None
+            if old is not None and \
+                    old.presentation_format() == fh.presentation_format():
+                continue
+
+            log.debug("watch: update '%s'", fh.fullpath)
+            self._add(fh)
+            changed = True
+            if fh.is_dir and old is None:
+                self._add_dir(fh.fullpath)
+        return changed
+
+    def _add_dir(self, path):
+        '''Watch and add everything under a new directory.'''
+        try:
+            for fh in hashlist_scan_dir(self.srcpath, path, self.opts,
+                                        dir_hook=self._watch):
+                self._add(fh)
+        except (OSError, IOError) as e:
+            log.debug("watch: can't scan '%s': %s", path, e)
+
+    def _remove(self, path):
+        fpath = self._fpath(path)
+        fh = self.entries.pop(fpath, None)
+        if fh is None:
+            return False
+        log.debug("watch: remove '%s'", path)
+        (dirname, name) = os.path.split(fpath)
+        self.children.get(dirname, set()).discard(name)
+        if fh.is_dir:
+            for name in self.children.pop(fpath, ()):
+                self._remove(os.path.join(path, name))
+            self._unwatch(path)
+        return True
@@ -0,0 +1,163 @@
+# Bounded worker thread pool.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import Queue
+import sys
+import threading
+
+log = logging.getLogger()
+
+
+class WorkerPool(object):
+    '''
+    A fixed-size pool of worker threads.
+
+    Each task has a cost (e.g. a number of bytes). submit() blocks while the
+    total cost of the tasks in flight would exceed max_cost, or while there
+    are already max_tasks tasks in flight. A task that is on its own is
+    always allowed to run, however expensive it is.
+
+    Results are handed back to the submitting thread through completed() and
+    wait(), as (tag, result, exc_info) tuples. exc_info is None if the task
+    returned normally, otherwise it's the sys.exc_info() tuple of the
+    exception the task raised.
+    '''
+
+    def __init__(self, jobs, max_cost=None, max_tasks=None):
+        if jobs < 1:
+            raise ValueError("WorkerPool needs at least one worker")
+
+        self.jobs = jobs
+        self.max_cost = max_cost
+        if max_tasks is None:
+            max_tasks = jobs * 2
+        self.max_tasks = max_tasks
+
+        self.cost_in_flight = 0
+        self.tasks_in_flight = 0
+        self.cond = threading.Condition()
+        # Tasks whose results haven't been collected. Only the submitting
+        # thread uses this.
+        self.uncollected = 0
+
+        self.tasks = Queue.Queue()
+        self.results = Queue.Queue()
+
+        self.threads = []
+        for n in xrange(jobs):
+            t = threading.Thread(target=self._worker,
+                                 name='hsync-worker-%d' % n)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+        log.debug("WorkerPool: %d workers, max_cost %s max_tasks %d",
+                  jobs, max_cost, max_tasks)
+
+    def _has_room(self, cost):
+        if self.tasks_in_flight == 0:
+            return True
+        if self.tasks_in_flight >= self.max_tasks:
+            return False
+        if self.max_cost is not None and \
+                self.cost_in_flight + cost > self.max_cost:
+            return False
+        return True
+
+    def submit(self, func, args=(), cost=0, tag=None):
+        '''
+        Queue func(*args) to run on a worker, blocking until there's room
+        for it.
+        '''
+        with self.cond:
+            while not self._has_room(cost):
+                self.cond.wait()
+            self.cost_in_flight += cost
+            self.tasks_in_flight += 1
+
+        self.uncollected += 1
+        self.tasks.put((func, args, cost, tag))
+
+    def _worker(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+
+            (func, args, cost, tag) = task
+            result = None
+            exc_info = None
+            try:
+                result = func(*args)
+            except:
+                exc_info = sys.exc_info()
+
+            self.results.put((tag, result, exc_info))
+
+            with self.cond:
+                self.cost_in_flight -= cost
+                self.tasks_in_flight -= 1
+                self.cond.notify_all()
+
+    def completed(self):
+        '''
+        Generate the results that are ready now, without blocking.
+        '''
+        while self.uncollected:
+            try:
+                result = self.results.get_nowait()
+            except Queue.Empty:
+                return
+            self.uncollected -= 1
+            yield result
+
+    def next_result(self):
+        '''
+        Block until a result is ready, and return it. Only call this when
+        there's a result still to collect, or it will never return.
+        '''
+        result = self.results.get()
+        self.uncollected -= 1
+        return result
+
+    def wait(self):
+        '''
+        Generate results until every submitted task has finished.
+        '''
+        while self.uncollected:
+            yield self.next_result()
+
+    def close(self):
+        '''
+        Stop the workers once they've finished the tasks in the queue.
+        '''
+        for t in self.threads:
+            self.tasks.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
@@ -0,0 +1,93 @@
+# Benchmark for compiled exclusion and inclusion rules.
+
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Time is_dir_excluded() and is_path_included() against growing rule sets,
+with the rules given as plain lists and sets (which cost a fnmatch() or
+startswith() per rule per path) and compiled into a GlobMatcher and
+PrefixSet. The prefix lookups don't depend on the number of rules at all,
+and the globs cost a single regex match, so the compiled per-path cost
+grows far more slowly than the plain one.
+
+Run it from the top of the tree:
+
+    python -m tests.bench_match
+'''
+
+from __future__ import print_function
+
+import time
+
+from hsync.utility import (GlobMatcher, PrefixSet, is_dir_excluded,
+                           is_path_included)
+
+
+def _paths(count):
+    return ['top%d/mid%d/leaf%d' % (n % 50, n % 300, n) for n in xrange(count)]
+
+
+def _rules(count):
+    globs = ['*/skip%d*' % n for n in xrange(count)]
+    dirs = ['top%d/gone%d/' % (n % 50, n) for n in xrange(count)]
+    return (globs, dirs)
+
+
+def _time_exclude(paths, globs, dirs):
+    '''Return the mean time per path, in microseconds.'''
+    start = time.time()
+    for fpath in paths:
+        is_dir_excluded(fpath, (), globs, dirs)
+    return (time.time() - start) * 1e6 / len(paths)
+
+
+def _time_include(paths, globs, dirs):
+    start = time.time()
+    for fpath in paths:
+        is_path_included(fpath, (), globs, dirs)
+    return (time.time() - start) * 1e6 / len(paths)
+
+
+def main():
+    paths = _paths(10000)
+    # The uncompiled rules are slow enough that a sample will do.
+    sample = paths[::50]
+    print("%6s %12s %12s %12s %12s" % ('rules', 'exclude', 'compiled',
+                                        'include', 'compiled'))
+    for count in (1, 10, 100, 300, 1000):
+        (globs, dirs) = _rules(count)
+        times = [
+            _time_exclude(sample, globs, set(dirs)),
+            _time_exclude(paths, GlobMatcher(globs), PrefixSet(dirs)),
+            _time_include(sample, globs, set(dirs)),
+            _time_include(paths, GlobMatcher(globs), PrefixSet(dirs)),
+        ]
+        print("%6d %s" % (count, ' '.join('%10.1fus' % t for t in times)))
+
+
+if __name__ == '__main__':
+    main()
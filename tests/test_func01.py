@@ -29,12 +29,15 @@
 
 from __future__ import print_function
 
+import hashlib
 import inspect
 import logging
 import os
 import shutil
 import stat
+import StringIO
 import subprocess
+import sys
 import time
 import unittest
 import urllib2
@@ -227,6 +230,339 @@ class HsyncBruteForceFunctionalTestCase(unittest.TestCase):
         self.rundiff('t_sub1')
         self.rundiff('t_sub2')
 
+    def test_local_sub1_jobs(self):
+        '''Small file tree, local filesystem, several workers'''
+        self.rundiff('t_sub1', dst_optlist=['-j', '3'])
+        self.rundiff('t_sub2', dst_optlist=['-j', '3'])
+
+    def test_local_binary_signature(self):
+        '''Small file trees, binary signature'''
+        self.rundiff('t_sub1', src_optlist=['-b'], dst_optlist=['-B'])
+        self.rundiff('t_sub2', src_optlist=['-b', '-z'],
+                     dst_optlist=['-B'])
+
+    def test_web_binary_signature(self):
+        '''Small file tree over HTTP, binary signature'''
+        self.rundiff('t_sub1', src_optlist=['-b'], dst_optlist=['-B'],
+                     web=True)
+
+    def test_local_tree_signature(self):
+        '''Small file trees, skipping unchanged subtrees'''
+        self.rundiff('t_sub1', src_optlist=['-t'], dst_optlist=['-T'])
+        self.rundiff('t_sub2', src_optlist=['-t', '-z'],
+                     dst_optlist=['-T', '-Z'])
+        self.rundiff('t_deldir2_in', 't_deldir2_out',
+                     src_optlist=['-t'], dst_optlist=['-T'])
+
+    def test_local_tree_signature_change(self):
+        '''Changes under an unchanged-looking tree are still found'''
+        (in_tmp, out_tmp) = self.rundiff('t_sub2', src_optlist=['-t'],
+                                         dst_optlist=['-T'], delete=False)
+        # Resync with a cached signature, after changing one subtree.
+        with open(os.path.join(in_tmp, 'd1', 'd1.1', 'new'), 'w') as f:
+            print("new", file=f)
+        self.assertTrue(hsync.main(['-S', in_tmp, '-t']))
+        self.assertTrue(hsync.main(['-D', out_tmp, '-u', in_tmp, '-T']))
+        self.assertTrue(os.path.exists(os.path.join(out_tmp, 'd1', 'd1.1',
+                                                    'new')))
+        # Now change the destination, which the source digests can't know
+        # about.
+        os.unlink(os.path.join(out_tmp, 'd1', 'd1.1', 'new'))
+        self.assertFalse(hsync.main(['-V', '-D', out_tmp, '-u', in_tmp,
+                                     '-T']))
+        self._just_remove(in_tmp)
+        self._just_remove(out_tmp)
+
+    def test_local_copy(self):
+        '''Moved and copied files are found on the destination'''
+        for dst_optlist in ([], ['--use-less-memory'], ['-j', '3']):
+            (in_tmp, out_tmp) = self.rundiff('t_sub2', delete=False)
+            jpg = os.path.join('d1', 'd1.1',
+                               'nasa_hubble_spacescape-wide.jpg')
+            moved = os.path.join('d2',
+                                 '620904main_hubble-20120206_946-710.jpg')
+            ino = os.stat(os.path.join(out_tmp, moved)).st_ino
+
+            os.rename(os.path.join(in_tmp, 'd2'), os.path.join(in_tmp, 'd3'))
+            shutil.copy2(os.path.join(in_tmp, jpg),
+                         os.path.join(in_tmp, 'd1', 'copy.jpg'))
+            self.assertTrue(hsync.main(['-S', in_tmp]))
+            # Spoil the source files, so fetching them would fail.
+            for f in (os.path.join('d1', 'copy.jpg'),
+                      os.path.join('d3', os.path.basename(moved))):
+                with open(os.path.join(in_tmp, f), 'wb') as fh:
+                    fh.write('spoiled')
+
+            dstopt = ['-D', out_tmp, '-u', in_tmp] + dst_optlist
+            self.assertTrue(hsync.main(dstopt))
+            self.assertFalse(os.path.exists(os.path.join(out_tmp, 'd2')))
+            self.assertEqual(os.stat(os.path.join(
+                out_tmp, 'd3', os.path.basename(moved))).st_ino, ino)
+            with open(os.path.join(out_tmp, 'd1', 'copy.jpg'), 'rb') as f:
+                with open(os.path.join(out_tmp, jpg), 'rb') as g:
+                    self.assertEqual(f.read(), g.read())
+            self._just_remove(in_tmp)
+            self._just_remove(out_tmp)
+
+    def _resume(self, web):
+        (in_tmp, out_tmp) = self.rundiff('t_sub1', delete=False)
+        contents = ''.join(chr(n % 251) for n in xrange(300000))
+        with open(os.path.join(in_tmp, 'big'), 'wb') as f:
+            f.write(contents)
+        self.assertTrue(hsync.main(['-S', in_tmp]))
+
+        # Leave half a download, then spoil that half on the source. Only
+        # the second half should be fetched.
+        digest = hashlib.sha256(contents).hexdigest()
+        part = os.path.join(out_tmp, '.big.%s.part' % digest[:16])
+        with open(part, 'wb') as f:
+            f.write(contents[:150000])
+        stale = os.path.join(out_tmp, '.gone.%s.part' % ('0' * 16))
+        with open(stale, 'wb') as f:
+            f.write('stale')
+        with open(os.path.join(in_tmp, 'big'), 'r+b') as f:
+            f.write('X' * 150000)
+
+        in_url = in_tmp
+        if web:
+            in_url = 'http://127.0.0.1:%d/test/in_tmp' % (self.wport)
+        self.assertTrue(hsync.main(['-D', out_tmp, '-u', in_url]))
+        with open(os.path.join(out_tmp, 'big'), 'rb') as f:
+            self.assertEqual(f.read(), contents)
+        self.assertFalse(os.path.exists(part))
+        self.assertFalse(os.path.exists(stale))
+        self._just_remove(in_tmp)
+        self._just_remove(out_tmp)
+
+    def test_local_resume(self):
+        '''Partial downloads are resumed'''
+        self._resume(web=False)
+
+    def test_web_resume(self):
+        '''Partial downloads are resumed over HTTP'''
+        self._resume(web=True)
+
+    def test_local_partial_not_signed(self):
+        '''Leftover partial downloads aren't in the destination signature'''
+        (in_tmp, out_tmp) = self.rundiff('t_sub1', delete=False)
+        part = '.gone.%s.part' % ('0' * 16)
+        with open(os.path.join(out_tmp, part), 'wb') as f:
+            f.write('stale')
+        self.assertTrue(hsync.main(['-S', in_tmp]))
+        self.assertTrue(hsync.main(['-D', out_tmp, '-u', in_tmp,
+                                    '--no-delete']))
+        self.assertTrue(os.path.exists(os.path.join(out_tmp, part)))
+        with open(os.path.join(out_tmp, 'HSYNC.SIG')) as f:
+            self.assertNotIn(part, f.read())
+        self._just_remove(in_tmp)
+        self._just_remove(out_tmp)
+
+    def test_local_partial_name_on_source(self):
+        '''A source file named like a partial download is synced'''
+        (in_tmp, out_tmp) = self.rundiff('t_sub1', delete=False)
+        part = '.real.0123456789abcdef.part'
+        with open(os.path.join(in_tmp, part), 'wb') as f:
+            f.write('a real file')
+        self.assertTrue(hsync.main(['-S', in_tmp]))
+        with open(os.path.join(in_tmp, 'HSYNC.SIG')) as f:
+            self.assertIn(part, f.read())
+        # The second run finds it already there, and keeps it.
+        for n in xrange(2):
+            self.assertTrue(hsync.main(['-D', out_tmp, '-u', in_tmp]))
+            with open(os.path.join(out_tmp, part), 'rb') as f:
+                self.assertEqual(f.read(), 'a real file')
+            with open(os.path.join(out_tmp, 'HSYNC.SIG')) as f:
+                self.assertIn(part, f.read())
+        self._just_remove(in_tmp)
+        self._just_remove(out_tmp)
+
+    def test_web_missing_leaves_no_partial(self):
+        '''A file that's gone from the source doesn't leave a partial'''
+        (in_tmp, out_tmp) = self.rundiff('t_sub1', delete=False)
+        with open(os.path.join(in_tmp, 'gone'), 'wb') as f:
+            f.write('contents')
+        self.assertTrue(hsync.main(['-S', in_tmp]))
+        os.unlink(os.path.join(in_tmp, 'gone'))
+
+        in_url = 'http://127.0.0.1:%d/test/in_tmp' % (self.wport)
+        hsync.main(['-D', out_tmp, '-u', in_url])
+        self.assertFalse(os.path.exists(os.path.join(out_tmp, 'gone')))
+        self.assertEqual([f for f in os.listdir(out_tmp)
+                          if f.endswith('.part')], [])
+        self._just_remove(in_tmp)
+        self._just_remove(out_tmp)
+
+    def _delta(self, web):
+        (in_tmp, out_tmp) = self.rundiff('t_sub1', delete=False)
+        contents = ''.join(chr(n % 251) for n in xrange(300000))
+        with open(os.path.join(in_tmp, 'big'), 'wb') as f:
+            f.write(contents)
+        srcopt = ['-S', in_tmp, '--chunk-signature',
+                  '--chunk-size', '10000', '--chunk-min-size', '100000']
+        self.assertTrue(hsync.main(srcopt))
+        self.assertTrue(os.path.exists(
+            os.path.join(in_tmp, 'HSYNC.SIG.chunks')))
+
+        in_url = in_tmp
+        if web:
+            in_url = 'http://127.0.0.1:%d/test/in_tmp' % (self.wport)
+        dstopt = ['-D', out_tmp, '-u', in_url, '--remote-sig-chunks']
+        self.assertTrue(hsync.main(dstopt))
+
+        # Change two chunks. Only those should be fetched.
+        contents = contents[:15000] + 'X' * 10 + contents[15010:295000] + \
+            'Y' * 5000
+        with open(os.path.join(in_tmp, 'big'), 'wb') as f:
+            f.write(contents)
+        mtime = os.stat(os.path.join(out_tmp, 'big')).st_mtime - 3600
+        os.utime(os.path.join(in_tmp, 'big'), (mtime, mtime))
+        self.assertTrue(hsync.main(srcopt))
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            self.assertTrue(hsync.main(dstopt))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertIn('F: big (fetched 2 of 30 chunks)', output)
+        with open(os.path.join(out_tmp, 'big'), 'rb') as f:
+            self.assertEqual(f.read(), contents)
+        self._just_remove(in_tmp)
+        self._just_remove(out_tmp)
+
+    def test_local_delta(self):
+        '''Only the changed chunks of large files are fetched'''
+        self._delta(web=False)
+
+    def test_web_delta(self):
+        '''Only the changed chunks of large files are fetched over HTTP'''
+        self._delta(web=True)
+
+    def test_local_include_delete(self):
+        '''Plain and glob includes find the same files to remove'''
+        for include in ('d1', 'd[1]'):
+            (in_tmp, out_tmp) = self.rundiff('t_sub1', delete=False)
+            with open(os.path.join(out_tmp, 'd2', 'extra'), 'w') as f:
+                f.write('only on the destination')
+            with open(os.path.join(in_tmp, 'd2', 'new'), 'w') as f:
+                f.write('not included')
+            self.assertTrue(hsync.main(['-S', in_tmp]))
+
+            stdout = sys.stdout
+            sys.stdout = StringIO.StringIO()
+            try:
+                self.assertTrue(hsync.main(['-D', out_tmp, '-u', in_tmp,
+                                            '-I', include]))
+                output = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+            # -I turns on --no-delete, so the files the source doesn't have
+            # are only listed, wherever they are. Nothing outside the
+            # include is fetched.
+            self.assertIn('\n- d2/extra\n', output, include)
+            self.assertTrue(os.path.exists(
+                os.path.join(out_tmp, 'd2', 'extra')), include)
+            self.assertFalse(os.path.exists(
+                os.path.join(out_tmp, 'd2', 'new')), include)
+            self._just_remove(in_tmp)
+            self._just_remove(out_tmp)
+
+    def test_local_include_copy(self):
+        '''Files outside the includes aren't used for local copies'''
+        (in_tmp, out_tmp) = self.rundiff('t_sub1', delete=False)
+        for d in (in_tmp, out_tmp):
+            with open(os.path.join(d, 'd2', 'same'), 'w') as f:
+                f.write('same contents')
+        with open(os.path.join(in_tmp, 'd1', 'new'), 'w') as f:
+            f.write('same contents')
+        self.assertTrue(hsync.main(['-S', in_tmp]))
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            self.assertTrue(hsync.main(['-D', out_tmp, '-u', in_tmp,
+                                        '-I', 'd1/new', '-v']))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertNotIn('can be copied locally', output)
+        with open(os.path.join(out_tmp, 'd1', 'new')) as f:
+            self.assertEqual(f.read(), 'same contents')
+        self._just_remove(in_tmp)
+        self._just_remove(out_tmp)
+
+    def test_local_journal(self):
+        '''An interrupted fetch leaves a journal of what it fetched'''
+        (in_tmp, out_tmp) = self.rundiff('t_sub2', delete=False)
+        for f in ('f1', 'f2'):
+            with open(os.path.join(in_tmp, f), 'w') as fh:
+                print(f, file=fh)
+        self.assertTrue(hsync.main(['-S', in_tmp]))
+        # Spoil f2 so its fetch fails, and the sync with it.
+        with open(os.path.join(in_tmp, 'f2'), 'w') as fh:
+            print('spoiled', file=fh)
+
+        journal = os.path.join(out_tmp, 'HSYNC.SIG.journal')
+        self.assertFalse(hsync.main(['-D', out_tmp, '-u', in_tmp,
+                                     '--checkpoint-files', '1']))
+        with open(journal) as fh:
+            journalled = [l.split()[-1] for l in fh]
+        self.assertIn('f1', journalled)
+        self.assertNotIn('f2', journalled)
+
+        with open(os.path.join(in_tmp, 'f2'), 'w') as fh:
+            print('f2', file=fh)
+        self.assertTrue(hsync.main(['-D', out_tmp, '-u', in_tmp]))
+        self.assertFalse(os.path.exists(journal))
+        self._just_remove(in_tmp)
+        self._just_remove(out_tmp)
+
+    def test_local_hash_cache(self):
+        '''Small file trees with a hash cache'''
+        (in_tmp, out_tmp) = self.rundiff('t_sub2', delete=False,
+                                         dst_optlist=['--hash-cache'],
+                                         clnt_repeat=2)
+        self.assertTrue(os.path.exists(os.path.join(out_tmp,
+                                                    'HSYNC.SIG.cache')))
+        self._just_remove(in_tmp)
+        self._just_remove(out_tmp)
+
+    def test_local_digest(self):
+        '''The signature names its digest algorithm'''
+        (in_tmp, out_tmp) = self.rundiff('t_sub2', delete=False)
+        src_sig = os.path.join(in_tmp, 'HSYNC.SIG')
+        dst_sig = os.path.join(out_tmp, 'HSYNC.SIG')
+        # The default has no header, so older clients can read it.
+        for sig in (src_sig, dst_sig):
+            with open(sig) as fh:
+                self.assertFalse(fh.readline().startswith('#'))
+
+        def set_header(sig, name):
+            with open(sig) as fh:
+                lines = fh.readlines()
+            lines.insert(0, '# digest: %s\n' % name)
+            with open(sig, 'w') as fh:
+                fh.writelines(lines)
+
+        # An existing destination signature we can't use is ignored.
+        set_header(dst_sig, 'md4')
+        self.assertTrue(hsync.main(['-D', out_tmp, '-u', in_tmp]))
+        # A source signature we can't use is an error.
+        set_header(src_sig, 'md4')
+        self.assertFalse(hsync.main(['-D', out_tmp, '-u', in_tmp]))
+        self.assertFalse(hsync.main(['-S', in_tmp, '--digest', 'md4']))
+        self._just_remove(in_tmp)
+        self._just_remove(out_tmp)
+
+    def test_local_less_memory(self):
+        '''Small file trees with disk-backed hashlists'''
+        self.rundiff('t_sub1', src_optlist=['--use-less-memory'],
+                     dst_optlist=['--use-less-memory'])
+        self.rundiff('t_deldir2_in', 't_deldir2_out',
+                     src_optlist=['--use-less-memory'],
+                     dst_optlist=['--use-less-memory'])
+
     def test_local_deldir(self):
         '''Make sure directories get deleted'''
         self.rundiff('t_deldir1_in', 't_deldir1_out')
@@ -320,6 +656,38 @@ class HsyncBruteForceFunctionalTestCase(unittest.TestCase):
         self.rundiff(tardir, None, dst_optlist=['-P'], web=True)
         shutil.rmtree(tardir)
 
+    def test_web_tarball_jobs(self):
+        '''Fetch a tarball tree over www using several workers'''
+        os.chdir(self.topdir)
+        tarball = 'zlib-1.2.8.tar.gz'
+        tardir = 'zlib-1.2.8'
+        subprocess.check_call(("tar xzf %s" % tarball).split())
+        self.rundiff(tardir, None, dst_optlist=['-P', '-j', '4'], web=True)
+        # A tiny budget means large files are fetched on their own.
+        self.rundiff(tardir, None, web=True,
+                     dst_optlist=['-j', '4', '--max-inflight-bytes', '1000'])
+        shutil.rmtree(tardir)
+
+    def test_source_jobs_deterministic(self):
+        '''Hashing with several jobs gives the same signature file'''
+        os.chdir(self.topdir)
+        tarball = 'zlib-1.2.8.tar.gz'
+        tardir = 'zlib-1.2.8'
+        subprocess.check_call(("tar xzf %s" % tarball).split())
+        sigfile = os.path.join(tardir, 'HSYNC.SIG')
+
+        self.assertTrue(hsync.main(['-S', tardir, '-c', '-q']))
+        with open(sigfile) as f:
+            serial = f.read()
+        os.unlink(sigfile)
+
+        self.assertTrue(hsync.main(['-S', tardir, '-c', '-q', '-j', '4']))
+        with open(sigfile) as f:
+            parallel = f.read()
+
+        self.assertEqual(serial, parallel)
+        shutil.rmtree(tardir)
+
     def test_web_tarball_filename_space(self):
         '''
         Unpack some tarballs, add a filename with a space, fetch over www'''
@@ -694,19 +694,21 @@ class HsyncLocalDiskFuncTestCase(unittest.TestCase):
         full_fetchfiles = [f[0] for f in needed]
         full_fetchfiles.sort()
 
-        # Fetch should match the first scan (with -X), but not the full scan
-        # as watcom/ files should not be transferred.
-        self.assertEquals(scanfiles, full_fetchfiles)
+        # Only the included subtree is even considered.
+        self.assertEquals([f for f in scanfiles
+                           if f == 'watcom' or f.startswith('watcom/')],
+                          full_fetchfiles)
 
         # See what we actually fetched.
         did_fetch = [f[0] for f in i_fetched]
         did_not_fetch = [f[0] for f in i_not_fetched]
 
+        self.assertNotEquals(did_fetch, [])
         for f in did_fetch:
             self.assertTrue(f.startswith('watcom'))
+            self.assertTrue(os.path.exists(os.path.join(zlibdst, f)))
 
-        for f in did_not_fetch:
-            self.assertFalse(f.startswith('watcom'))
+        self.assertEquals(did_not_fetch, [])
 
     def test_e2e_include_glob_dst1(self):
         '''
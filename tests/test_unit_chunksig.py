@@ -0,0 +1,119 @@
+# Unit tests for chunk signatures.
+
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from hsync.chunksig import *
+from hsync.exceptions import *
+from hsync.filehash import FileHash, HashStringFormatError
+from hsync.hashengine import engine as hash_engine
+from hsync.hashlist import HashList
+
+
+class ChunkSigUnitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.chunkfile = os.path.join(self.tmp, 'HSYNC.SIG.chunks')
+
+    def tearDown(self):
+        hash_engine.record_chunks(None, None)
+        shutil.rmtree(self.tmp, True)
+
+    def _hashlist(self, files):
+        hl = HashList()
+        for (name, data) in sorted(files.iteritems()):
+            path = os.path.join(self.tmp, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            hl.append(FileHash.init_from_file(path, trim=True,
+                                              root=self.tmp))
+        return hl
+
+    def _read(self):
+        with open(self.chunkfile) as f:
+            return chunks_from_lines(f.read().splitlines())
+
+    def test_round_trip(self):
+        '''Chunk digests are written and read back'''
+        big = 'x' * 1500 + 'y' * 1000
+        hl = self._hashlist({'big': big, 'copy': big, 'small': 'z' * 10})
+        chunk_file_write(hl, self.chunkfile, self.tmp, 1000, 1000)
+
+        sig = self._read()
+        self.assertEqual(sig.digest_name, hash_engine.digest_name)
+        self.assertEqual(len(sig), 1)
+        digest = hashlib.sha256(big).digest()
+        want = [hashlib.sha256(big[n:n + 1000]).digest()
+                for n in (0, 1000, 2000)]
+        self.assertEqual(sig.get(digest), (1000, want))
+        self.assertEqual(sig.get(digest, 1000), (1000, want))
+        self.assertIsNone(sig.get(digest, 2000))
+        self.assertIsNone(sig.get(hashlib.sha256('z' * 10).digest()))
+
+    def test_reuse(self):
+        '''Recorded and old chunk digests are used without reading again'''
+        hl = self._hashlist({'big': 'x' * 2500})
+        fh = hl[0]
+        old = ChunkSignature(hash_engine.digest_name)
+        old.add(fh.digest, 1000, ['old'] * 3)
+        # Spoil the file, so that any attempt to read it shows.
+        with open(os.path.join(self.tmp, 'big'), 'wb') as f:
+            f.write('spoiled')
+
+        chunk_file_write(hl, self.chunkfile, self.tmp, 1000, 1000, old=old)
+        self.assertEqual(self._read().get(fh.digest), (1000, ['old'] * 3))
+
+        # A different chunk size means the old digests won't do.
+        chunk_file_write(hl, self.chunkfile, self.tmp, 500, 1000, old=old)
+        self.assertEqual(len(self._read()), 0)
+
+        hash_engine.record_chunks(1000, 1000)
+        hl = self._hashlist({'big': 'y' * 2500})
+        with open(os.path.join(self.tmp, 'big'), 'wb') as f:
+            f.write('spoiled')
+        chunk_file_write(hl, self.chunkfile, self.tmp, 1000, 1000)
+        self.assertEqual(self._read().get(hl[0].digest)[1][0],
+                         hashlib.sha256('y' * 1000).digest())
+
+    def test_bad(self):
+        '''Broken chunk files are rejected'''
+        header = '# digest: sha256'
+        line = '%s 1000 %s' % ('00' * 32, '11' * 32)
+        with self.assertRaises(TruncatedHashfileError):
+            chunks_from_lines([header, line])
+        with self.assertRaises(HashStringFormatError):
+            chunks_from_lines([line, 'FINAL: 1'])
+        with self.assertRaises(HashStringFormatError):
+            chunks_from_lines(['FINAL: 0'])
+        self.assertEqual(len(chunks_from_lines([header, line, 'FINAL: 1'])),
+                         1)
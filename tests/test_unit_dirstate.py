@@ -0,0 +1,130 @@
+# Unit tests for incremental scan state.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from hsync import hsync
+from hsync.dirstate import *
+
+
+class DirStateUnitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.topdir = tempfile.mkdtemp()
+        self.sig = os.path.join(self.topdir, 'HSYNC.SIG')
+        self.old = time.time() - 3600
+        os.makedirs(os.path.join(self.topdir, 'a', 'b'))
+        os.mkdir(os.path.join(self.topdir, 'c'))
+        for f in ('f1', 'a/f2', 'a/b/f3', 'c/f4'):
+            self._write(f, f)
+        for d in ('a/b', 'a', 'c'):
+            self._age(d)
+
+    def tearDown(self):
+        shutil.rmtree(self.topdir)
+
+    def _write(self, f, contents):
+        with open(os.path.join(self.topdir, f), 'w') as fh:
+            fh.write(contents)
+
+    def _age(self, path):
+        '''Make path old enough for its state to be recorded.'''
+        os.utime(os.path.join(self.topdir, path), (self.old, self.old))
+
+    def _scan(self, mode, *extra):
+        self.assertTrue(hsync.main(['-S', self.topdir, '-q',
+                                    '--incremental-scan', mode] +
+                                   list(extra)))
+        with open(self.sig) as f:
+            return sorted(l.split()[-1] for l in f
+                          if not l.startswith(('FINAL:', '#')))
+
+    def _hash(self, path):
+        with open(self.sig) as f:
+            for l in f:
+                if l.rstrip('\n').endswith(' ' + path):
+                    return l.split()[0]
+
+    def test_unchanged(self):
+        '''A rescan of an unchanged tree gives the same signature'''
+        first = self._scan('trust')
+        self.assertEqual(first, ['a', 'a/b', 'a/b/f3', 'a/f2', 'c', 'c/f4',
+                                 'f1'])
+        state = DirState.load(self.sig + '.dirs', self.sig)
+        self.assertEqual(sorted(state.dirs), ['a', 'a/b', 'c'])
+        self.assertEqual(self._scan('trust'), first)
+
+    def test_use_less_memory(self):
+        '''Unchanged directories are looked up in a disk-backed hashlist'''
+        first = self._scan('stat', '--use-less-memory')
+        self.assertEqual(self._scan('stat', '--use-less-memory'), first)
+        self._write('a/b/new', 'new')
+        self.assertEqual(self._scan('trust', '--use-less-memory'),
+                         sorted(first + ['a/b/new']))
+
+    def test_new_file(self):
+        '''New files are found, as they change their directory'''
+        self._scan('trust')
+        self._write('a/b/new', 'new')
+        self.assertIn('a/b/new', self._scan('trust'))
+
+    def test_in_place_change(self):
+        '''Only 'stat' mode sees files changed in place'''
+        self._scan('trust')
+        old = self._hash('c/f4')
+        self._write('c/f4', 'changed')
+        self._age('c')
+        self.assertEqual(self._hash('c/f4'), old)
+        self._scan('trust')
+        self.assertEqual(self._hash('c/f4'), old)
+        self._scan('stat')
+        self.assertNotEqual(self._hash('c/f4'), old)
+
+    def test_full_scan_interval(self):
+        '''A full scan sees everything'''
+        self._scan('trust')
+        old = self._hash('c/f4')
+        self._write('c/f4', 'changed')
+        self._age('c')
+        self._scan('trust', '--full-scan-interval', '0')
+        self.assertNotEqual(self._hash('c/f4'), old)
+
+    def test_options_changed(self):
+        '''A state recorded with different options isn't used'''
+        self._scan('trust')
+        self.assertNotIn('c/f4', self._scan('trust', '-X', 'c'))
+
+    def test_stale_state(self):
+        '''A state that doesn't match the signature file isn't used'''
+        self._scan('trust')
+        self.assertTrue(hsync.main(['-S', self.topdir, '-q']))
+        self.assertIsNone(DirState.load(self.sig + '.dirs', self.sig))
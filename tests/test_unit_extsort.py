@@ -0,0 +1,89 @@
+# Unit tests for the external sort.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from hsync import extsort
+from hsync.extsort import *
+
+
+class ExternalSortUnitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, True)
+
+    def test_single_run(self):
+        '''Small inputs are sorted in memory'''
+        data = [random.randint(0, 1000) for n in xrange(100)]
+        self.assertEquals(list(external_sort(data, tmpdir=self.tmp)),
+                          sorted(data))
+
+    def test_merge_runs(self):
+        '''Inputs larger than a run are spilled and merged'''
+        data = [('path%05d' % random.randint(0, 10000), n)
+                for n in xrange(1000)]
+        self.assertEquals(list(external_sort(data, run_size=64,
+                                             tmpdir=self.tmp)),
+                          sorted(data))
+
+    def test_empty(self):
+        '''Sorting nothing gives nothing'''
+        self.assertEquals(list(external_sort([], tmpdir=self.tmp)), [])
+
+    def test_default_run_size(self):
+        '''RUN_SIZE is used when no run size is given'''
+        old = (extsort.RUN_SIZE, extsort._write_run)
+        runs = []
+
+        def write_run(buf, tmpdir):
+            runs.append(len(buf))
+            return old[1](buf, tmpdir)
+
+        extsort.RUN_SIZE = 8
+        extsort._write_run = write_run
+        try:
+            self.assertEquals(list(external_sort(xrange(20, 0, -1),
+                                                 tmpdir=self.tmp)),
+                              range(1, 21))
+        finally:
+            (extsort.RUN_SIZE, extsort._write_run) = old
+        self.assertEquals(runs, [8, 8, 4])
+
+    def test_cleanup(self):
+        '''Run files don't outlive the sort'''
+        gen = external_sort(xrange(100, 0, -1), run_size=10,
+                            tmpdir=self.tmp)
+        self.assertEquals(next(gen), 1)
+        gen.close()
+        self.assertEquals(os.listdir(self.tmp), [])
@@ -27,13 +27,216 @@
 
 from __future__ import print_function
 
+import gzip
+import hashlib
+import inspect
+import os
+import shutil
+import StringIO
+import tempfile
 import unittest
 
+from hsync.exceptions import *
 from hsync.fetch import *
+from hsync.fetch import _seek_response
+from hsync.filehash import FileHash
+from hsync.hsync import getopts, init_stats
 
 
 class FetchContentsUnitTestCase(unittest.TestCase):
 
+    me = inspect.getfile(inspect.currentframe())
+    topdir = os.path.join(os.path.dirname(me), 'test')
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        (self.opts, args) = getopts(['-q'])
+        self.opts.stats = init_stats()
+
+    def tearDown(self):
+        if hasattr(self, 'tmp') and self.tmp:
+            shutil.rmtree(self.tmp, True)
+
+    def _make_file(self, name, contents):
+        fpath = os.path.join(self.tmp, name)
+        with open(fpath, 'wb') as f:
+            f.write(contents)
+        return fpath
+
     def test_null(self):
         '''Placeholder'''
         pass
+
+    def test_fetch_to_string(self):
+        '''Fetch returns the contents when no outfile is given'''
+        contents = 'OSSIFRAGE' * 10000
+        fpath = self._make_file('f1', contents)
+        self.opts.fetch_blocksize = 1000
+        self.assertEqual(fetch_contents('file://' + fpath, self.opts),
+                         contents)
+        self.assertEqual(self.opts.stats.bytes_transferred, len(contents))
+
+    def test_fetch_to_file(self):
+        '''Fetch writes blocks to outfile and returns the byte count'''
+        contents = 'OSSIFRAGE' * 10000
+        fpath = self._make_file('f1', contents)
+        outpath = os.path.join(self.tmp, 'out')
+        self.opts.fetch_blocksize = 1000
+        with open(outpath, 'wb') as outfile:
+            ret = fetch_contents('file://' + fpath, self.opts,
+                                 outfile=outfile)
+        self.assertEqual(ret, len(contents))
+        with open(outpath, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+
+    def test_fetch_empty_to_file(self):
+        '''Fetching an empty file to outfile returns zero, not None'''
+        fpath = self._make_file('f1', '')
+        outpath = os.path.join(self.tmp, 'out')
+        with open(outpath, 'wb') as outfile:
+            ret = fetch_contents('file://' + fpath, self.opts,
+                                 outfile=outfile)
+        self.assertEqual(ret, 0)
+
+    def test_fetch_missing(self):
+        '''Fetching a missing file returns None'''
+        fpath = os.path.join(self.tmp, 'nonexistent')
+        self.assertIsNone(fetch_contents('file://' + fpath, self.opts))
+
+    def test_fetch_hasher(self):
+        '''The hasher sees every block that is fetched'''
+        contents = 'OSSIFRAGE' * 10000
+        fpath = self._make_file('f1', contents)
+        self.opts.fetch_blocksize = 1000
+        md = hashlib.sha256()
+        outpath = os.path.join(self.tmp, 'out')
+        with open(outpath, 'wb') as outfile:
+            fetch_contents('file://' + fpath, self.opts, outfile=outfile,
+                           hasher=md)
+        self.assertEqual(md.hexdigest(), hashlib.sha256(contents).hexdigest())
+
+    def test_fetch_oversize_stops_early(self):
+        '''A fetch that overruns the expected size fails without finishing'''
+        contents = 'OSSIFRAGE' * 10000
+        fpath = self._make_file('f1', contents)
+        self.opts.fetch_blocksize = 1000
+        fh = FileHash.init_from_string('0 100644 %s %s 0 %d f1' % (
+            FileHash.mapper.default_name, FileHash.mapper.default_group,
+            2500))
+        md = hashlib.sha256()
+        ret = fetch_contents('file://' + fpath, self.opts, for_filehash=fh,
+                             hasher=md)
+        self.assertIsNone(ret)
+        self.assertEqual(self.opts.stats.bytes_transferred, 3000)
+
+    def test_fetch_offset(self):
+        '''A fetch from an offset returns the rest of the object'''
+        contents = 'OSSIFRAGE' * 10000
+        fpath = self._make_file('f1', contents)
+        self.opts.fetch_blocksize = 1000
+        fh = FileHash.init_from_string('0 100644 %s %s 0 %d f1' % (
+            FileHash.mapper.default_name, FileHash.mapper.default_group,
+            len(contents)))
+        ret = fetch_contents('file://' + fpath, self.opts, for_filehash=fh,
+                             offset=25000)
+        self.assertEqual(ret, contents[25000:])
+        self.assertEqual(self.opts.stats.bytes_transferred,
+                         len(contents) - 25000)
+
+    def test_fetch_range(self):
+        '''A range fetch returns just the bytes asked for'''
+        contents = 'OSSIFRAGE' * 10000
+        fpath = self._make_file('f1', contents)
+        self.opts.fetch_blocksize = 1000
+        ret = ''.join(fetch_range('file://' + fpath, 25500, 40000,
+                                  self.opts))
+        self.assertEqual(ret, contents[25500:40000])
+        self.assertEqual(self.opts.stats.bytes_transferred, 40000 - 25500)
+
+        with self.assertRaises(FetchSizeMismatchException):
+            ''.join(fetch_range('file://' + fpath, 89000, 91000, self.opts))
+
+    def test_seek_response(self):
+        '''Responses to Range requests are checked'''
+
+        class Response(object):
+            def __init__(self, code, content_range=None):
+                self.code = code
+                self.headers = {'content-range': content_range}
+
+            def getcode(self):
+                return self.code
+
+            def info(self):
+                return self
+
+            def getheader(self, name):
+                return self.headers[name]
+
+        # Range ignored, everything has to be skipped.
+        self.assertEqual(_seek_response(Response(200), 100), 100)
+        self.assertEqual(
+            _seek_response(Response(206, 'bytes 100-199/200'), 100), 0)
+        self.assertEqual(
+            _seek_response(Response(206, 'bytes 50-199/200'), 100), 50)
+        self.assertIsNone(
+            _seek_response(Response(206, 'bytes 150-199/200'), 100))
+        self.assertIsNone(_seek_response(Response(206), 100))
+
+    def test_fetch_lines(self):
+        '''fetch_lines() yields lines without line endings'''
+        lines = ['line %d' % n for n in xrange(5000)]
+        fpath = self._make_file('f1', '\n'.join(lines))
+        self.opts.fetch_blocksize = 1000
+        self.assertEqual(list(fetch_lines('file://' + fpath, self.opts)),
+                         lines)
+
+    def test_fetch_lines_missing(self):
+        '''fetch_lines() returns None for a missing file'''
+        fpath = os.path.join(self.tmp, 'nonexistent')
+        self.assertIsNone(fetch_lines('file://' + fpath, self.opts))
+
+    def test_split_lines(self):
+        '''Lines split across blocks are joined up'''
+        blocks = ['a\nb', 'c', 'd\r\n', '\ne\n']
+        self.assertEqual(list(split_lines(blocks)),
+                         ['a', 'bcd', '', 'e'])
+
+    def test_fetch_lines_compressed(self):
+        '''Compressed objects are decompressed as they arrive'''
+        lines = ['line %d' % n for n in xrange(5000)]
+        fpath = os.path.join(self.tmp, 'f1.gz')
+        f = gzip.open(fpath, 'wb')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+        self.opts.fetch_blocksize = 100
+        self.assertEqual(list(fetch_lines('file://' + fpath, self.opts,
+                                          compressed=True)),
+                         lines)
+
+    def test_gunzip_multiple_members(self):
+        '''Concatenated gzip members are all decompressed'''
+        data = ''
+        for text in ('first\n', 'second\n'):
+            buf = StringIO.StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb')
+            f.write(text)
+            f.close()
+            data += buf.getvalue()
+        blocks = [data[n:n + 7] for n in xrange(0, len(data), 7)]
+        self.assertEqual(''.join(gunzip_blocks(blocks)), 'first\nsecond\n')
+
+    def test_gunzip_truncated(self):
+        '''A gzip stream that stops early is an error'''
+        buf = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb')
+        f.write('some text\n' * 100)
+        f.close()
+        data = buf.getvalue()
+        self.assertEqual(''.join(gunzip_blocks([data, data])),
+                         'some text\n' * 200)
+        for size in (0, 5, len(data) // 2, len(data) - 1):
+            with self.assertRaises(TruncatedHashfileError):
+                ''.join(gunzip_blocks([data[:size]]))
+        with self.assertRaises(TruncatedHashfileError):
+            ''.join(gunzip_blocks([data, data[:-8]]))
@@ -27,6 +27,7 @@
 
 from __future__ import print_function
 
+import hashlib
 import inspect
 import cPickle as pickle
 import os
@@ -203,6 +204,33 @@ class FileHashCreateFromStringTestCase(unittest.TestCase):
         self.assertTrue(fh.size, 100)
         self.assertEquals(fh.fpath, '/etc/hosts in space')
 
+    def test_hashstr_stored_raw(self):
+        '''Hex hashes are kept as raw digests, others as strings'''
+        md = hashlib.sha256('Rhubarb').hexdigest()
+        fstr = '%s 100644 %s %s %s 7 f1' % \
+            (md, self.user, self.group, int(time.time()))
+        fh = FileHash.init_from_string(fstr)
+        self.assertEqual(fh.hashstr, md)
+        self.assertEqual(fh.digest, hashlib.sha256('Rhubarb').digest())
+        self.assertEqual(fh.presentation_format(), fstr)
+
+        fh.hashstr = FileHash.notsethash
+        self.assertEqual(fh.hashstr, FileHash.notsethash)
+        self.assertIsNone(fh.digest)
+
+        fh.hashstr = md.upper()
+        self.assertEqual(fh.hashstr, md.upper())
+
+    def test_compact(self):
+        '''FileHash has no __dict__, and shares user and group names'''
+        fstr = '0 100644 %s %s %s 100 f1' % \
+            (self.user, self.group, int(time.time()))
+        fha = FileHash.init_from_string(fstr)
+        fhb = FileHash.init_from_string(fstr)
+        self.assertFalse(hasattr(fha, '__dict__'))
+        self.assertIs(fha.user, fhb.user)
+        self.assertIs(fha.group, fhb.group)
+
 
 class FileHashCompareUnitTestCase(unittest.TestCase):
 
@@ -487,3 +515,17 @@ class FileHashObjectPicklableUnitTestcase(unittest.TestCase):
         fh = FileHash.init_from_file(tname) # Same object.
         p2 = pickle.dumps(fha)
         self.assertEqual(p, p2, "Pickles of same filehash are the same")
+
+    def test_unpickle(self):
+        '''A FileHash survives a pickle round trip'''
+        tname = os.path.join(self.topdir, 'testfile_pickle')
+        with open(tname, "wb") as f:
+            f.write("Rhubarb")
+        fha = FileHash.init_from_file(tname)
+        for protocol in (0, pickle.HIGHEST_PROTOCOL):
+            fh = pickle.loads(pickle.dumps(fha, protocol))
+            self.assertEqual(fh, fha)
+            self.assertEqual(fh.hashstr, fha.hashstr)
+            self.assertTrue(fh.compare(fha))
+            self.assertFalse(hasattr(fh, 'link_target'),
+                             "Unset attributes stay unset")
@@ -0,0 +1,137 @@
+# Unit tests for the stat-caching filesystem walker.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from hsync.fswalk import *
+from hsync.stats import StatsCollector
+
+
+class FsWalkUnitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.topdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.topdir, 'a', 'b'))
+        os.mkdir(os.path.join(self.topdir, 'c'))
+        for f in ('f1', 'a/f2', 'a/b/f3'):
+            with open(os.path.join(self.topdir, f), 'w') as fh:
+                fh.write(f)
+        os.symlink('a', os.path.join(self.topdir, 'dirlink'))
+        os.symlink('f1', os.path.join(self.topdir, 'filelink'))
+        os.symlink('nonexistent', os.path.join(self.topdir, 'broken'))
+
+    def tearDown(self):
+        shutil.rmtree(self.topdir)
+
+    def _normalise(self, it):
+        return [(root, sorted(dirs), sorted(files)) for
+                (root, dirs, files) in it]
+
+    def test_same_as_os_walk(self):
+        '''walk() gives the same answers as os.walk()'''
+        ours = self._normalise((r, d, f) for (r, d, f, c)
+                               in walk(self.topdir))
+        theirs = self._normalise(os.walk(self.topdir))
+        self.assertEquals(sorted(ours), sorted(theirs))
+
+    def test_stat_cache(self):
+        '''Each entry has its lstat() result'''
+        for root, dirs, files, stat_cache in walk(self.topdir):
+            self.assertEquals(set(stat_cache.keys()), set(dirs + files))
+            for name in dirs + files:
+                self.assertEquals(stat_cache[name],
+                                  os.lstat(os.path.join(root, name)))
+
+    def test_prune(self):
+        '''Removing a dir from dirs stops the walk descending into it'''
+        roots = []
+        for root, dirs, files, stat_cache in walk(self.topdir):
+            roots.append(root)
+            if 'a' in dirs:
+                dirs.remove('a')
+        self.assertNotIn(os.path.join(self.topdir, 'a'), roots)
+
+    def test_dir_hook(self):
+        '''The hook sees each directory before it's listed'''
+        seen = []
+        for root, dirs, files, stat_cache in walk(self.topdir,
+                                                  dir_hook=seen.append):
+            self.assertEquals(seen[-1], root)
+        self.assertEquals(len(seen), len(list(os.walk(self.topdir))))
+
+    def test_no_recurse(self):
+        '''Only the top directory is listed without recursion'''
+        roots = [root for (root, dirs, files, stat_cache)
+                 in walk(self.topdir, recurse=False)]
+        self.assertEquals(roots, [self.topdir])
+
+    def test_stats(self):
+        '''Stat calls are counted'''
+        s = StatsCollector.init('teststats',
+                                ['stat_calls', 'stat_calls_saved'])
+        list(walk(self.topdir, s))
+        # Nine objects, plus one stat() for each of the three symlinks.
+        self.assertEquals(s.stat_calls, 12)
+        # os.walk() would classify every entry, and lstat() the three
+        # real directories again. We spend three extra on symlinks.
+        self.assertEquals(s.stat_calls_saved, 0)
+
+    def test_listing(self):
+        '''Unchanged directories come from the listing'''
+        class Listing(object):
+            def __init__(self, stat_files):
+                self.stat_files = stat_files
+                self.put_paths = []
+
+            def get(self, path, st):
+                if path.endswith('/a'):
+                    return (['b', 'gone'], ['f2', 'vanished'],
+                            self.stat_files)
+                return None
+
+            def put(self, path, st, dirs):
+                self.put_paths.append(path)
+
+        topa = os.path.join(self.topdir, 'a')
+        for stat_files in (True, False):
+            listing = Listing(stat_files)
+            found = dict((root, (dirs, files, stat_cache)) for
+                         (root, dirs, files, stat_cache)
+                         in walk(self.topdir, listing=listing))
+            (dirs, files, stat_cache) = found[topa]
+            self.assertEquals(dirs, ['b'])
+            if stat_files:
+                self.assertEquals(files, ['f2'])
+                self.assertEquals(sorted(stat_cache), ['b', 'f2'])
+            else:
+                self.assertEquals(files, ['f2', 'vanished'])
+                self.assertEquals(sorted(stat_cache), ['b'])
+            self.assertNotIn(topa, listing.put_paths)
+            self.assertIn(os.path.join(topa, 'b'), listing.put_paths)
@@ -0,0 +1,157 @@
+# Unit tests for the destination hash cache.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from hsync.filehash import FileHash
+from hsync.hashcache import *
+from hsync.hashlist_op_impl import hashlist_generate
+from hsync.hsync import getopts, init_stats
+
+
+class HashCacheUnitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'HSYNC.SIG.cache')
+        self.top = os.path.join(self.tmp, 'top')
+        os.mkdir(self.top)
+        for name in ('f1', 'f2'):
+            with open(os.path.join(self.top, name), 'w') as f:
+                f.write(name)
+        # Everything here is brand new, so pretend it's later than it is.
+        self.later = time.time() + 60
+        (self.opts, args) = getopts(['-q'])
+        self.opts.stats = init_stats()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, True)
+
+    def _stat(self, name):
+        return os.lstat(os.path.join(self.top, name))
+
+    def test_lookup(self):
+        '''A digest is found again while the file is unchanged'''
+        cache = HashCache(self.path, now=self.later)
+        cache.add(self._stat('f1'), 'a' * 32)
+        cache.close()
+
+        cache = HashCache(self.path, now=self.later)
+        self.assertEqual(cache.lookup(self._stat('f1')), 'a' * 32)
+        self.assertIsNone(cache.lookup(self._stat('f2')))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Any change to the ctime is enough.
+        os.chmod(os.path.join(self.top, 'f1'), 0600)
+        self.assertIsNone(cache.lookup(self._stat('f1')))
+        cache.close()
+
+    def test_racy(self):
+        '''Files changed too recently aren't cached'''
+        cache = HashCache(self.path)
+        cache.add(self._stat('f1'), 'a' * 32)
+        cache.close()
+        cache = HashCache(self.path)
+        self.assertIsNone(cache.lookup(self._stat('f1')))
+        cache.abandon()
+
+    def test_replaced(self):
+        '''Each use replaces the cache, so files not seen drop out'''
+        cache = HashCache(self.path, now=self.later)
+        cache.add(self._stat('f1'), 'a' * 32)
+        cache.add(self._stat('f2'), 'b' * 32)
+        cache.close()
+        cache = HashCache(self.path, now=self.later)
+        cache.add(self._stat('f2'), 'b' * 32)
+        cache.close()
+        cache = HashCache(self.path, now=self.later)
+        self.assertIsNone(cache.lookup(self._stat('f1')))
+        self.assertEqual(cache.lookup(self._stat('f2')), 'b' * 32)
+        cache.close()
+
+    def test_abandon(self):
+        '''An abandoned cache is left as it was'''
+        cache = HashCache(self.path, now=self.later)
+        cache.add(self._stat('f1'), 'a' * 32)
+        cache.close()
+        cache = HashCache(self.path, now=self.later)
+        cache.abandon()
+        cache = HashCache(self.path, now=self.later)
+        self.assertEqual(cache.lookup(self._stat('f1')), 'a' * 32)
+        cache.close()
+
+    def test_digest(self):
+        '''Digests from another algorithm aren't used'''
+        cache = HashCache(self.path, now=self.later)
+        cache.add(self._stat('f1'), 'a' * 32)
+        cache.close()
+
+        cache = HashCache(self.path, digest_name='blake2b-256',
+                          now=self.later)
+        self.assertIsNone(cache.lookup(self._stat('f1')))
+        cache.add(self._stat('f1'), 'b' * 32)
+        cache.close()
+
+        cache = HashCache(self.path, now=self.later)
+        self.assertIsNone(cache.lookup(self._stat('f1')))
+        cache.close()
+
+    def test_corrupt(self):
+        '''A corrupt cache is thrown away'''
+        with open(self.path, 'w') as f:
+            f.write('not a database' * 100)
+        cache = HashCache(self.path, now=self.later)
+        self.assertIsNone(cache.lookup(self._stat('f1')))
+        cache.close()
+
+    def test_scan(self):
+        '''A scan with the cache doesn't read files it already knows'''
+        cache = HashCache(self.path, now=self.later)
+        first = hashlist_generate(self.top, self.opts, source_mode=False,
+                                  hash_cache=cache)
+        cache.close()
+
+        def no_reading(fh):
+            raise AssertionError("'%s' was read" % fh.fpath)
+
+        cache = HashCache(self.path, now=self.later)
+        saved = FileHash.hash_file
+        FileHash.hash_file = no_reading
+        try:
+            second = hashlist_generate(self.top, self.opts,
+                                       source_mode=False, hash_cache=cache)
+        finally:
+            FileHash.hash_file = saved
+        cache.close()
+        self.assertEqual([fh.presentation_format() for fh in first],
+                         [fh.presentation_format() for fh in second])
+        self.assertEqual(cache.hits, 2)
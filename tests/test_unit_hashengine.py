@@ -0,0 +1,197 @@
+# Unit tests for the file hashing engine.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from hsync.filehash import FileHash
+from hsync.hashengine import *
+
+
+class HashEngineUnitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, True)
+
+    def _file(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_hash_path(self):
+        '''Files are hashed the same whatever the block size'''
+        data = os.urandom(10000)
+        path = self._file('f', data)
+        for block_size in (1, 7, 4096, 10000, 10001, HASH_BLOCKSIZE):
+            engine = HashEngine(block_size=block_size)
+            result = engine.hash_path(path)
+            self.assertEqual(result.digest, hashlib.sha256(data).digest())
+            self.assertEqual(result.nbytes, len(data))
+
+    def test_empty(self):
+        '''Empty files hash as empty strings'''
+        path = self._file('empty', '')
+        result = HashEngine().hash_path(path)
+        self.assertEqual(result.digest, hashlib.sha256('').digest())
+        self.assertEqual(result.nbytes, 0)
+
+    def test_no_fadvise(self):
+        '''Hashing works without posix_fadvise()'''
+        path = self._file('f', 'contents')
+        result = HashEngine(fadvise=False).hash_path(path)
+        self.assertEqual(result.digest, hashlib.sha256('contents').digest())
+
+    def test_totals(self):
+        '''The totals cover every call'''
+        engine = HashEngine()
+        engine.hash_path(self._file('f1', 'a' * 100))
+        engine.hash_path(self._file('f2', 'b' * 50))
+        (files, nbytes, seconds) = engine.totals()
+        self.assertEqual((files, nbytes), (2, 150))
+        self.assertGreaterEqual(seconds, 0.0)
+
+    def test_missing(self):
+        '''A missing file raises IOError'''
+        engine = HashEngine()
+        with self.assertRaises(IOError):
+            engine.hash_path(os.path.join(self.tmp, 'nonexistent'))
+        self.assertEqual(engine.totals()[0], 0)
+
+    def test_threads(self):
+        '''Threads don't share a buffer'''
+        engine = HashEngine(block_size=16)
+        paths = [self._file('f%d' % n, os.urandom(1000 + n))
+                 for n in xrange(8)]
+        results = {}
+
+        def hash_all(tid):
+            for path in paths:
+                results[(tid, path)] = engine.hash_path(path).digest
+
+        threads = [threading.Thread(target=hash_all, args=(tid,))
+                   for tid in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for path in paths:
+            with open(path, 'rb') as f:
+                want = hashlib.sha256(f.read()).digest()
+            for tid in xrange(4):
+                self.assertEqual(results[(tid, path)], want)
+
+    def test_digests(self):
+        '''Only known, available algorithms can be used'''
+        self.assertIn('sha256', digest_names())
+        for name in ('md5', 'sha1', 'blake2b', ''):
+            with self.assertRaises(UnknownDigestError):
+                check_digest(name)
+        for name in DIGEST_IDS:
+            if name in digest_names():
+                self.assertEqual(new_digest(name).digest_size, 32)
+            else:
+                with self.assertRaises(UnknownDigestError):
+                    new_digest(name)
+
+        engine = HashEngine()
+        self.assertEqual(engine.digest_name, DEFAULT_DIGEST)
+        with self.assertRaises(UnknownDigestError):
+            engine.use_digest('md5')
+        self.assertEqual(engine.digest_name, DEFAULT_DIGEST)
+
+    @unittest.skipUnless('blake2b-256' in digest_names(),
+                         "BLAKE2 isn't available")
+    def test_blake2(self):
+        '''Files can be hashed with BLAKE2'''
+        path = self._file('f', 'contents')
+        engine = HashEngine(digest_name='blake2b-256')
+        digest = engine.hash_path(path).digest
+        self.assertEqual(len(digest), 32)
+        self.assertNotEqual(digest, hashlib.sha256('contents').digest())
+        self.assertEqual(engine.hash_path(path, 'sha256').digest,
+                         hashlib.sha256('contents').digest())
+
+    def test_header(self):
+        '''Digest headers are recognised'''
+        self.assertEqual(digest_header('sha256'), '# digest: sha256')
+        self.assertEqual(header_digest('# digest: sha256'), 'sha256')
+        self.assertIsNone(header_digest('# something else'))
+        with self.assertRaises(UnknownDigestError):
+            header_digest('# digest: md5')
+
+    def test_filehash(self):
+        '''FileHash uses the engine'''
+        path = self._file('f', 'contents')
+        fh = FileHash.init_from_file(path, trim=True, root=self.tmp)
+        self.assertEqual(fh.hashstr, hashlib.sha256('contents').hexdigest())
+
+    def test_chunks(self):
+        '''Chunk digests are the same whatever the block size'''
+        data = os.urandom(10000)
+        path = self._file('f', data)
+        for chunk_size in (1000, 3000, 10000, 20000):
+            want = [hashlib.sha256(data[n:n + chunk_size]).digest()
+                    for n in xrange(0, len(data), chunk_size)]
+            for block_size in (1, 7, 4096, HASH_BLOCKSIZE):
+                engine = HashEngine(block_size=block_size)
+                result = engine.hash_path(path, chunk_size=chunk_size)
+                self.assertEqual(result.digest, hashlib.sha256(data).digest())
+                self.assertEqual(result.chunks, want)
+
+        self.assertIsNone(HashEngine().hash_path(path).chunks)
+        self.assertEqual(HashEngine().hash_path(
+            self._file('empty', ''), chunk_size=1000).chunks, [])
+
+    def test_record_chunks(self):
+        '''Chunks are recorded for large files'''
+        small = self._file('small', 'a' * 100)
+        big = self._file('big', 'b' * 2500)
+        engine = HashEngine()
+        engine.record_chunks(1000, 1000)
+        small_digest = engine.hash_path(small).digest
+        big_digest = engine.hash_path(big).digest
+        self.assertIsNone(engine.take_chunks(small_digest))
+        self.assertEqual(engine.take_chunks(big_digest),
+                         [hashlib.sha256('b' * 1000).digest()] * 2 +
+                         [hashlib.sha256('b' * 500).digest()])
+        self.assertIsNone(engine.take_chunks(big_digest))
+
+        engine.hash_path(big)
+        engine.record_chunks(None, None)
+        self.assertIsNone(engine.take_chunks(big_digest))
+        engine.hash_path(big)
+        self.assertIsNone(engine.take_chunks(big_digest))
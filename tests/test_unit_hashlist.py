@@ -139,6 +139,93 @@ class HashListTestCase(unittest.TestCase):
             for n in xrange(1000):
                 self.assertEqual(hl[n], fhlist[n])
 
+    def test_path_ordered(self):
+        '''Path order is tracked on append and restored by sorting'''
+        for T in self.all_impl:
+            hl = T()
+            pfx = "0 100644 %s %s 0 0 " % (self.user, self.group)
+
+            for f in ('a', 'a/1', 'b'):
+                hl.append(FileHash.init_from_string(pfx + f))
+            self.assertTrue(hl.path_ordered)
+
+            hl.append(FileHash.init_from_string(pfx + 'a/2'))
+            self.assertFalse(hl.path_ordered)
+
+            hl.sort_by_path()
+            self.assertTrue(hl.path_ordered)
+            self.assertEqual([fh.fpath for fh in hl],
+                             ['a', 'a/1', 'a/2', 'b'])
+
+            hl.append(FileHash.init_from_string(pfx + 'c'))
+            self.assertTrue(hl.path_ordered)
+
+    def test_children(self):
+        '''The entries directly in a directory are found by name'''
+        for T in self.all_impl:
+            hl = T(raise_on_duplicates=False, warn_on_duplicates=False)
+            pfx = "0 100644 %s %s 0 %%d " % (self.user, self.group)
+            for (n, f) in enumerate(('a', 'a/1', 'a/2/x', 'a-b', 'b',
+                                     'a0', 'a/1')):
+                hl.append(FileHash.init_from_string(pfx % n + f))
+
+            self.assertEqual(sorted(hl.children('')),
+                             ['a', 'a-b', 'a0', 'b'])
+            a = hl.children('a')
+            self.assertEqual(sorted(a), ['1'])
+            self.assertEqual(a['1'].size, 6)
+            self.assertEqual(sorted(hl.children('a/2')), ['x'])
+            self.assertEqual(hl.children('c'), {})
+
+            hl.append(FileHash.init_from_string(pfx % 7 + 'a/3'))
+            self.assertEqual(sorted(hl.children('a')), ['1', '3'])
+
+    def test_sort_indexing(self):
+        '''Indexing follows the sorted order'''
+        for T in self.all_impl:
+            hl = T()
+            pfx = "0 100644 %s %s 0 0 " % (self.user, self.group)
+            paths = ['%0.4i' % ((n * 7919) % 2500) for n in xrange(2500)]
+            for f in paths:
+                hl.append(FileHash.init_from_string(pfx + f))
+
+            hl.sort_by_path()
+            paths.sort()
+            for n in (0, 1, 1234, 2499, -1):
+                self.assertEqual(hl[n].fpath, paths[n])
+            with self.assertRaises(IndexError):
+                hl[2500]
+
+    def test_sqlite_round_trip(self):
+        '''SqliteHashList gives back what was put in'''
+        def state(fh):
+            st = fh.__getstate__()
+            del st['strhash_value'], st['hash_value']
+            if st.get('associated_dest_object') is not None:
+                st['associated_dest_object'] = \
+                    state(st['associated_dest_object'])
+            return st
+
+        fhlist = [
+            FileHash.init_from_file(self.me),
+            FileHash.init_from_file(self.me, defer_read=True),
+            FileHash.init_from_file(self.topdir),
+            FileHash.init_from_string("0 120777 %s %s 0 0 link>>> target" %
+                                      (self.user, self.group), root='/'),
+            FileHash.init_from_string("%s 100644 %s %s 0 7 f" %
+                                      (FileHash.notsethash,
+                                       self.user, self.group)),
+        ]
+        fhlist[0].compare(fhlist[1])
+        fhlist[0].associated_dest_object = fhlist[1]
+
+        hl = SqliteHashList()
+        hl.extend(fhlist)
+        for n, fh in enumerate(hl):
+            self.assertEqual(state(fh), state(fhlist[n]))
+            self.assertEqual(state(hl[n]), state(fhlist[n]))
+            self.assertEqual(fh, fhlist[n])
+
 
 class HashDictTestCase(unittest.TestCase):
 
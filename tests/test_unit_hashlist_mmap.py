@@ -0,0 +1,225 @@
+# Unit tests for the mmap-backed hashlist.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from hsync.exceptions import *
+from hsync.hashlist_mmap import *
+from hsync.hashlist_op_impl import *
+from hsync.hsync import getopts, init_stats
+from hsync.idmapper import UidGidMapper
+
+
+class MmapHashListUnitTestCase(unittest.TestCase):
+
+    mapper = UidGidMapper()
+
+    paths = ['a', 'a-b', 'a-b/1', 'a/1', 'a/2', 'a/2/x', 'ab', 'b']
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        (self.opts, args) = getopts(['-q'])
+        self.opts.stats = init_stats()
+        self.user = self.mapper.get_name_for_uid(os.getuid())
+        self.group = self.mapper.get_group_for_gid(os.getgid())
+
+        lines = ['%064x 100644 %s %s 0 %d %s' %
+                 (n + 1, self.user, self.group, n, p)
+                 for (n, p) in enumerate(self.paths)]
+        self.hl = hashlist_from_stringlist(lines, self.opts, root=self.tmp)
+        self.text = os.path.join(self.tmp, 'HSYNC.SIG')
+        self.binary = self.text + '.bin'
+        sigfile_write(self.hl, self.text, self.opts, binary_path=self.binary)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, True)
+
+    def _open(self, path, **kwargs):
+        return MmapHashList(open(path, 'rb'), self.opts, root=self.tmp,
+                            **kwargs)
+
+    def test_entries(self):
+        '''Text and binary signatures give the same entries'''
+        for path in (self.text, self.binary):
+            mhl = self._open(path)
+            self.assertEqual(len(mhl), len(self.paths))
+            self.assertTrue(mhl.path_ordered)
+            for (n, fh) in enumerate(mhl):
+                self.assertEqual(fh.presentation_format(),
+                                 self.hl[n].presentation_format())
+                self.assertEqual(mhl[n], self.hl[n])
+                self.assertEqual(mhl.path(n), self.paths[n])
+            self.assertEqual(mhl[-1].fpath, 'b')
+            mhl.close()
+
+    def test_cache(self):
+        '''Decoded entries are cached, up to a limit'''
+        mhl = self._open(self.text, cache_size=2)
+        fh = mhl[0]
+        self.assertIs(mhl[0], fh)
+        mhl[1]
+        mhl[2]
+        self.assertIsNot(mhl[0], fh)
+        self.assertEqual(len(mhl.cache), 2)
+        mhl.close()
+
+    def test_subtree_ranges(self):
+        '''Subtrees are found by binary search'''
+        for path in (self.text, self.binary):
+            mhl = self._open(path)
+            for (inc, expect) in (
+                    (['a'], ['a', 'a/1', 'a/2', 'a/2/x']),
+                    (['a/'], ['a', 'a/1', 'a/2', 'a/2/x']),
+                    (['a/2', 'b'], ['a/2', 'a/2/x', 'b']),
+                    (['a', 'a/2'], ['a', 'a/1', 'a/2', 'a/2/x']),
+                    (['a-b', 'ab'], ['a-b', 'a-b/1', 'ab']),
+                    (['c'], [])):
+                self.assertEqual([fh.fpath for fh in
+                                  included_entries(mhl, inc)], expect)
+                self.assertEqual([fh.fpath for fh in
+                                  included_entries(self.hl, inc)], expect)
+            mhl.close()
+
+    def test_children(self):
+        '''The entries directly in a directory are found by name'''
+        for path in (self.text, self.binary):
+            mhl = self._open(path)
+            for (d, expect) in (('', ['a', 'a-b', 'ab', 'b']),
+                                ('a', ['1', '2']), ('a/2', ['x']),
+                                ('c', [])):
+                self.assertEqual(sorted(mhl.children(d)), expect)
+                self.assertEqual(sorted(self.hl.children(d)), expect)
+            mhl.close()
+
+    def test_find(self):
+        '''Paths are found by binary search'''
+        for path in (self.text, self.binary):
+            mhl = self._open(path)
+            for p in self.paths:
+                pos = mhl.find(p)
+                self.assertEqual(next(mhl.entries(pos, mhl.end_pos)).fpath,
+                                 p)
+            for p in ('', 'a/', 'a/0', 'c'):
+                self.assertIsNone(mhl.find(p))
+            mhl.close()
+
+    def test_lazy_index(self):
+        '''A text signature is only indexed if entries are numbered'''
+        mhl = self._open(self.text)
+        self.assertEqual([fh.fpath for fh in included_entries(mhl, ['a'])],
+                         ['a', 'a/1', 'a/2', 'a/2/x'])
+        self.assertIsNotNone(mhl.find('b'))
+        self.assertEqual([fh.fpath for fh in mhl], self.paths)
+        self.assertIsNone(mhl.offsets)
+        self.assertEqual(len(mhl), len(self.paths))
+        self.assertIsNotNone(mhl.offsets)
+        mhl.close()
+
+    def test_search(self):
+        '''Searching a large text signature agrees with a plain scan'''
+        rand = random.Random(1)
+        paths = sorted(set(
+            '/'.join(rand.choice(['a', 'b', 'c-d', 'e' * 50])
+                     for n in xrange(rand.randint(1, 4)))
+            for m in xrange(500)))
+        lines = ['%064x 100644 %s %s 0 %d %s' %
+                 (n + 1, self.user, self.group, n, p)
+                 for (n, p) in enumerate(paths)]
+        hl = hashlist_from_stringlist(lines, self.opts, root=self.tmp)
+        sigfile_write(hl, self.text, self.opts)
+        mhl = self._open(self.text)
+        for inc in (['a'], ['b/a'], ['c-d', 'e' * 50], ['a/b/c-d'], ['z']):
+            self.assertEqual([fh.fpath for fh in included_entries(mhl, inc)],
+                             [fh.fpath for fh in included_entries(hl, inc)])
+        for p in paths + ['', 'a/', 'b/z', 'zz']:
+            self.assertEqual(mhl.find(p) is not None, p in paths, p)
+        mhl.close()
+
+    def test_entries_outside(self):
+        '''Skipped subtrees are jumped over'''
+        for path in (self.text, self.binary):
+            mhl = self._open(path)
+            for (prefixes, expect) in (
+                    (['a/'], ['a', 'a-b', 'a-b/1', 'ab', 'b']),
+                    (['a-b/', 'a/2/'], ['a', 'a-b', 'a/1', 'a/2', 'ab', 'b']),
+                    ([''], []),
+                    ([], self.paths)):
+                self.assertEqual([fh.fpath for fh in
+                                  entries_outside(mhl, prefixes)], expect)
+                self.assertEqual([fh.fpath for fh in
+                                  entries_outside(self.hl, prefixes)], expect)
+            mhl.close()
+
+    def test_hashfiles_skipped(self):
+        '''Hash and lock files are left out, as by the other readers'''
+        hl = HashList()
+        for (n, p) in enumerate(['HSYNC.SIG', 'a', 'a/HSYNC.SIG.lock',
+                                 'a/1', 'b']):
+            hl.append(FileHash.init_from_string(
+                '%064x 100644 %s %s 0 %d %s' %
+                (n + 1, self.user, self.group, n, p)))
+        sigfile_write(hl, self.text, self.opts, binary_path=self.binary)
+
+        expect = ['a', 'a/1', 'b']
+        with open(self.text) as f:
+            self.assertEqual([fh.fpath for fh in hashlist_from_stringlist(
+                (l.rstrip('\n') for l in f), self.opts, root=self.tmp)],
+                expect)
+        with open(self.binary, 'rb') as f:
+            self.assertEqual([fh.fpath for fh in hashlist_from_sigbin(
+                f, self.opts, root=self.tmp)], expect)
+
+        for path in (self.text, self.binary):
+            mhl = self._open(path)
+            self.assertEqual([fh.fpath for fh in mhl], expect)
+            self.assertEqual(len(mhl), len(expect))
+            self.assertEqual([mhl[n].fpath for n in xrange(len(mhl))],
+                             expect)
+            self.assertEqual(sorted(mhl.children('a')), ['1'])
+            self.assertIsNone(mhl.find('HSYNC.SIG'))
+            self.assertIsNotNone(mhl.find('b'))
+            mhl.close()
+
+    def test_read_only(self):
+        '''Entries can't be added'''
+        mhl = self._open(self.text)
+        with self.assertRaises(ReadOnlyHashListError):
+            mhl.append(self.hl[0])
+        mhl.close()
+
+    def test_truncated(self):
+        '''A text signature without a FINAL: line is rejected'''
+        with open(self.text) as f:
+            lines = f.readlines()
+        with open(self.text, 'w') as f:
+            f.writelines(lines[:-1])
+        with self.assertRaises(TruncatedHashfileError):
+            self._open(self.text)
@@ -0,0 +1,224 @@
+# Unit tests for hashlist operations.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from hsync import extsort
+from hsync.exceptions import *
+from hsync.filehash import *
+from hsync.hashengine import UnknownDigestError, digest_names
+from hsync.hashlist_op_impl import *
+from hsync.hashlist_sqlite import SqliteHashList
+from hsync.hsync import getopts, init_stats
+from hsync.idmapper import *
+
+
+class HashListOpTestCase(unittest.TestCase):
+
+    mapper = UidGidMapper()
+
+    def setUp(self):
+        (self.opts, args) = getopts(['-q'])
+        self.opts.stats = init_stats()
+        self.user = self.mapper.get_name_for_uid(os.getuid())
+        self.group = self.mapper.get_group_for_gid(os.getgid())
+
+    def _lines(self, n):
+        return ['%064x 100644 %s %s 0 %d file%06d' %
+                (i, self.user, self.group, i, i) for i in xrange(n)]
+
+    def _parse(self, lines, **kwargs):
+        return hashlist_from_stringlist(lines, self.opts, root='/tmp',
+                                        **kwargs)
+
+    def test_from_stringlist_iterator(self):
+        '''Any iterable of lines can be parsed'''
+        lines = self._lines(100)
+        hl = self._parse(iter(lines))
+        self.assertEqual([fh.fpath for fh in hl],
+                         ['file%06d' % i for i in xrange(100)])
+
+    def test_from_stringlist_comments(self):
+        '''Comment lines are not parsed as entries'''
+        lines = ['# a comment'] + self._lines(3)
+        hl = self._parse(lines)
+        self.assertEqual(len(hl), 3)
+
+    def test_from_stringlist_digest(self):
+        '''The digest header names the algorithm'''
+        self.assertEqual(self._parse(self._lines(3)).digest_name, 'sha256')
+        hl = self._parse(['# digest: sha256'] + self._lines(3))
+        self.assertEqual(hl.digest_name, 'sha256')
+        self.assertEqual(len(hl), 3)
+
+        with self.assertRaises(UnknownDigestError):
+            self._parse(['# digest: md4'] + self._lines(3))
+
+        # A journal written with a different algorithm, as happens if the
+        # source changes algorithm and the destination is interrupted.
+        hl = self._parse(self._lines(3) + ['# digest: sha256'])
+        self.assertEqual(hl.digest_name, 'sha256')
+        lines = ['# digest: sha256'] + self._lines(3) + \
+            ['# digest: blake2b-256']
+        if 'blake2b-256' in digest_names():
+            self.assertIsNone(self._parse(lines).digest_name)
+        else:
+            with self.assertRaises(UnknownDigestError):
+                self._parse(lines)
+
+    def test_from_stringlist_final(self):
+        '''A missing FINAL: line is detected if required'''
+        lines = self._lines(3) + ['FINAL: %s' % ('0' * 64)]
+        hl = self._parse(lines, require_final=True)
+        self.assertEqual(len(hl), 3)
+
+        with self.assertRaises(TruncatedHashfileError):
+            self._parse(lines[:-1], require_final=True)
+        with self.assertRaises(TruncatedHashfileError):
+            self._parse([], require_final=True)
+
+        # Not required, no error.
+        hl = self._parse(lines[:-1])
+        self.assertEqual(len(hl), 3)
+
+    def _hashlist(self, paths):
+        return self._parse(['%s 100644 %s %s 0 0 %s' %
+                            ('0' * 64, self.user, self.group, p)
+                            for p in paths])
+
+    def test_merge_by_path(self):
+        '''Sorted hashlists are paired up by path'''
+        src = self._hashlist(['a', 'b', 'd', 'e'])
+        dst = self._hashlist(['b', 'c', 'e', 'f'])
+        pairs = [(s.fpath if s else None, d.fpath if d else None)
+                 for (s, d) in merge_by_path(src, dst)]
+        self.assertEqual(pairs, [('a', None), ('b', 'b'), (None, 'c'),
+                                 ('d', None), ('e', 'e'), (None, 'f')])
+
+    def test_merge_by_path_empty(self):
+        '''Either hashlist can be empty'''
+        src = self._hashlist(['a', 'b'])
+        empty = self._hashlist([])
+        self.assertEqual([(s.fpath, d) for (s, d) in
+                          merge_by_path(src, empty)],
+                         [('a', None), ('b', None)])
+        self.assertEqual([(s, d.fpath) for (s, d) in
+                          merge_by_path(empty, src)],
+                         [(None, 'a'), (None, 'b')])
+
+    def test_sigfile_write_unsorted(self):
+        '''An unsorted hashlist is written in path order, and left alone'''
+        tmp = tempfile.mkdtemp()
+        old_run_size = extsort.RUN_SIZE
+        # Make sure the sort spills.
+        extsort.RUN_SIZE = 2
+        try:
+            paths = ['c', 'a', 'b/1', 'b', 'b/0']
+            unsorted = self._hashlist(paths)
+            self.assertFalse(unsorted.path_ordered)
+            in_order = self._hashlist(sorted(paths))
+
+            for name, hl in (('u', unsorted), ('s', in_order)):
+                sigfile_write(hl, os.path.join(tmp, name), self.opts,
+                              binary_path=os.path.join(tmp, name + '.bin'),
+                              tree_path=os.path.join(tmp, name + '.tree'))
+            for suffix in ('', '.bin', '.tree'):
+                with open(os.path.join(tmp, 'u' + suffix), 'rb') as f:
+                    u = f.read()
+                with open(os.path.join(tmp, 's' + suffix), 'rb') as f:
+                    self.assertEqual(u, f.read(), suffix)
+
+            self.assertFalse(unsorted.path_ordered)
+            self.assertEqual([fh.fpath for fh in unsorted], paths)
+            self.assertEqual(sorted(os.listdir(tmp)),
+                             ['s', 's.bin', 's.tree', 'u', 'u.bin', 'u.tree'])
+        finally:
+            extsort.RUN_SIZE = old_run_size
+            shutil.rmtree(tmp, True)
+
+    def test_sigfile_write_unsorted_sqlite(self):
+        '''An unsorted sqlite hashlist is sorted in SQL, and written'''
+        tmp = tempfile.mkdtemp()
+        try:
+            paths = ['c', 'a', 'b/1', 'b']
+            unsorted = SqliteHashList()
+            unsorted.extend(self._hashlist(paths))
+            self.assertFalse(unsorted.path_ordered)
+            sigfile_write(unsorted, os.path.join(tmp, 'u'), self.opts)
+            sigfile_write(self._hashlist(sorted(paths)),
+                          os.path.join(tmp, 's'), self.opts)
+            with open(os.path.join(tmp, 'u')) as f:
+                u = f.read()
+            with open(os.path.join(tmp, 's')) as f:
+                self.assertEqual(u, f.read())
+            self.assertEqual([fh.fpath for fh in unsorted], sorted(paths))
+        finally:
+            shutil.rmtree(tmp, True)
+
+    def _entries(self, pairs):
+        return self._parse(['%s 100644 %s %s 0 0 %s' %
+                            (h * 64, self.user, self.group, p)
+                            for (p, h) in pairs])
+
+    def _local_copies(self):
+        dst = self._entries([('gone', 'a'), ('keep', 'b'), ('old', 'c')])
+        not_needed = self._entries([('gone', 'a')])
+        needed = self._entries([('n1', 'a'), ('n2', 'a'), ('n3', 'b'),
+                                ('n4', 'c'), ('old', 'd')])
+        for fh in needed:
+            fh.dest_missing = fh.fpath != 'old'
+            fh.contents_differ = not fh.dest_missing
+        (needed, not_needed) = plan_local_copies(needed, not_needed, dst,
+                                                 self.opts)
+        return (dict((fh.fpath, (fh.local_copy_from,
+                                 getattr(fh, 'local_copy_rename', None)))
+                     for fh in needed),
+                [fh.fpath for fh in not_needed])
+
+    def test_plan_local_copies(self):
+        '''Needed contents already on the destination are used'''
+        (copies, not_needed) = self._local_copies()
+        self.assertEqual(copies, {
+            'n1': ('gone', True),
+            'n2': ('n1', False),
+            'n3': ('keep', False),
+            'n4': (None, None),  # 'old' is about to be overwritten.
+            'old': (None, None),
+        })
+        self.assertEqual(not_needed, [])
+
+    def test_plan_local_copies_no_delete(self):
+        '''Files are copied, not renamed, if deletes are off'''
+        self.opts.no_delete = True
+        (copies, not_needed) = self._local_copies()
+        self.assertEqual(copies['n1'], ('gone', False))
+        self.assertEqual(copies['n2'], ('gone', False))
+        self.assertEqual(copies['n3'], ('keep', False))
+        self.assertEqual(not_needed, ['gone'])
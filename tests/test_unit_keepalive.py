@@ -0,0 +1,117 @@
+# Unit tests for HTTP keep-alive connection pooling.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import unittest
+import urllib2
+
+from hsync.keepalive import *
+from hsync.stats import StatsCollector
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = 'x' * 10000
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if self.path == '/close':
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up early is expected here.
+        pass
+
+
+class KeepAliveUnitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+        self.stats = StatsCollector.init('teststats', [
+            'http_connections_opened', 'http_connections_reused'])
+        self.pool = ConnectionPool(stats=self.stats)
+        self.opener = urllib2.build_opener(*keepalive_handlers(self.pool))
+
+    def tearDown(self):
+        self.pool.close_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _fetch(self, path, amt=None):
+        url = self.opener.open(self.url + path)
+        try:
+            return url.read(amt) if amt is not None else url.read()
+        finally:
+            url.close()
+
+    def test_reuse(self):
+        '''Sequential requests share one connection'''
+        for n in xrange(5):
+            self.assertEquals(len(self._fetch('/f%d' % n)), 10000)
+        self.assertEquals(self.stats.http_connections_opened, 1)
+        self.assertEquals(self.stats.http_connections_reused, 4)
+
+    def test_partial_read_not_reused(self):
+        '''A connection with unread data isn't reused'''
+        self._fetch('/a', 100)
+        self._fetch('/b')
+        self.assertEquals(self.stats.http_connections_opened, 2)
+        self.assertEquals(self.stats.http_connections_reused, 0)
+
+    def test_connection_close(self):
+        '''The server can refuse keep-alive'''
+        self._fetch('/close')
+        self._fetch('/b')
+        self.assertEquals(self.stats.http_connections_opened, 2)
+
+    def test_stale_connection(self):
+        '''A dead pooled connection is replaced transparently'''
+        self._fetch('/a')
+        for conns in self.pool.idle.values():
+            for conn in conns:
+                conn.sock.close()
+        self.assertEquals(len(self._fetch('/b')), 10000)
+        self.assertEquals(self.stats.http_connections_opened, 2)
@@ -0,0 +1,177 @@
+# Unit tests for the binary signature format.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from hsync.exceptions import *
+from hsync.filehash import FileHash
+from hsync.hashengine import UnknownDigestError, digest_names, new_digest
+from hsync.hashlist_mmap import MmapHashList
+from hsync.hashlist_op_impl import *
+from hsync.hsync import getopts, init_stats
+from hsync.idmapper import UidGidMapper
+from hsync.sigbin import *
+
+
+class SigBinUnitTestCase(unittest.TestCase):
+
+    mapper = UidGidMapper()
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        (self.opts, args) = getopts(['-q'])
+        self.opts.stats = init_stats()
+        self.user = self.mapper.get_name_for_uid(os.getuid())
+        self.group = self.mapper.get_group_for_gid(os.getgid())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, True)
+
+    def _hashlist(self):
+        lines = [
+            '%s 040755 %s %s 100 0 d' % ('0' * 64, self.user, self.group),
+            '%s 100644 %s %s 200 7 d/f' % (hashlib.sha256('x').hexdigest(),
+                                           self.user, self.group),
+            '%s 120777 %s %s 300 3 d/l>>> f' % ('0' * 64,
+                                                self.user, self.group),
+            '%s 100600 root root 400 %d e' % (hashlib.sha256('y').hexdigest(),
+                                              2 ** 40),
+        ]
+        return hashlist_from_stringlist(lines, self.opts, root=self.tmp)
+
+    def _write(self, hl):
+        text = os.path.join(self.tmp, 'HSYNC.SIG')
+        binary = text + '.bin'
+        sigfile_write(hl, text, self.opts, binary_path=binary)
+        return binary
+
+    def test_round_trip(self):
+        '''A binary signature loads the same entries as the text one'''
+        hl = self._hashlist()
+        binary = self._write(hl)
+        with open(binary, 'rb') as f:
+            bhl = hashlist_from_sigbin(f, self.opts, root=self.tmp)
+        self.assertEqual(len(bhl), len(hl))
+        for (a, b) in zip(hl, bhl):
+            self.assertEqual(a.presentation_format(), b.presentation_format())
+            self.assertEqual(a.fullpath, b.fullpath)
+            self.assertTrue(b.compare(a))
+
+    def test_final(self):
+        '''The FINAL digest matches the text signature'''
+        binary = self._write(self._hashlist())
+        with open(os.path.join(self.tmp, 'HSYNC.SIG')) as f:
+            final = f.read().splitlines()[-1]
+        with open(binary, 'rb') as f:
+            reader = SigBinReader(f)
+            self.assertEqual('FINAL: %s' % reader.final, final)
+            reader.close()
+
+    def test_find(self):
+        '''Entries can be found by path'''
+        binary = self._write(self._hashlist())
+        with open(binary, 'rb') as f:
+            reader = SigBinReader(f)
+            for (n, path) in enumerate(['d', 'd/f', 'd/l', 'e']):
+                self.assertEqual(reader.find(path), n)
+                self.assertEqual(reader.filehash(n).fpath, path)
+            self.assertIsNone(reader.find('a'))
+            self.assertIsNone(reader.find('d/g'))
+            self.assertIsNone(reader.find('z'))
+            reader.close()
+
+    def test_truncated(self):
+        '''A truncated binary signature is detected'''
+        binary = self._write(self._hashlist())
+        with open(binary, 'rb') as f:
+            data = f.read()
+        for size in (10, len(data) - 1):
+            with open(binary, 'wb') as f:
+                f.write(data[:size])
+            with open(binary, 'rb') as f:
+                with self.assertRaises(TruncatedHashfileError):
+                    SigBinReader(f)
+
+    def test_final_checked(self):
+        '''A binary signature whose entries don't match FINAL is rejected'''
+        binary = self._write(self._hashlist())
+        with open(binary, 'rb') as f:
+            data = f.read()
+        # Change the last byte of the names, the end of 'root'.
+        with open(binary, 'wb') as f:
+            f.write(data[:-1] + 'X')
+        with open(binary, 'rb') as f:
+            with self.assertRaises(TruncatedHashfileError):
+                SigBinReader(f)
+        with open(binary, 'rb') as f:
+            with self.assertRaises(TruncatedHashfileError):
+                MmapHashList(f, self.opts, root=self.tmp)
+
+    def test_digest(self):
+        '''The digest algorithm is recorded'''
+        binary = self._write(self._hashlist())
+        with open(binary, 'rb') as f:
+            reader = SigBinReader(f)
+            self.assertEqual(reader.digest_name, 'sha256')
+            reader.close()
+
+        with open(binary, 'rb') as f:
+            data = f.read()
+        # The algorithm number follows the magic and the version.
+        with open(binary, 'wb') as f:
+            f.write(data[:10] + '\x63\x00' + data[12:])
+        with open(binary, 'rb') as f:
+            with self.assertRaises(UnknownDigestError):
+                SigBinReader(f)
+
+        # Other algorithms can only be read if they're available. The
+        # FINAL digest of no entries is that of nothing at all.
+        available = 'blake2s-256' in digest_names()
+        writer = SigBinWriter(binary, digest_name='blake2s-256')
+        if available:
+            writer.close(new_digest('blake2s-256').hexdigest())
+        else:
+            writer.close('0' * 64)
+        with open(binary, 'rb') as f:
+            if available:
+                reader = SigBinReader(f)
+                self.assertEqual(reader.digest_name, 'blake2s-256')
+                reader.close()
+            else:
+                with self.assertRaises(UnknownDigestError):
+                    SigBinReader(f)
+
+    def test_bad_magic(self):
+        '''A text signature isn't mistaken for a binary one'''
+        self._write(self._hashlist())
+        with open(os.path.join(self.tmp, 'HSYNC.SIG'), 'rb') as f:
+            with self.assertRaises(BadSigBinFormatError):
+                SigBinReader(f)
@@ -0,0 +1,124 @@
+# Unit tests for the signature journal.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from hsync.filehash import FileHash
+from hsync.sigjournal import *
+
+
+class SigJournalUnitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'HSYNC.SIG.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, True)
+
+    def _fh(self, name, size=10):
+        return FileHash.init_from_string('%s 100644 %s %s 0 %d %s' % (
+            '0' * 64, FileHash.mapper.default_name,
+            FileHash.mapper.default_group, size, name))
+
+    def test_lazy(self):
+        '''There's no journal file until something is added'''
+        j = SigJournal(self.path, 10, 1000)
+        j.close()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(journal_lines(self.path), [])
+
+    def test_add(self):
+        '''Entries are written in signature file format'''
+        j = SigJournal(self.path, 10, 1000)
+        fhs = [self._fh('f1'), self._fh('d/f2')]
+        for fh in fhs:
+            j.add(fh)
+        j.close()
+        self.assertEqual(journal_lines(self.path),
+                         [fh.presentation_format() for fh in fhs])
+
+        # Reopening appends.
+        j = SigJournal(self.path, 10, 1000)
+        j.add(self._fh('f3'))
+        j.close()
+        self.assertEqual(len(journal_lines(self.path)), 3)
+
+    def test_header(self):
+        '''Only algorithms other than the default get a header'''
+        j = SigJournal(self.path, 10, 1000, digest_name='blake2s-256')
+        j.add(self._fh('f1'))
+        j.close()
+        self.assertEqual(journal_lines(self.path)[0], '# digest: blake2s-256')
+
+        # Reopening appends, without another header.
+        j = SigJournal(self.path, 10, 1000, digest_name='blake2s-256')
+        j.add(self._fh('f2'))
+        j.close()
+        self.assertEqual(len(journal_lines(self.path)), 3)
+
+    def test_checkpoint(self):
+        '''Checkpoints happen every so many files or bytes'''
+        j = SigJournal(self.path, 3, 1000)
+        for n in xrange(7):
+            j.add(self._fh('f%d' % n))
+        self.assertEqual(j.checkpoints, 2)
+        self.assertEqual(len(journal_lines(self.path)), 6)
+
+        j.add(self._fh('big'), 1000)
+        self.assertEqual(j.checkpoints, 3)
+        j.close()
+
+    def test_incomplete(self):
+        '''An incomplete last line is ignored'''
+        with open(self.path, 'wb') as f:
+            f.write('line1\nline2\nli')
+        self.assertEqual(journal_lines(self.path), ['line1', 'line2'])
+
+    def test_remove(self):
+        '''A removed journal is gone'''
+        j = SigJournal(self.path, 10, 1000)
+        j.add(self._fh('f1'))
+        j.remove()
+        self.assertFalse(os.path.exists(self.path))
+        # It's fine if it's already gone.
+        remove_journal(self.path)
+
+    def test_with_journal(self):
+        '''Journal lines follow the signature, without repeats'''
+        self.assertEqual(list(with_journal(['a', 'b', 'c'], ['b', 'd', 'd'])),
+                         ['a', 'c', 'b', 'd'])
+        # The last of a repeated line is the one kept.
+        self.assertEqual(list(with_journal(['a'], ['x', 'y', 'x'])),
+                         ['a', 'y', 'x'])
+        # Comments are all kept.
+        self.assertEqual(list(with_journal(['#h', 'a'], ['#h', 'b'])),
+                         ['#h', 'a', '#h', 'b'])
@@ -71,6 +71,16 @@ class StatsCollectorUnitTestCase(unittest.TestCase):
         test = {'a': 1, 'b': 2, 'c': 3}
         self.assertEquals(copy, test)
 
+    def test_incr(self):
+        '''incr() adds and returns the new value'''
+        s = StatsCollector.init('statstest', ['a', 'b'])
+        self.assertEquals(s.incr('a'), 1)
+        self.assertEquals(s.incr('a', 10), 11)
+        self.assertEquals(s.a, 11)
+        self.assertEquals(s.b, 0)
+        with self.assertRaises(AttributeError):
+            s.incr('c')
+
     def test_check_str(self):
         '''str() works'''
         s = StatsCollector.init('statstest', ['a', 'b'])
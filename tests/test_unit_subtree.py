@@ -0,0 +1,121 @@
+# Unit tests for the subtree digests.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from hsync.exceptions import *
+from hsync.hashlist_op_impl import *
+from hsync.hsync import getopts, init_stats
+from hsync.idmapper import UidGidMapper
+from hsync.subtree import *
+
+
+class SubtreeUnitTestCase(unittest.TestCase):
+
+    mapper = UidGidMapper()
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        (self.opts, args) = getopts(['-q'])
+        self.opts.stats = init_stats()
+        self.user = self.mapper.get_name_for_uid(os.getuid())
+        self.group = self.mapper.get_group_for_gid(os.getgid())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, True)
+
+    def _hashlist(self, entries):
+        '''entries is a list of (path, hash, mtime), in path order.'''
+        lines = []
+        for (p, h, mtime) in entries:
+            if h is None:
+                lines.append('%064x 040755 %s %s %d 4096 %s' %
+                             (0, self.user, self.group, mtime, p))
+            else:
+                lines.append('%064x 100644 %s %s %d 1 %s' %
+                             (h, self.user, self.group, mtime, p))
+        return hashlist_from_stringlist(lines, self.opts, root=self.tmp)
+
+    tree = [('a', None, 0), ('a-b', 1, 0), ('a/1', 2, 0), ('a/d', None, 0),
+            ('a/d/x', 3, 0), ('b', None, 0), ('b/1', 4, 0)]
+
+    def test_digests(self):
+        '''Every directory gets a digest'''
+        digests = subtree_digests(self._hashlist(self.tree))
+        self.assertEqual(sorted(digests), ['', 'a', 'a/d', 'b'])
+        self.assertEqual(len(set(digests.values())), 4)
+
+    def test_change_propagates(self):
+        '''A change changes the digests of its directory and above'''
+        before = subtree_digests(self._hashlist(self.tree))
+        tree = list(self.tree)
+        tree[4] = ('a/d/x', 5, 0)
+        after = subtree_digests(self._hashlist(tree))
+        for d in ('', 'a', 'a/d'):
+            self.assertNotEqual(before[d], after[d])
+        self.assertEqual(before['b'], after['b'])
+        self.assertEqual(unchanged_prefixes(before, after), ['b/'])
+        self.assertEqual(unchanged_prefixes(before, before), [''])
+
+    def test_dir_mtime_ignored(self):
+        '''Directory mtimes don't affect the digests'''
+        before = subtree_digests(self._hashlist(self.tree))
+        tree = list(self.tree)
+        tree[3] = ('a/d', None, 12345)
+        self.assertEqual(subtree_digests(self._hashlist(tree)), before)
+
+    def test_unchanged_prefixes(self):
+        '''Only the outermost matching directories are given'''
+        src = {'': '1', 'a': '2', 'a/d': '3', 'a-b': '4', 'a-b/c': '5'}
+        dst = {'': '0', 'a': '2', 'a/d': '3', 'a-b': '0', 'a-b/c': '5'}
+        self.assertEqual(unchanged_prefixes(src, dst), ['a-b/c/', 'a/'])
+        self.assertEqual(unchanged_prefixes(src, {}), [])
+
+    def test_file_round_trip(self):
+        '''Subtree files can be read back'''
+        digests = subtree_digests(self._hashlist(self.tree))
+        path = os.path.join(self.tmp, 'HSYNC.SIG.tree')
+        subtree_file_write(digests, path)
+        with open(path) as f:
+            lines = [l.rstrip('\n') for l in f]
+        self.assertEqual(subtree_digests_from_lines(lines), digests)
+        with self.assertRaises(TruncatedHashfileError):
+            subtree_digests_from_lines(lines[:-1])
+
+    def test_sigfile_write(self):
+        '''The subtree file is written along with the signature'''
+        hl = self._hashlist(self.tree)
+        path = os.path.join(self.tmp, 'HSYNC.SIG')
+        sigfile_write(hl, path, self.opts, tree_path=path + '.tree')
+        with open(path + '.tree') as f:
+            lines = [l.rstrip('\n') for l in f]
+        self.assertEqual(subtree_digests_from_lines(lines),
+                         subtree_digests(hl))
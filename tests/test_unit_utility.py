@@ -25,6 +25,8 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
 # THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import fnmatch
+import os
 import unittest
 
 from hsync.utility import *
@@ -219,6 +221,67 @@ class UtilityIncludeUnitTestCase(unittest.TestCase):
         self.assertTrue(_test_include('include/alsoincluded'))
 
 
+class UtilityMatcherUnitTestCase(unittest.TestCase):
+
+    def test_glob_matcher(self):
+        '''A GlobMatcher agrees with fnmatch()'''
+        globs = ['excl*', '*/.exclude', 'a?c', 'x[0-9]y', 'lit.eral',
+                 '[!a]*z', 'dir/*/sub']
+        paths = ['exclude', 'notexcluded/.exclude', 'abc', 'abbc', 'x5y',
+                 'xay', 'lit.eral', 'litXeral', 'bz', 'az', 'dir/a/b/sub',
+                 'dir/sub', 'excl\nude', '']
+        matcher = GlobMatcher(globs)
+        self.assertEqual(len(matcher), len(globs))
+        for path in paths:
+            want = [g for g in globs if fnmatch.fnmatch(path, g)]
+            self.assertEqual(matcher.match(path), bool(want), path)
+
+        self.assertFalse(GlobMatcher().match('anything'))
+        self.assertFalse(GlobMatcher().match(''))
+
+    def test_prefix_set(self):
+        '''A PrefixSet agrees with startswith()'''
+        prefixes = ['exclude/', 'a/b/', 'a/bc/d/', 'x//', '/abs/']
+        paths = ['exclude', 'exclude/', 'exclude/x', 'excludex/y', 'a/b',
+                 'a/b/', 'a/b/c/d', 'a/bc/d', 'a/bc/d/e', 'a/bc/dx',
+                 'x/y', 'x//y', '/abs/z', 'abs/z', '']
+        ps = PrefixSet(prefixes)
+        self.assertEqual(len(ps), len(prefixes))
+        self.assertIn('a/b/', ps)
+        self.assertNotIn('a/b', ps)
+        for path in paths:
+            want = [p for p in prefixes if path.startswith(p)]
+            self.assertEqual(ps.find(path), (want or [None])[0], path)
+
+        ps.add('a/b/')
+        self.assertEqual(len(ps), len(prefixes))
+        with self.assertRaises(ValueError):
+            ps.add('nosep')
+
+    def test_compiled_exclude(self):
+        '''Exclusions work the same with compiled rules'''
+        excluded_dirs = PrefixSet()
+        direx_glob = GlobMatcher(['*/.exclude'])
+        self.assertTrue(is_dir_excluded('notexcluded/.exclude', [],
+                                        direx_glob, excluded_dirs))
+        self.assertEqual(list(excluded_dirs), ['notexcluded/.exclude/'])
+        self.assertTrue(is_path_pre_excluded('notexcluded/.exclude/gone',
+                                             excluded_dirs))
+        self.assertFalse(is_path_pre_excluded('notexcluded/.exclude',
+                                              excluded_dirs))
+        self.assertTrue(is_path_pre_excluded('notexcluded/.exclude',
+                                             excluded_dirs, is_dir=True))
+
+        included_dirs = PrefixSet()
+        inclist_glob = GlobMatcher(['inc*'])
+        self.assertTrue(is_path_included('include', [], inclist_glob,
+                                         included_dirs, is_dir=True))
+        self.assertTrue(is_path_included('include/x', [], GlobMatcher(),
+                                         included_dirs))
+        self.assertFalse(is_path_included('other/x', [], GlobMatcher(),
+                                          included_dirs))
+
+
 class UtilityHashfileUnitTestCase(unittest.TestCase):
 
     def test_simple_default(self):
@@ -227,6 +290,44 @@ class UtilityHashfileUnitTestCase(unittest.TestCase):
         self.assertTrue(is_hashfile('HSYNC.SIG.gz'))
         self.assertFalse(is_hashfile('not-a-hashfile'))
 
+    def test_binary(self):
+        '''Binary hashfile detection'''
+        self.assertTrue(is_hashfile('HSYNC.SIG.bin'))
+        self.assertTrue(is_hashfile('other-HSYNC.SIG.bin'))
+        self.assertFalse(is_hashfile('other-HSYNC.SIG.bin',
+                                     guess_sigfiles=False))
+        self.assertTrue(is_hashfile('custom.bin', custom_hashfile='custom'))
+
+    def test_tree(self):
+        '''Subtree file detection'''
+        self.assertTrue(is_hashfile('HSYNC.SIG.tree'))
+        self.assertTrue(is_hashfile('other-HSYNC.SIG.tree'))
+        self.assertFalse(is_hashfile('other-HSYNC.SIG.tree',
+                                     guess_sigfiles=False))
+        self.assertTrue(is_hashfile('custom.tree', custom_hashfile='custom'))
+
+    def test_journal(self):
+        '''Signature journal detection'''
+        self.assertTrue(is_hashfile('HSYNC.SIG.journal'))
+        self.assertTrue(is_hashfile('other-HSYNC.SIG.journal'))
+        self.assertFalse(is_hashfile('other-HSYNC.SIG.journal',
+                                     guess_sigfiles=False))
+        self.assertTrue(is_hashfile('custom.journal',
+                                    custom_hashfile='custom'))
+
+    def test_cache(self):
+        '''Hash cache detection'''
+        self.assertTrue(is_hashfile('HSYNC.SIG.cache'))
+        self.assertTrue(is_hashfile('other-HSYNC.SIG.cache'))
+        self.assertTrue(is_hashfile('custom.cache', custom_hashfile='custom'))
+
+    def test_chunks(self):
+        '''Chunk signature detection'''
+        self.assertTrue(is_hashfile('HSYNC.SIG.chunks'))
+        self.assertTrue(is_hashfile('other-HSYNC.SIG.chunks'))
+        self.assertTrue(is_hashfile('custom.chunks',
+                                    custom_hashfile='custom'))
+
     def test_simple_compress(self):
         '''Switchable compressed hashfile detection'''
         self.assertTrue(is_hashfile('HSYNC.SIG', allow_compressed=True))
@@ -318,6 +419,17 @@ class UtilityHashfileUnitTestCase(unittest.TestCase):
                                      allow_locks=False,
                                      allow_compressed=False))
 
+    def test_partial(self):
+        '''Partial downloads are detected'''
+        part = os.path.basename(partial_path('d/file.txt',
+                                             '0123456789abcdef' * 4))
+        self.assertEqual(part, '.file.txt.0123456789abcdef.part')
+        self.assertTrue(is_partial(part))
+        self.assertFalse(is_hashfile(part))
+        self.assertTrue(is_hashfile(part, allow_partials=True))
+        self.assertFalse(is_partial('file.part'))
+        self.assertFalse(is_partial('.file.notahexstring.part'))
+
     def test_bad_hashfile_name(self):
         '''Don't allow bogus hashfile spec'''
         with self.assertRaises(Exception):
@@ -0,0 +1,189 @@
+# Unit tests for the inotify source watcher.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import errno
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+from hsync import source_impl, watch
+from hsync.hashlist_op_impl import hashlist_generate
+from hsync.hsync import getopts, init_stats
+from hsync.inotify import *
+from hsync.watch import SourceWatcher
+
+
+class InotifyUnitTestCase(unittest.TestCase):
+
+    def test_parse_events(self):
+        '''Raw events are split up and names unpadded'''
+        buf = struct.pack('iIII', 1, IN_CREATE, 0, 8) + 'name\0\0\0\0' + \
+            struct.pack('iIII', 2, IN_IGNORED, 0, 0)
+        self.assertEqual(list(parse_events(buf)),
+                         [(1, IN_CREATE, 0, 'name'), (2, IN_IGNORED, 0, '')])
+
+
+class SourceWatcherUnitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            Inotify().close()
+        except InotifyUnavailableError as e:
+            self.skipTest(str(e))
+
+        self.topdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.topdir, 'a'))
+        self._write('a/f1', 'f1')
+        self._write('f2', 'f2')
+
+        (self.opts, args) = getopts(['-q', '--watch-delay', '0.1'])
+        self.opts.stats = init_stats()
+        self.old_poll = watch.POLL_INTERVAL
+        watch.POLL_INTERVAL = 0.1
+
+        self.written = []
+        self.stop = threading.Event()
+        self.watcher = SourceWatcher(self.topdir, self.opts, self._written)
+        self.thread = threading.Thread(target=self.watcher.run,
+                                       kwargs={'stop': self.stop.is_set})
+        self.thread.start()
+        self._wait(1)
+
+    def tearDown(self):
+        self.stop.set()
+        self.thread.join()
+        watch.POLL_INTERVAL = self.old_poll
+        shutil.rmtree(self.topdir)
+
+    def _write(self, f, contents):
+        with open(os.path.join(self.topdir, f), 'w') as fh:
+            fh.write(contents)
+
+    def _written(self, hashlist):
+        self.written.append(dict((fh.fpath, fh.hashstr) for fh in hashlist))
+
+    def _wait(self, n):
+        '''Wait for the nth signature to be written, and return it.'''
+        deadline = time.time() + 10
+        while len(self.written) < n and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(self.written), n)
+        return self.written[-1]
+
+    def test_initial(self):
+        '''The first signature covers the tree'''
+        self.assertEqual(sorted(self.written[0]), ['a', 'a/f1', 'f2'])
+        self.assertEqual(sorted(self.watcher.dir_wds),
+                         [self.topdir, os.path.join(self.topdir, 'a')])
+
+    def test_changes(self):
+        '''Changes show up in the next signature'''
+        old = self.written[0]['a/f1']
+        self._write('a/f1', 'changed')
+        os.makedirs(os.path.join(self.topdir, 'b', 'c'))
+        self._write('b/c/f3', 'f3')
+        os.unlink(os.path.join(self.topdir, 'f2'))
+        sig = self._wait(2)
+        self.assertEqual(sorted(sig), ['a', 'a/f1', 'b', 'b/c', 'b/c/f3'])
+        self.assertNotEqual(sig['a/f1'], old)
+
+    def test_move_dir(self):
+        '''A moved directory is found at its new path, and still watched'''
+        os.rename(os.path.join(self.topdir, 'a'),
+                  os.path.join(self.topdir, 'z'))
+        self.assertEqual(sorted(self._wait(2)), ['f2', 'z', 'z/f1'])
+        self._write('z/new', 'new')
+        self.assertIn('z/new', self._wait(3))
+
+    def test_matches_scan(self):
+        '''The signature has what a scan of the tree would find'''
+        os.makedirs(os.path.join(self.topdir, 'b', 'CVS'))
+        self._write('b/CVS/Entries', 'cvs')
+        self._write('b/f5', 'f5')
+        self._write('b/f5~', 'backup')
+        self._write('b/HSYNC.SIG.lock', '')
+        os.mkdir(os.path.join(self.topdir, 'b', 'empty'))
+        scan = dict((fh.fpath, fh.hashstr)
+                    for fh in hashlist_generate(self.topdir, self.opts))
+        self.assertIn('b/f5', scan)
+        deadline = time.time() + 10
+        while self.written[-1] != scan and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.written[-1], scan)
+
+        # Changes in a directory that was empty are seen too.
+        n = len(self.written)
+        self._write('b/empty/f6', 'f6')
+        self.assertIn('b/empty/f6', self._wait(n + 1))
+
+    def test_ignored(self):
+        '''Excluded files don't cause a rewrite'''
+        self._write('a/f1~', 'backup')
+        self._write('a/f4', 'f4')
+        sig = self._wait(2)
+        self.assertIn('a/f4', sig)
+        self.assertNotIn('a/f1~', sig)
+
+
+class SourceWatchErrorUnitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.topdir = tempfile.mkdtemp()
+        (self.opts, args) = getopts(['-q', '-S', self.topdir, '--watch'])
+        self.opts.stats = init_stats()
+        self.old_inotify = watch.Inotify
+
+    def tearDown(self):
+        watch.Inotify = self.old_inotify
+        shutil.rmtree(self.topdir)
+
+    def _source_watch(self):
+        return source_impl.source_watch(
+            os.path.join(self.topdir, 'HSYNC.SIG'), self.opts)
+
+    def test_unavailable(self):
+        '''No inotify is an error, not an exception'''
+        def unavailable():
+            raise InotifyUnavailableError("no inotify here")
+        watch.Inotify = unavailable
+        self.assertFalse(self._source_watch())
+
+    def test_out_of_watches(self):
+        '''Running out of watches is an error, not an exception'''
+        class NoWatches(object):
+            def add_watch(self, path, mask):
+                raise InotifyWatchError(errno.ENOSPC, "Can't watch")
+
+            def close(self):
+                pass
+        watch.Inotify = NoWatches
+        self.assertFalse(self._source_watch())
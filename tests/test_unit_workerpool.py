@@ -0,0 +1,113 @@
+# Unit tests for the worker pool.
+
+# Copyright (c) 2015, Andre Lucas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the <organization> nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import threading
+import time
+import unittest
+
+from hsync.workerpool import *
+
+
+class WorkerPoolUnitTestCase(unittest.TestCase):
+
+    def test_results(self):
+        '''All submitted tasks produce a tagged result'''
+        pool = WorkerPool(4)
+        for n in xrange(20):
+            pool.submit(lambda x: x * 2, (n,), tag=n)
+        results = dict((tag, result) for (tag, result, exc_info)
+                       in pool.wait())
+        pool.close()
+        self.assertEquals(results, dict((n, n * 2) for n in xrange(20)))
+
+    def test_exception(self):
+        '''Exceptions are handed back, not raised in the worker'''
+        def fail():
+            raise ValueError("oops")
+
+        pool = WorkerPool(2)
+        pool.submit(fail, tag='x')
+        results = list(pool.wait())
+        pool.close()
+        self.assertEquals(len(results), 1)
+        (tag, result, exc_info) = results[0]
+        self.assertEquals(tag, 'x')
+        self.assertIsNone(result)
+        self.assertIs(exc_info[0], ValueError)
+
+    def test_wait_after_completed(self):
+        '''wait() only returns the results completed() hasn't'''
+        gate = threading.Event()
+
+        def second():
+            gate.wait()
+            return 'second'
+
+        pool = WorkerPool(2)
+        pool.submit(lambda: 'first', tag=1)
+        pool.submit(second, tag=2)
+        self.assertEquals(pool.next_result()[:2], (1, 'first'))
+        self.assertEquals(list(pool.completed()), [])
+        gate.set()
+        self.assertEquals([r[:2] for r in pool.wait()], [(2, 'second')])
+        self.assertEquals(list(pool.wait()), [])
+        pool.close()
+
+    def test_cost_limit(self):
+        '''The total cost in flight stays under max_cost'''
+        lock = threading.Lock()
+        state = {'cost': 0, 'max': 0}
+
+        def task(cost):
+            with lock:
+                state['cost'] += cost
+                state['max'] = max(state['max'], state['cost'])
+            time.sleep(0.01)
+            with lock:
+                state['cost'] -= cost
+
+        pool = WorkerPool(4, max_cost=100)
+        for n in xrange(20):
+            pool.submit(task, (40,), cost=40)
+        list(pool.wait())
+        pool.close()
+        self.assertLessEqual(state['max'], 80)
+
+    def test_oversize_task_runs(self):
+        '''A task bigger than max_cost still runs, on its own'''
+        pool = WorkerPool(2, max_cost=10)
+        pool.submit(lambda: 'big', cost=1000, tag=1)
+        pool.submit(lambda: 'small', cost=1, tag=2)
+        results = sorted((tag, result) for (tag, result, exc_info)
+                         in pool.wait())
+        pool.close()
+        self.assertEquals(results, [(1, 'big'), (2, 'small')])
+
+    def test_bad_jobs(self):
+        '''At least one worker is required'''
+        with self.assertRaises(ValueError):
+            WorkerPool(0)